@@ -0,0 +1,17 @@
+"""
+Benchmarks of representative grammars at growing input sizes.
+
+    python -m benchmarks                          # all, 1 KB to 10 MB
+    python -m benchmarks --sizes 1K,10K,100K json csv
+    python -m benchmarks --output new.json --compare old.json
+
+Each benchmark builds its input of the requested size from a fixed seed,
+so runs are reproducible and need no network or data files. Every size is
+parsed in a fresh child process, which reports the time of the best run,
+the throughput and the peak memory the parse added. The slope of
+log(time) over log(size) between consecutive sizes shows how a benchmark
+scales: about 1 for linear behavior, about 2 for quadratic. Results are
+written as JSON for comparison between versions.
+
+Benchmarks are listed in grammars.py, measurement lives in runner.py.
+"""
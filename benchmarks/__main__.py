@@ -0,0 +1,59 @@
+import argparse
+import sys
+
+from benchmarks.grammars import benchmarks
+from benchmarks import runner
+
+
+def size(text):
+    """Parse sizes like 1000, 10K or 10M"""
+    units = {'K': 1000, 'M': 1000 ** 2}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+    return int(text)
+
+
+def report(benchmark, measurement):
+    if 'error' in measurement:
+        print '%-14s %10d  %s' % (benchmark.name, measurement['size'],
+                                  measurement['error'])
+    else:
+        print '%-14s %10d  %8.3fs  %10.0f B/s  %8d KB%s' % (
+            benchmark.name, measurement['size'], measurement['seconds'],
+            measurement['throughput'] or 0, measurement['peak_memory_kb'],
+            '' if measurement['complete'] else '  incomplete parse')
+    sys.stdout.flush()
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run: %s' % ', '.join(
+                            b.name for b in benchmarks))
+    parser.add_argument('--sizes', default='1K,10K,100K,1M,10M',
+                        help='comma separated input sizes (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per size, the best counts')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds per size before giving up larger sizes')
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help='results file (default %(default)s)')
+    parser.add_argument('--compare', help='earlier results file to compare to')
+    options = parser.parse_args(arguments)
+
+    selected = [b for b in benchmarks if not options.names or b.name in options.names]
+    sizes = [size(s) for s in options.sizes.split(',')]
+    results = runner.run_all(selected, sizes, options.repeat, options.timeout, report)
+    print
+    for name in sorted(results):
+        print '%-14s slopes %s' % (name, ' '.join(
+            '%.2f' % slope for slope in results[name]['slopes']))
+    runner.save(options.output, results)
+    if options.compare:
+        print
+        for line in runner.compare(runner.load(options.compare), results):
+            print line
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+"""
+The benchmarked grammars and generators of their inputs.
+
+Text inputs are measured in bytes. Structured inputs (lists and objects)
+count 8 bytes per element, the size of a reference.
+"""
+
+import json
+import random
+
+from peg import *
+
+
+class Benchmark(object):
+    """A parser with a generator of inputs of a given size"""
+
+    def __init__(self, name, parser, make):
+        self.name = name
+        self.parser = parser
+        self.make = make
+
+    def parse(self, value):
+        """End position of the first complete parse of value, or None"""
+        for result, pos in self.parser(value, 0):
+            return pos
+
+
+benchmarks = []
+
+def benchmark(name, parser):
+    """Register the decorated input generator"""
+    def register(make):
+        benchmarks.append(Benchmark(name, parser, make))
+        return make
+    return register
+
+
+def single(result):
+    return [result]
+
+def ignore(result):
+    return Empty
+
+def drop(p):
+    """p without its result, so that chaining keeps the other results"""
+    return p >> Make(ignore)
+
+def listed(p, separator):
+    """List of p's results separated by separator, possibly empty"""
+    return ((p >> Make(single)) + star(drop(separator) + p)) | Return([])
+
+
+# Arithmetic expressions building BinaryAdd and BinaryMul nodes
+
+class BinaryAdd(object):
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+
+class BinaryMul(object):
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+
+def sum_of(terms):
+    return reduce(BinaryAdd, terms)
+
+def product_of(factors):
+    return reduce(BinaryMul, factors)
+
+arithmetic = Grammar('sum')
+arithmetic['sum'] = ((arithmetic['product'] >> Make(single)) +
+                     star(drop(item('+')) + arithmetic['product'])) >> Make(sum_of)
+arithmetic['product'] = ((arithmetic['atom'] >> Make(single)) +
+                         star(drop(item('*')) + arithmetic['atom'])) >> Make(product_of)
+arithmetic['atom'] = (capture(plus(Set('0123456789'))) >> Make(int)) | \
+                     (drop(item('(')) + arithmetic['sum'] + drop(item(')')))
+
+
+def expression(rnd, depth):
+    operands = [str(rnd.randint(0, 999)) if depth > 4 or rnd.random() < 0.8
+                else '(%s)' % expression(rnd, depth + 1)
+                for i in xrange(rnd.randint(1, 4))]
+    return rnd.choice('+*').join(operands)
+
+@benchmark('arithmetic', arithmetic)
+def make_arithmetic(size):
+    rnd = random.Random(size)
+    parts, length = [], 0
+    while length < size:
+        parts.append(expression(rnd, 0))
+        length += len(parts[-1]) + 1
+    return '+'.join(parts)
+
+
+# JSON without escapes in strings
+
+ws = skip(Set(' \t\r\n'))
+
+def token(c):
+    return drop(ws + item(c) + ws)
+
+def pairs_to_dict(pairs):
+    return dict(pairs)
+
+def number(text):
+    return float(text) if '.' in text else int(text)
+
+def true(text):
+    return True
+
+def false(text):
+    return False
+
+def null(text):
+    return None
+
+digits = Set('0123456789')
+
+json_grammar = Grammar('value')
+json_grammar['value'] = json_grammar['object'] | json_grammar['array'] | \
+    json_grammar['string'] | json_grammar['number'] | \
+    (literal('true') >> Make(true)) | (literal('false') >> Make(false)) | \
+    (literal('null') >> Make(null))
+json_grammar['object'] = (token('{') +
+                          listed(json_grammar['pair'] >> Make(tuple), token(',')) +
+                          token('}')) >> Make(pairs_to_dict)
+json_grammar['pair'] = (json_grammar['string'] >> Make(single)) + token(':') + \
+                       (json_grammar['value'] >> Make(single))
+json_grammar['array'] = token('[') + listed(json_grammar['value'], token(',')) + \
+                        token(']')
+json_grammar['string'] = drop(item('"')) + \
+    (capture(skip(Set(map(chr, range(32, 128))) - Set('"\\\\'))) >> Make(str)) + \
+    drop(item('"'))
+json_grammar['number'] = capture(skip(item('-')) + plus(digits) +
+                                 skip(item('.') + skip(digits))) >> Make(number)
+
+
+def record(rnd, depth):
+    kind = rnd.random()
+    if depth > 3 or kind < 0.5:
+        return rnd.choice([rnd.randint(-1000, 1000), round(rnd.random() * 100, 3),
+                           'text %d' % rnd.randint(0, 10 ** 6), True, False, None])
+    if kind < 0.75:
+        return [record(rnd, depth + 1) for i in xrange(rnd.randint(0, 5))]
+    return dict(('key%d' % i, record(rnd, depth + 1))
+                for i in xrange(rnd.randint(0, 5)))
+
+@benchmark('json', json_grammar)
+def make_json(size):
+    rnd = random.Random(size)
+    records, length = [], 2
+    while length < size:
+        records.append(json.dumps(record(rnd, 0)))
+        length += len(records[-1]) + 2
+    return '[%s]' % ', '.join(records)
+
+
+# CSV with quoted fields
+
+csv = Grammar('file')
+csv['file'] = star(csv['record'])
+csv['record'] = listed(csv['field'], item(',')) + drop(item('\n'))
+csv['field'] = csv['quoted'] | (capture(skip(Set(map(chr, range(32, 128))) -
+                                             Set(',"'))) >> Make(str))
+csv['quoted'] = drop(item('"')) + \
+    (capture(skip((Set(map(chr, range(32, 128)) + ['\n']) - Set('"')) |
+                  literal('""'))) >> Make(str)) + drop(item('"'))
+
+@benchmark('csv', csv)
+def make_csv(size):
+    rnd = random.Random(size)
+    lines, length = [], 0
+    while length < size:
+        fields = [str(rnd.randint(0, 10 ** 6)) if rnd.random() < 0.5
+                  else '"name, %d"' % rnd.randint(0, 100)
+                  for i in xrange(rnd.randint(1, 8))]
+        lines.append(','.join(fields) + '\n')
+        length += len(lines[-1])
+    return ''.join(lines)
+
+
+# Nested lists parsed with element[...]
+
+row = star(Set(range(10))) + drop(EndOfInput())
+matrix = star(element[row]) + drop(EndOfInput())
+
+@benchmark('lists', matrix)
+def make_lists(size):
+    rnd = random.Random(size)
+    rows, length = [], 0
+    while length < size:
+        rows.append([rnd.randint(0, 9) for i in xrange(rnd.randint(0, 20))])
+        length += 8 * (len(rows[-1]) + 1)
+    return rows
+
+
+# Objects parsed with get and type_of
+
+class X(object):
+
+    def __init__(self, foo):
+        self.foo = foo
+
+
+class Y(object):
+
+    def __init__(self, bar):
+        self.bar = bar
+
+
+the_int = (type_of(X) & get('foo') | type_of(Y) & get('bar'))[type_of(int)]
+objects = star(element[the_int]) + drop(EndOfInput())
+
+@benchmark('objects', objects)
+def make_objects(size):
+    rnd = random.Random(size)
+    return [X(i) if rnd.random() < 0.5 else Y(i) for i in xrange(size // 8)]
+
+
+# The same objects, dispatched on their type
+
+class Z(Y):
+    pass
+
+dispatched_int = match_type({X: get('foo'), Y: get('bar')})[type_of(int)]
+dispatched = star(element[dispatched_int]) + drop(EndOfInput())
+
+@benchmark('dispatch', dispatched)
+def make_dispatched(size):
+    rnd = random.Random(size)
+    return [rnd.choice((X, Y, Z))(i) for i in xrange(size // 8)]
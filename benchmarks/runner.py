@@ -0,0 +1,113 @@
+"""
+Measurement of benchmarks in child processes.
+"""
+
+import gc
+import json
+import math
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+def measure(benchmark, size, repeat, connection):
+    """Child process: parse an input of size repeat times and send
+    the measurement"""
+    try:
+        value = benchmark.make(size)
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best = None
+        for run in xrange(repeat):
+            start = time.time()
+            end = benchmark.parse(value)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        complete = end == len(value)
+        connection.send({'size': size, 'seconds': best,
+                         'throughput': size / best if best else None,
+                         'peak_memory_kb': peak, 'complete': complete})
+    except Exception as error:
+        connection.send({'size': size, 'error': repr(error)})
+
+
+def run(benchmark, size, repeat=1, timeout=None):
+    """Measurement of benchmark at size, in a fresh process"""
+    receiver, sender = multiprocessing.Pipe(False)
+    child = multiprocessing.Process(target=measure,
+                                    args=(benchmark, size, repeat, sender))
+    child.start()
+    if receiver.poll(timeout):
+        result = receiver.recv()
+    else:
+        child.terminate()
+        result = {'size': size, 'error': 'timeout after %ss' % timeout}
+    child.join()
+    return result
+
+
+def slopes(measurements):
+    """log(time) / log(size) between consecutive measurements, about 1
+    for linear and 2 for quadratic scaling"""
+    timed = [m for m in measurements if m.get('seconds')]
+    return [math.log(b['seconds'] / a['seconds']) / math.log(float(b['size']) / a['size'])
+            for a, b in zip(timed, timed[1:])]
+
+
+def run_all(benchmarks, sizes, repeat=1, timeout=None, report=None):
+    """Results of all benchmarks. Larger sizes are skipped once a size
+    failed or timed out."""
+    results = {}
+    for benchmark in benchmarks:
+        measurements = []
+        for size in sizes:
+            measurement = run(benchmark, size, repeat, timeout)
+            measurements.append(measurement)
+            if report:
+                report(benchmark, measurement)
+            if 'error' in measurement:
+                break
+        results[benchmark.name] = {'measurements': measurements,
+                                   'slopes': slopes(measurements)}
+    return results
+
+
+def environment():
+    """Description of the measured version and machine"""
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'python': sys.version, 'platform': platform.platform(),
+            'revision': revision, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def save(path, results):
+    with open(path, 'w') as output:
+        json.dump({'environment': environment(), 'results': results},
+                  output, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as results:
+        return json.load(results)['results']
+
+
+def compare(old, new):
+    """Lines comparing the times of two result sets, size by size"""
+    lines = []
+    for name in sorted(new):
+        before = dict((m['size'], m) for m in old.get(name, {}).get('measurements', []))
+        for measurement in new[name]['measurements']:
+            previous = before.get(measurement['size'], {})
+            if measurement.get('seconds') and previous.get('seconds'):
+                lines.append('%-14s %10d  %8.3fs -> %8.3fs  x%.2f' % (
+                    name, measurement['size'], previous['seconds'],
+                    measurement['seconds'],
+                    measurement['seconds'] / previous['seconds']))
+    return lines
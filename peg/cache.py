@@ -0,0 +1,168 @@
+"""
+On-disk cache of built grammars.
+
+Building a large grammar evaluates thousands of operators, compiling it
+generates and compiles Python code. A cache stores the finished grammar,
+compiled code included as bytecode, under a fingerprint of the code that
+builds it:
+
+    def build():
+        g = Grammar('expr')
+        ...
+        return g.compile()
+
+    g = Grammar.cached(build)       # builds or loads on first use
+    g(data)
+
+The fingerprint covers the source of the module defining the builder, the
+builder's name, the sources of this package, the Python version and an
+optional key, so changing any of them builds the grammar again. Grammars
+cached this way must be picklable: rules may not contain lambdas or other
+functions pickle cannot refer to by name. Grammars that cannot be pickled
+are used as built and never stored, so every process builds them again.
+
+The cache lives in $PEG_CACHE or ~/.cache/peg unless a directory is given.
+Failing to write the cache only costs the next process a rebuild.
+"""
+
+import cPickle as pickle
+import hashlib
+import inspect
+import marshal
+import os
+import sys
+import tempfile
+
+from expressions import Expression
+
+
+def default_directory():
+    return os.environ.get('PEG_CACHE') or \
+        os.path.join(os.path.expanduser('~'), '.cache', 'peg')
+
+
+package_digest = None
+
+def package_fingerprint():
+    """Digest of the sources of this package"""
+    global package_digest
+    if package_digest is None:
+        digest = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                with open(os.path.join(directory, name), 'rb') as source:
+                    digest.update(source.read())
+        package_digest = digest.hexdigest()
+    return package_digest
+
+
+def fingerprint(builder, key=None):
+    """Cache key of the grammar built by builder"""
+    digest = hashlib.sha1()
+    digest.update(package_fingerprint())
+    digest.update(sys.version)
+    digest.update('%s.%s' % (builder.__module__, builder.__name__))
+    try:
+        digest.update(inspect.getsource(sys.modules[builder.__module__]))
+    except (IOError, TypeError, KeyError):
+        digest.update(marshal.dumps(builder.func_code))
+    if key is not None:
+        digest.update(repr(key))
+    return digest.hexdigest()
+
+
+class GrammarCache(object):
+    """Directory of pickled grammars by fingerprint"""
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.grammar')
+
+    def load(self, key):
+        """The cached grammar or None"""
+        try:
+            with open(self.path(key), 'rb') as cached:
+                return pickle.load(cached)
+        except Exception:
+            # missing, truncated or unreadable file: build again
+            return None
+
+    def store(self, key, grammar):
+        """Write grammar atomically. Unwritable directories and grammars
+        that cannot be pickled, e.g. nested too deeply, are ignored."""
+        try:
+            data = pickle.dumps(grammar, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, temporary = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(handle, 'wb') as cached:
+                cached.write(data)
+            os.rename(temporary, self.path(key))
+        except (IOError, OSError):
+            pass
+
+
+class LazyGrammar(Expression):
+    """Grammar loaded from the cache, or built and cached, on first use.
+    Behaves as the grammar: its members are those of the loaded one."""
+
+    fields = ('builder', 'cache', 'key', 'grammar')
+
+    def __init__(self, builder, cache, key):
+        self.builder = builder
+        self.cache = cache
+        self.key = key
+        self.grammar = None
+
+    def load(self):
+        if self.grammar is None:
+            grammar = self.cache.load(self.key)
+            if grammar is None:
+                grammar = self.builder()
+                self.cache.store(self.key, grammar)
+            self.grammar = grammar
+        return self.grammar
+
+    def __call__(self, value, position=0):
+        return self.load()(value, position)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def match(self, value, position):
+        return self.load().match(value, position)
+
+    def parse(self, value, position=0):
+        return self.load().parse(value, position)
+
+    def parse_many(self, iterable, workers=None, chunksize=1):
+        return self.load().parse_many(iterable, workers, chunksize)
+
+    # methods Expression defines for the proxy itself
+    def compile(self):
+        return self.load().compile()
+
+    def optimize(self):
+        return self.load().optimize()
+
+    def intern(self):
+        return self.load().intern()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in self.fields:
+            # not set yet, e.g. while copying
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+def cached(builder, directory=None, key=None):
+    return LazyGrammar(builder, GrammarCache(directory), fingerprint(builder, key))
@@ -0,0 +1,417 @@
+"""
+Compilation of expression trees into specialized Python code.
+
+Each expression node is translated into a generator function with the
+same contract as Expression.__call__. Children are inlined into their
+parent's function where possible: element tests become plain `if`
+statements on explicit position variables and nested alternatives become
+consecutive blocks. Nodes the compiler does not know (including the
+expressions created at parse time by Bind) are called as they are, so a
+compiled expression yields exactly the results of the interpreted one,
+in the same order.
+
+    p.compile()(data, 0)        # compiled expression
+    g.compile()                 # compile all rules of grammar g in place
+    g(data)
+
+Node types are translated by handlers registered with @translates.
+Handlers apply to the exact type only, so subclasses overriding __call__
+are never compiled with their parent's semantics.
+"""
+
+import marshal
+
+from expressions import *
+from prediction import Dispatch
+from structure import Get, At, TypeOf, MatchType
+
+
+handlers = {}
+
+def translates(cls):
+    """Register the decorated function as translation of cls nodes"""
+    def register(handler):
+        handlers[cls] = handler
+        return handler
+    return register
+
+
+# Maximum loop nesting of inlined code. Python refuses to compile more
+# than 20 statically nested blocks, deeper trees are split into functions.
+MAX_NESTING = 10
+
+
+def indent(lines, level=1):
+    return ['    ' * level + line for line in lines]
+
+def nesting(lines):
+    """Number of loop blocks surrounding the innermost line"""
+    depth = 0
+    for line in lines:
+        stripped = line.lstrip()
+        if stripped.startswith('for ') or stripped.startswith('while '):
+            depth = max(depth, (len(line) - len(stripped)) // 4 + 1)
+    return depth
+
+
+class Compiler(object):
+    """Generates one module of Python source for a set of expressions"""
+
+    def __init__(self):
+        self.namespace = {'len': len, 'isinstance': isinstance}
+        self.names = {}         # id(object) -> constant name
+        self.functions = {}     # id(node) -> function name
+        self.queue = []
+        self.source = []
+        self.counter = 0
+
+    def fresh(self, prefix):
+        self.counter += 1
+        return '%s%d' % (prefix, self.counter)
+
+    def constant(self, obj):
+        """Name under which obj is visible to generated code"""
+        name = self.names.get(id(obj))
+        if name is None:
+            name = self.names[id(obj)] = self.fresh('_c')
+            self.namespace[name] = obj
+        return name
+
+    def function(self, node):
+        """Name of the generator function compiled for node"""
+        name = self.functions.get(id(node))
+        if name is None:
+            name = self.functions[id(node)] = self.fresh('_f')
+            self.constant(node)     # keep node alive while its id is in use
+            self.queue.append((name, node))
+        return name
+
+    def call(self, node, value, pos, r, p, body):
+        """Iterate over the results of node through a function call"""
+        handler = handlers.get(type(node))
+        callee = self.function(node) if handler else self.constant(node)
+        return ['for %s, %s in %s(%s, %s):' % (r, p, callee, value, pos)] + \
+               indent(body)
+
+    def inline(self, node, value, pos, r, p, body):
+        """Lines running body once for each result (r, p) of node parsing
+        value at pos"""
+        handler = handlers.get(type(node))
+        if handler is None:
+            return self.call(node, value, pos, r, p, body)
+        if nesting(body) >= MAX_NESTING and not getattr(handler, 'leaf', False):
+            return self.call(node, value, pos, r, p, body)
+        return handler(self, node, value, pos, r, p, body)
+
+    def build(self):
+        """Compile all queued nodes and execute the generated module"""
+        while self.queue:
+            name, node = self.queue.pop(0)
+            body = self.inline(node, 'value', 'position', 'r', 'p',
+                               ['yield r, p'])
+            # failing nodes drop the body with its yield, keep a generator
+            body += ['return', 'yield']
+            self.source += ['def %s(value, position):' % name] + \
+                           indent(body) + ['']
+        source = '\n'.join(self.source)
+        self.constants = dict(self.namespace)
+        self.code = compile(source, '<compiled grammar>', 'exec')
+        exec(self.code, self.namespace)
+        return source
+
+    def generated(self, node):
+        return self.namespace[self.functions[id(node)]]
+
+
+class Compiled(Expression):
+    """An expression together with its compiled generator function"""
+
+    __slots__ = ('expression', 'function', 'source')
+
+    def __init__(self, expression, function, source):
+        self.expression = expression
+        self.function = function
+        self.source = source
+
+    def __call__(self, value, position):
+        return self.function(value, position)
+
+    def match(self, value, position):
+        return self.expression.match(value, position)
+
+    def __reduce__(self):
+        # generated functions cannot be pickled, compile again instead
+        return compile_expression, (self.expression,)
+
+
+def compile_expression(expression):
+    compiler = Compiler()
+    compiler.function(expression)
+    source = compiler.build()
+    return Compiled(expression, compiler.generated(expression), source)
+
+
+def compile_grammar(grammar):
+    """Compile all rules of grammar. Returns {key: generator function}."""
+    compiler = Compiler()
+    for rule in grammar.rules.values():
+        compiler.function(rule)
+    compiler.build()
+    return CompiledRules(((key, compiler.generated(rule))
+                          for key, rule in grammar.rules.items()),
+                         compiler.code, compiler.constants)
+
+
+class CompiledRules(dict):
+    """Generated functions by rule key. Pickles as bytecode and constants,
+    so loading does not run the compiler again."""
+
+    def __init__(self, functions, code, constants):
+        dict.__init__(self, functions)
+        self.code = code
+        self.constants = constants
+
+    def __reduce__(self):
+        names = dict((key, function.__name__) for key, function in self.items())
+        return load_rules, (marshal.dumps(self.code), self.constants, names)
+
+
+def load_rules(code, constants, names):
+    code = marshal.loads(code)
+    namespace = dict(constants)
+    exec(code, namespace)
+    return CompiledRules(((key, namespace[name]) for key, name in names.items()),
+                         code, constants)
+
+
+def leaf(handler):
+    """Mark a handler which opens no loops of its own"""
+    handler.leaf = True
+    return handler
+
+
+@translates(Element)
+@leaf
+def translate_element(c, node, value, pos, r, p, body):
+    return ['if %s < len(%s):' % (pos, value),
+            '    %s = %s[%s]' % (r, value, pos),
+            '    %s = %s + 1' % (p, pos)] + indent(body)
+
+
+@translates(Set)
+@leaf
+def translate_set(c, node, value, pos, r, p, body):
+    test = '%s in %s' % (r, c.constant(node.members))
+    if node.octets is not None:
+        test += ' or %s in %s and %s(%s)' % (r, c.constant(node.octets),
+                                            c.constant(is_binary), value)
+    return ['if %s < len(%s):' % (pos, value),
+            '    %s = %s[%s]' % (r, value, pos),
+            '    if %s:' % test,
+            '        %s = %s + 1' % (p, pos)] + indent(body, 2)
+
+
+@translates(Literal)
+@leaf
+def translate_literal(c, node, value, pos, r, p, body):
+    literal = c.constant(node)
+    return ['if %s.matches(%s, %s):' % (literal, value, pos),
+            '    %s = %s.matched(%s, %s)' % (r, literal, value, pos),
+            '    %s = %s + %d' % (p, pos, len(node.elements))] + indent(body)
+
+
+@translates(Item)
+@leaf
+def translate_item(c, node, value, pos, r, p, body):
+    element = c.constant(node.element)
+    test = '%s < len(%s) and %s[%s] == %s' % (pos, value, value, pos, element)
+    if node.octets is not None:
+        test += ' or %s(%s) and %s.matches(%s, %s)' % (
+            c.constant(is_binary), value, c.constant(node), value, pos)
+    return ['if %s:' % test,
+            '    %s = %s[%s]' % (r, value, pos),
+            '    %s = %s + 1' % (p, pos)] + indent(body)
+
+
+@translates(Items)
+@leaf
+def translate_items(c, node, value, pos, r, p, body):
+    return ['if %s.accepts(%s, %s):' % (c.constant(node), value, pos),
+            '    %s = %s[%s]' % (r, value, pos),
+            '    %s = %s + 1' % (p, pos)] + indent(body)
+
+
+@translates(When)
+@leaf
+def translate_when(c, node, value, pos, r, p, body):
+    return ['if %s < len(%s):' % (pos, value),
+            '    %s = %s[%s]' % (r, value, pos),
+            '    if %s(%s):' % (c.constant(node.predicate), r),
+            '        %s = %s + 1' % (p, pos)] + indent(body, 2)
+
+
+@translates(Get)
+@translates(At)
+@leaf
+def translate_getter(c, node, value, pos, r, p, body):
+    # getters cannot be pickled with the compiled rules, their nodes can
+    return ['%s = %s.getter(%s)' % (r, c.constant(node), value),
+            '%s = %s' % (p, pos)] + body
+
+
+@translates(TypeOf)
+@leaf
+def translate_type_of(c, node, value, pos, r, p, body):
+    return ['if isinstance(%s, %s):' % (value, c.constant(node.atype)),
+            '    %s = %s' % (r, value),
+            '    %s = %s' % (p, pos)] + indent(body)
+
+
+@translates(Return)
+@leaf
+def translate_return(c, node, value, pos, r, p, body):
+    return ['%s = %s' % (r, c.constant(node.result)),
+            '%s = %s' % (p, pos)] + body
+
+
+@translates(Zero)
+@leaf
+def translate_zero(c, node, value, pos, r, p, body):
+    return ['pass']
+
+
+@translates(EndOfInput)
+@leaf
+def translate_end(c, node, value, pos, r, p, body):
+    return ['if %s == len(%s):' % (pos, value),
+            '    %s = %s(%s)' % (r, c.constant(End), pos),
+            '    %s = %s' % (p, pos)] + indent(body)
+
+
+@translates(Branch)
+def translate_branch(c, node, value, pos, r, p, body):
+    if len(body) > 2:
+        # do not duplicate large continuations
+        return c.call(node, value, pos, r, p, body)
+    return c.inline(node.p, value, pos, r, p, body) + \
+           c.inline(node.q, value, pos, r, p, body)
+
+
+@translates(Alternatives)
+def translate_alternatives(c, node, value, pos, r, p, body):
+    if len(body) > 2:
+        return c.call(node, value, pos, r, p, body)
+    lines = []
+    for arm in node.arms:
+        lines += c.inline(arm, value, pos, r, p, body)
+    return lines
+
+
+@translates(Sequence)
+def translate_sequence(c, node, value, pos, r, p, body):
+    concat = c.constant(concatenate)
+    results = [c.fresh('r') for part in node.parts]
+    positions = [c.fresh('p') for part in node.parts]
+    lines = ['%s = %s' % (r, results[-1]), '%s = %s' % (p, positions[-1])] + body
+    for index in reversed(range(len(node.parts))):
+        if index:
+            start = positions[index - 1]
+            lines = ['%s = %s(%s, %s)' % (results[index], concat,
+                                          results[index - 1], results[index])] + lines
+        else:
+            start = pos
+        lines = c.inline(node.parts[index], value, start,
+                         results[index], positions[index], lines)
+    return lines
+
+
+@translates(Bind)
+def translate_bind(c, node, value, pos, r, p, body):
+    r1, p1 = c.fresh('r'), c.fresh('p')
+    each = c.constant(node.each)
+    return c.inline(node.expr, value, pos, r1, p1,
+                    ['for %s, %s in %s(%s)(%s, %s):' % (r, p, each, r1, value, p1)]
+                    + indent(body))
+
+
+@translates(Both)
+def translate_both(c, node, value, pos, r, p, body):
+    r1, p1 = c.fresh('r'), c.fresh('p')
+    return c.inline(node.p, value, pos, r1, p1,
+                    c.inline(node.q, value, pos, r, p, body))
+
+
+@translates(Inside)
+def translate_inside(c, node, value, pos, r, p, body):
+    outer, p1, p2 = c.fresh('r'), c.fresh('p'), c.fresh('p')
+    return c.inline(node.outer, value, pos, outer, p1,
+                    c.inline(node.inner, outer, '0', r, p2,
+                             ['%s = %s' % (p, p1)] + body))
+
+
+@translates(Cut)
+def translate_cut(c, node, value, pos, r, p, body):
+    commit = ['if isinstance(%s, %s):' % (value, c.constant(Stream)),
+              '    %s.commit(%s)' % (value, p)]
+    return c.call(node.expr, value, pos, r, p, commit + body + ['break'])
+
+
+@translates(Unify)
+def translate_unify(c, node, value, pos, r, p, body):
+    r1 = c.fresh('r')
+    pattern = c.constant(node.pattern)
+    return c.inline(node.expression, value, pos, r1, p,
+                    ['for %s in %s.unify(%s):' % (r, pattern, r1)]
+                    + indent(body))
+
+
+@translates(Repeat)
+def translate_repeat(c, node, value, pos, r, p, body):
+    what = c.function(node.what) if type(node.what) in handlers \
+        else c.constant(node.what)
+    r1, p1, n = c.fresh('r'), c.fresh('p'), c.fresh('n')
+    collect = ['        %s.append(%s)' % (r, r1)] if node.mode == 'list' else []
+    lines = ['%s = []' % r,
+             '%s = 0' % n,
+             '%s = %s' % (p, pos),
+             'while True:',
+             '    for %s, %s in %s(%s, %s):' % (r1, p1, what, value, p)] + \
+            collect + \
+            ['        %s += 1' % n,
+             '        %s = %s' % (p, p1),
+             '        break',
+             '    else:',
+             '        break']
+    if node.mode == 'count':
+        body = ['%s = %s' % (r, n)] + body
+    elif node.mode == 'span':
+        body = ['%s = %s, %s' % (r, pos, p)] + body
+    elif node.mode == 'skip':
+        body = ['%s = %s' % (r, c.constant(Empty))] + body
+    if node.once:
+        return lines + ['if %s:' % n] + indent(body)
+    return lines + body
+
+
+@translates(Dispatch)
+def translate_dispatch(c, node, value, pos, r, p, body):
+    if len(body) > 2:
+        return c.call(node, value, pos, r, p, body)
+    index = c.fresh('i')
+    lines = ['for %s in %s.select(%s, %s):' % (index, c.constant(node), value, pos)]
+    for i, arm in enumerate(node.alternatives):
+        lines += indent(['%s %s == %d:' % ('elif' if i else 'if', index, i)] +
+                        indent(c.inline(arm, value, pos, r, p, body)))
+    return lines
+
+
+@translates(MatchType)
+def translate_match_type(c, node, value, pos, r, p, body):
+    if len(body) > 2:
+        return c.call(node, value, pos, r, p, body)
+    index = c.fresh('i')
+    lines = ['%s = %s.select(%s)' % (index, c.constant(node), value)]
+    for i, parser in enumerate(node.parsers):
+        lines += ['%s %s == %d:' % ('elif' if i else 'if', index, i)] + \
+                 indent(c.inline(parser, value, pos, r, p, body))
+    return lines
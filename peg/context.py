@@ -0,0 +1,139 @@
+"""
+Per-parse state.
+
+A Context holds what one parse changes while it runs: the rule
+applications in progress (for left recursion), the positions where seeds
+are growing and the bindings of Variables. Every call g(data) of a
+grammar parses in a fresh Context, so one grammar instance serves any
+number of nested, interleaved or concurrent parses, e.g. from the
+threads of a pool:
+
+    g = build_grammar()
+    pool.map(lambda text: next(g(text)), texts)
+
+Expressions keep their signature (value, position). The context of the
+parse is current while the parse computes its next result: parse()
+makes it current for each step of the generator and restores the
+previous one afterwards; call() does the same for a single call, as
+g.parse(data) makes. The current context is thread-local.
+
+Expressions parsed outside of any grammar run without a context and keep
+Variable bindings on the Variable, as before. Use Context().parse(p,
+value) to isolate such parses as well.
+
+Caches and statistics are shared by all parses of a grammar: its Memo
+table and its Profile. Memo entries belong to the context of the parse
+which created them and are advanced with it as the current context.
+Other parses reuse an entry once it is complete or its parse finished,
+so concurrent parses may share one memoized grammar. g.parse(data)
+caches in the Context instead: the first result of each rule
+application.
+"""
+
+import threading
+
+
+local = threading.local()
+
+# held while a finished parse is resumed by one of its memo entries
+resuming = threading.RLock()
+
+def current():
+    """The context of the parse running in this thread, or None"""
+    return getattr(local, 'context', None)
+
+
+class Context(object):
+    """State of one parse"""
+
+    def __init__(self, parent=None):
+        self.active = {}    # (grammar id, rule, position, input id) -> Activation
+        self.growing = {}   # (position, input id) -> number of growing seeds
+        # parses nested in another one see the bindings made so far
+        self.bindings = dict(parent.bindings) if parent is not None else {}
+        # state of match(), the first-result mode
+        self.seeds = {}         # rule application in progress -> its seed
+        self.recursive = set()  # those found to be left-recursive
+        self.recursions = 0     # number of seeds answered so far
+        self.matched = {}       # rule application -> cached first result
+        self.running = 0        # computations in progress with self current
+        self.finished = False   # whether the parse(), if any, is over
+
+    def call(self, function, value, position=0):
+        """function(value, position) computed with self as the current
+        context"""
+        return self.resume(lambda: function(value, position))
+
+    def resume(self, function):
+        """function() computed with self as the current context. Once its
+        parse finished, a context is only resumed by the memo entries it
+        left in progress, from any thread but one at a time."""
+        resumed = self.finished
+        if resumed:
+            resuming.acquire()
+        outer = current()
+        local.context = self
+        self.running += 1
+        try:
+            return function()
+        finally:
+            self.running -= 1
+            local.context = outer
+            if resumed:
+                resuming.release()
+
+    def parse(self, parser, value, position=0):
+        """Results of parser on value, computed with self as the current
+        context"""
+        try:
+            results = self.call(
+                lambda value, position: iter(parser(value, position)),
+                value, position)
+            while True:
+                try:
+                    result = self.resume(lambda: next(results))
+                except StopIteration:
+                    return
+                yield result
+        finally:
+            self.finished = True
+
+    def activate(self, key, frame, results):
+        """Mark a rule application as active while results computes.
+        The mark is removed whenever a result is handed out, so only
+        applications on the current call stack count as active."""
+        results = iter(results)
+        while True:
+            self.active[key] = frame
+            try:
+                result = next(results)
+            except StopIteration:
+                return
+            finally:
+                del self.active[key]
+            yield result
+
+    def recurse(self, grammar, rule, position, value, frame):
+        """Re-entry of an active rule at the same position. Answers with
+        the seed grown so far and marks the rule as left-recursive."""
+        if not frame.left_recursive:
+            frame.left_recursive = True
+            key = position, id(value)
+            self.growing[key] = self.growing.get(key, 0) + 1
+            if grammar.memo is not None:
+                # rules entered between the head and its recursive call
+                # were cached with results computed from the seed
+                for owner, other, pos, input_id in self.active.keys():
+                    if owner == id(grammar) and pos == position and \
+                            input_id == id(value) and other != rule:
+                        grammar.memo.discard(other, position, value)
+        return frame.replay()
+
+    def is_growing(self, position, value):
+        return (position, id(value)) in self.growing
+
+    def stop_growing(self, position, value):
+        key = position, id(value)
+        self.growing[key] -= 1
+        if not self.growing[key]:
+            del self.growing[key]
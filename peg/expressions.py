@@ -45,12 +45,27 @@ The following additional expressions are present:
     item(x)
         Consumes just x and returns it.
 
-    chain(p, q)
-        Apply parser p followed by parser q. Returns q's result.
+    literal(xs)
+        Consumes exactly the elements of xs. Yields the matched input, as
+        chaining item(x) for each element would. Adjacent items are fused into one
+        literal automatically, e.g. item('i') + item('f') == literal('if')
 
-    when(p, cond)
-        Apply p but filter results by cond. cond should be a lambda
-        expression taking p's result as input and return a bool.
+    Regex(pattern)
+        Matches the regular expression at the current position of a
+        string and returns the matched text.
+
+    capture(p)
+        Apply p but return a Span, a view of the consumed input which is
+        copied only when unpacked (e.g. by Make). Adjacent spans chain
+        into one span, so sequences of captures do not copy at all.
+
+    chain(p, q), also p + q
+        Apply parser p followed by parser q. Returns the concatenation of
+        their results. A chain p1 + p2 + ... + pn is one n-ary Sequence.
+
+    when(cond)
+        Consumes the next element if cond, a function taking the element,
+        returns true. Returns the element.
 
     many(p)
         Non-greedy star. Apply p zero or more times, backtrack as needed.
@@ -58,6 +73,9 @@ The following additional expressions are present:
     some(p)
         Non-greedy plus. Apply p one or more times, backtracking as needed.
 
+    Repetitions of a Set in many, some, star and plus scan strings with
+    a regular expression instead of one element at a time.
+
 
     Recursors
     ---------
@@ -70,6 +88,10 @@ The following additional expressions are present:
         Greedy plus. (Not guaranteed to unbind variables!)
         Apply parser p one or more times. Return non-empty list of matches.
 
+    skip(p), count(p), span(p)
+        Greedy star without keeping the matches. Return Empty, the number
+        of matches or the (start, end) positions of the repetition.
+
 
     Grammars
     --------
@@ -85,9 +107,99 @@ The following additional expressions are present:
 
     Symbols use **late binding** so that in order to refer to a symbol
     the symbol itself does not need to be defined.
+
+    Rules may be left-recursive, e.g. g['e'] = g['e'] + item('+') + g['t']
+    Such rules are evaluated repeatedly, growing their results from a seed
+    until they stop consuming more input.
         
     g(data)
-        Applys g[starting_symbol] to the given data.
+        Applys g[starting_symbol] to the given data. Each call parses in
+        a Context of its own, which holds the rules in progress and the
+        Variable bindings, so one grammar serves nested, interleaved
+        and concurrent parses. See context.py.
+
+    g.parse(data), p.match(data, position)
+        The first parse by ordered choice (PEG semantics), returned as
+        a pair (result, next_position), or None if there is none. Plain
+        calls instead of generators: an alternative that succeeds commits,
+        sequences take the first result of each part, repetitions are
+        greedy. Where the grammar relies on backtracking into a part, the
+        result differs from the first result of g(data). Bindings of
+        Variables are not undone. Rules are matched uncompiled, packrat
+        caches live for one parse, left recursion grows from a failing
+        seed. Expressions of other packages default to the first result
+        of their generator.
+
+    g.compile(), p.compile()
+        Translates the rules of g (or expression p) into Python code which
+        yields the same results. See codegen.py.
+
+    g.optimize(), p.optimize()
+        Simplifies the rules of g (or expression p) by the laws above:
+        flattens alternatives and chains into n-ary nodes, drops zero
+        arms, merges items into Sets and shares identical subtrees.
+        See optimize.py.
+
+    g.intern(), p.intern()
+        Replaces structurally identical subtrees of the rules of g (or
+        expression p) by one node, shared across all interned grammars.
+        Expressions keep their fields in __slots__, without a __dict__.
+        See interning.py and slots.py.
+
+    g.predict()
+        Replaces wide alternatives p1 | p2 | ... in the rules of g by a
+        table lookup of the next element, trying only the alternatives
+        which can start with it. See prediction.py.
+
+    Grammar.cached(build)
+        Caches the grammar returned by build(), compiled code included,
+        on disk. Later processes load it instead of building it again.
+
+    g.parse_many(inputs, workers)
+        Parses independent inputs in a pool of processes. Grammars and
+        the expressions built by this package can be pickled.
+
+    g.Grammar(start_symbol, engine='vm')
+        Runs the grammar on a backtracking virtual machine instead of
+        nested generators. See vm.py.
+
+    g.Grammar(start_symbol, memo=Memo(size, policy))
+        Packrat mode. Caches the results of each rule per position and
+        input for the duration of a parse, of a Document across parses.
+        See memo.py for size limits and eviction policies.
+
+    g.Grammar(start_symbol, profile=True)
+        Records calls, results, backtracking and time per rule.
+        g.profile_report() tabulates them. See profiling.py.
+
+    g.feed_parser()
+        Push parser for input arriving in chunks: feed(chunk) returns
+        the messages completed so far, the parse suspends until the
+        next chunk when it runs out of input. See feed.py.
+
+    g.edit(document, offset, removed, inserted)
+        Edits a Document parsed before. The next parse recomputes only
+        the rule applications which examined the edited range.
+        See incremental.py.
+
+
+    Input
+    -----
+
+    Expressions parse any indexable value supporting len(). Stream(f)
+    reads files and iterators on demand; a cut lets it discard the input
+    before the position the cut committed to. See stream.py.
+
+    Range(low, high) is the Set of the characters or ints between low
+    and high. It keeps intervals instead of every element, as do unions,
+    intersections and differences with it; bytes and ASCII characters
+    are looked up in a table. See ranges.py.
+
+    bytearray and mmap inputs are parsed in place. On these, byte values
+    in Set, item and literal may be given as characters or ints, literals
+    compare slices, scans and Regex run the regular expression engine
+    over the buffer. capture(skip(p)) returns a Span whose view() is a
+    buffer over the input, so tokens are not copied either.
 
 
     Filters
@@ -129,14 +241,38 @@ The following additional expressions are present:
         
 """
 
-from instantiations import *
+import mmap
+import re
 
-class Expression(object):
+from instantiations import *
+from memo import Memo, MemoEntry
+from stream import Stream
+from incremental import Document
+from profiling import Profile
+from ranges import Ranges
+from context import Context, current
+from slots import Slotted
+
+class Expression(Slotted):
     """Base class for parsing expressions"""
+
+    __slots__ = ('_compiled', '__weakref__')
+
+    # True for expressions yielding at most one result with no side effects
+    # left to run after it, so that results may be collected in advance.
+    single = False
     
     def __call__(self, value, position):
         raise NotImplementedError
 
+    def match(self, value, position):
+        """First result by ordered choice: the pair (result, next_position)
+        or None if the expression fails. Expressions without a match of
+        their own take the first result of their generator."""
+        for result in self(value, position):
+            return result
+        return None
+
     def __add__(self, other):
         return chain(self, other)
 
@@ -160,15 +296,46 @@ class Expression(object):
         return cut(self)
 
     def __getattr__(self, item):
+        if item.startswith('_'):
+            # protocols probed by pickle and copy, unset private slots
+            raise AttributeError(item)
         from structure import Attribute
         return Attribute(self, item)
 
+    def __getstate__(self):
+        state = Slotted.__getstate__(self)
+        state.pop('_compiled', None)
+        return state
+
+    def compile(self):
+        """Translate into specialized Python code. The compiled expression
+        is cached and yields the same results as the interpreted one."""
+        compiled = getattr(self, '_compiled', None)
+        if compiled is None:
+            from codegen import compile_expression
+            compiled = self._compiled = compile_expression(self)
+        return compiled
+
+    def optimize(self):
+        """Equivalent expression simplified by the monad laws, see
+        optimize.py"""
+        from optimize import optimize
+        return optimize(self)
+
+    def intern(self):
+        """The expression with structurally identical subtrees shared,
+        see interning.py"""
+        from interning import intern
+        return intern(self)
+
 
 class Bind(Expression):
     """Resulting parser of the monadic bind operator.
     'expr' is the parser to which we bind the 'each' method for each result.
     'each' is expected to take the parsed result and return a new parser."""
 
+    __slots__ = ('expr', 'each')
+
     def __init__(self, expr, each):
         self.expr = expr
         self.each = each
@@ -178,30 +345,52 @@ class Bind(Expression):
             for r2, p2 in self.each(r1)(value, p1):
                 yield r2, p2
 
+    def match(self, value, position):
+        first = self.expr.match(value, position)
+        if first is None:
+            return None
+        return self.each(first[0]).match(value, first[1])
+
 
 class Return(Expression):
     """The returning element of the monad. Does not consume input,
     yields only the result"""
 
+    __slots__ = ('result',)
+
+    single = True
+
     def __init__(self, result):
         self.result = result
 
     def __call__(self, value, position):
         yield self.result, position
 
+    def match(self, value, position):
+        return self.result, position
+
 
 class Zero(Expression):
     """The monad's zero element. Signals parsing failure."""
-    
+
+    __slots__ = ()
+
+    single = True
+
     def __call__(self, value, position):
         return
         yield   # the "empty generator pattern"
+
+    def match(self, value, position):
+        return None
 zero = Zero()
 
 
 class Branch(Expression):
     """The monad's addition. Yields results from both given parsers."""
 
+    __slots__ = ('p', 'q')
+
     def __init__(self, p, q):
         self.p = p
         self.q = q
@@ -212,10 +401,114 @@ class Branch(Expression):
                                            self.q(value, position)):
             yield result, pos
 
+    def match(self, value, position):
+        result = self.p.match(value, position)
+        if result is None:
+            return self.q.match(value, position)
+        return result
+
+    def __reduce__(self):
+        # p1 | p2 | ... | pn nests n deep, pickle its arms as a list
+        arms, p = [], self
+        while type(p) is Branch:
+            arms.append(p.q)
+            p = p.p
+        arms.reverse()
+        return branches, (p, arms)
+
+
+def branches(p, arms):
+    """The chain p | arms[0] | arms[1] | ..., nested as | nests it"""
+    for arm in arms:
+        p = Branch(p, arm)
+    return p
+
+
+class Alternatives(Expression):
+    """Branch of any number of arms. Yields the results of each arm in
+    order, like p1 | p2 | ... without nested generators."""
+
+    __slots__ = ('arms',)
+
+    def __init__(self, arms):
+        self.arms = list(arms)
+
+    def __call__(self, value, position):
+        for arm in self.arms:
+            for result, pos in arm(value, position):
+                yield result, pos
+
+    def match(self, value, position):
+        for arm in self.arms:
+            result = arm.match(value, position)
+            if result is not None:
+                return result
+        return None
+
+
+class Sequence(Expression):
+    """Chain of any number of parts, built by p1 + p2 + ... + pn. Yields
+    the concatenated results of the parts for each combination of their
+    results, backtracking from the last part. Walks the parts with an
+    index instead of nested binds; leaves, which match at most once, are
+    matched by a call instead of a generator."""
+
+    __slots__ = ('parts', 'single', 'leaves')
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.single = all(part.single for part in self.parts)
+        self.leaves = [type(part) in leaves for part in self.parts]
+
+    def __call__(self, value, position):
+        parts, leaf = self.parts, self.leaves
+        last = len(parts) - 1
+        generators = [None] * len(parts)
+        results = [None] * len(parts)   # concatenated results so far
+        positions = [None] * len(parts)
+        index, fresh, start = 0, True, position
+        while index >= 0:
+            if leaf[index]:
+                found = parts[index].match(value, start) if fresh else None
+            else:
+                if fresh:
+                    generators[index] = iter(parts[index](value, start))
+                found = next(generators[index], None)
+            if found is None:
+                # backtrack into the previous part
+                generators[index] = None
+                index, fresh = index - 1, False
+                start = positions[index - 1] if index > 0 else position
+                continue
+            result, pos = found
+            if index:
+                result = concatenate(results[index - 1], result)
+            if index == last:
+                fresh = False
+                yield result, pos
+            else:
+                results[index], positions[index] = result, pos
+                index, fresh, start = index + 1, True, pos
+
+    def match(self, value, position):
+        parts = self.parts
+        first = parts[0].match(value, position)
+        if first is None:
+            return None
+        result, pos = first
+        for index in xrange(1, len(parts)):
+            part = parts[index].match(value, pos)
+            if part is None:
+                return None
+            result, pos = concatenate(result, part[0]), part[1]
+        return result, pos
+
 
 class Both(Expression):
     """Parse if both child-parsers parsed successfully at the same position"""
 
+    __slots__ = ('p', 'q')
+
     def __init__(self, p, q):
         self.p = p
         self.q = q
@@ -225,10 +518,17 @@ class Both(Expression):
             for r2, p2 in self.q(value, position):
                 yield r2, p2
 
+    def match(self, value, position):
+        if self.p.match(value, position) is None:
+            return None
+        return self.q.match(value, position)
+
 
 class Inside(Expression):
     """Re-Parse the result of the outer expression"""
 
+    __slots__ = ('outer', 'inner')
+
     def __init__(self, outer, inner):
         self.outer = outer
         self.inner = inner
@@ -238,62 +538,400 @@ class Inside(Expression):
             for inner_result, inner_pos in self.inner(outer_result, 0):
                     yield inner_result, outer_pos
 
+    def match(self, value, position):
+        outer = self.outer.match(value, position)
+        if outer is None:
+            return None
+        inner = self.inner.match(outer[0], 0)
+        if inner is None:
+            return None
+        return inner[0], outer[1]
+
 
 class Cut(Expression):
 
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         self.expr = expr
 
     def __call__(self, value, position):
         for result, pos in self.expr(value, position):
+            if isinstance(value, Stream):
+                value.commit(pos)
             yield result, pos
             break
 
+    def match(self, value, position):
+        result = self.expr.match(value, position)
+        if result is not None and isinstance(value, Stream):
+            value.commit(result[1])
+        return result
+
 cut = Cut
 
 
 
 class Element(Expression):
     """Parser for just the next element"""
-    
+
+    __slots__ = ()
+
+    single = True
+
     def __call__(self, value, position):
         if position < len(value):
             yield value[position], position + 1
+
+    def match(self, value, position):
+        if position < len(value):
+            return value[position], position + 1
+        return None
 element = Element() 
 
-        
+
+
+class Items(Expression):
+    """Alternatives item(e1) | item(e2) | ... of distinct elements, looked
+    up at once. Yields the input's element, as the alternatives would,
+    also where it is only equal to an item or, on binary input, another
+    spelling of the byte."""
+
+    __slots__ = ('elements', 'items', 'octets')
+
+    single = True
+
+    def __init__(self, elements):
+        self.elements = list(elements)
+        self.items = frozenset(self.elements)
+        octets = set()
+        for e in self.elements:
+            octets.update(byte_values([e]) or ())
+        self.octets = frozenset(octets) or None
+
+    def accepts(self, value, position):
+        """Whether one of the items matches at position"""
+        if position < len(value):
+            v = value[position]
+            try:
+                return v in self.items or self.octets is not None and \
+                    v in self.octets and is_binary(value)
+            except TypeError:
+                pass    # unhashable element
+        return False
+
+    def __call__(self, value, position):
+        if self.accepts(value, position):
+            yield value[position], position + 1
+
+    def match(self, value, position):
+        if self.accepts(value, position):
+            return value[position], position + 1
+        return None
+
+
+def concatenate(r1, r2):
+    """Result of chaining two parsers that returned r1 and r2"""
+    if r2 is Empty:
+        return r1
+    return r1 + r2 if hasattr(r1, '__add__') else r2
+
+
+# Inputs whose elements are bytes
+binary = (bytearray, mmap.mmap)
+
+def is_binary(value):
+    if isinstance(value, Span):
+        value = value.value
+    return isinstance(value, binary)
+
+def byte_values(choices):
+    """Both spellings, character and int, of byte valued choices.
+    None if some choice is not a byte."""
+    values = set()
+    for c in choices:
+        if isinstance(c, str) and len(c) == 1:
+            values.update((c, ord(c)))
+        elif type(c) in (int, long) and 0 <= c < 256:
+            values.update((c, chr(c)))
+        else:
+            return None
+    return frozenset(values)
+
+
+def unwrap(value, position):
+    """The input underlying value with position and end translated to it.
+    Lets string scanning see through Span views."""
+    if isinstance(value, Span):
+        return value.value, value.start + position, value.end
+    return value, position, len(value)
+
+
+class Capture(Expression):
+    """Yields the Span of input consumed by expr instead of its result"""
+
+    __slots__ = ('expr',)
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def __call__(self, value, position):
+        if isinstance(value, Span):
+            value, offset = value.value, value.start
+        else:
+            offset = 0
+        for result, pos in self.expr(value, position):
+            yield Span(value, offset + position, offset + pos), pos
+
+    def match(self, value, position):
+        if isinstance(value, Span):
+            value, offset = value.value, value.start
+        else:
+            offset = 0
+        result = self.expr.match(value, position)
+        if result is None:
+            return None
+        return Span(value, offset + position, offset + result[1]), result[1]
+
+capture = Capture
+
+
+class Literal(Expression):
+    """Parser for an exact sequence of elements, compared at once.
+    Yields the matched input, as chaining item(e) for each element would:
+    a single element as it is, more sliced from strings and binary input
+    and concatenated from the elements of other inputs."""
+
+    __slots__ = ('elements', 'text', 'octets')
+
+    single = True
+
+    def __init__(self, elements):
+        self.elements = list(elements)
+        if all(isinstance(e, basestring) and len(e) == 1 for e in self.elements):
+            self.text = ''.join(self.elements)
+        else:
+            self.text = None
+        if byte_values(self.elements) is not None:
+            self.octets = ''.join(e if isinstance(e, str) else chr(e)
+                                  for e in self.elements)
+        else:
+            self.octets = None
+
+    def fuse(self, other):
+        """The literal matching self followed by other"""
+        return Literal(self.elements + other.elements)
+
+    def matches(self, value, position):
+        end = position + len(self.elements)
+        if self.text is not None:
+            text, start, stop = unwrap(value, position)
+            if isinstance(text, Document):
+                return start + len(self.text) <= stop and \
+                    text[start:start + len(self.text)] == self.text
+            if isinstance(text, basestring):
+                if type(text) is type(self.text):
+                    return text.startswith(self.text, start, stop)
+                return start + len(self.text) <= stop and \
+                    text[start:start + len(self.text)] == self.text
+        if self.octets is not None:
+            data, start, stop = unwrap(value, position)
+            if isinstance(data, binary):
+                return start + len(self.octets) <= stop and \
+                    data[start:start + len(self.octets)] == self.octets
+        if isinstance(value, list):
+            return value[position:end] == self.elements
+        if end > len(value):
+            return False
+        for index, element in enumerate(self.elements):
+            if not value[position + index] == element:
+                return False
+        return True
+
+    def matched(self, value, position):
+        """The input matched at position"""
+        if len(self.elements) == 1:
+            return value[position]
+        data, start, stop = unwrap(value, position)
+        if not self.elements or isinstance(data, (basestring, Document) + binary):
+            return data[start:start + len(self.elements)]
+        return reduce(concatenate, [value[position + index]
+                                    for index in xrange(len(self.elements))])
+
+    def __call__(self, value, position):
+        if self.matches(value, position):
+            yield self.matched(value, position), position + len(self.elements)
+
+    def match(self, value, position):
+        if self.matches(value, position):
+            return self.matched(value, position), position + len(self.elements)
+        return None
+
+literal = Literal
+
+
+class Item(Literal):
+    """Literal of one element, compared with the next element directly.
+    Binary input is compared the way Literal compares it. Yields the
+    input's element."""
+
+    __slots__ = ('element',)
+
+    def __init__(self, element):
+        Literal.__init__(self, [element])
+        self.element = element
+
+    def __call__(self, value, position):
+        if position < len(value) and value[position] == self.element or \
+                self.octets is not None and is_binary(value) and \
+                self.matches(value, position):
+            yield value[position], position + 1
+
+    def match(self, value, position):
+        if position < len(value) and value[position] == self.element or \
+                self.octets is not None and is_binary(value) and \
+                self.matches(value, position):
+            return value[position], position + 1
+        return None
+
+
+class When(Expression):
+    """Parser for the next element if it satisfies the predicate"""
+
+    __slots__ = ('predicate',)
+
+    single = True
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __call__(self, value, position):
+        if position < len(value):
+            v = value[position]
+            if self.predicate(v):
+                yield v, position + 1
+
+    def match(self, value, position):
+        if position < len(value):
+            v = value[position]
+            if self.predicate(v):
+                return v, position + 1
+        return None
+
+
 def chain(p1, p2):
     """Apply both parsers in order, return the most recent result"""
     #return p1 ** (lambda result: p2)
-
-    return p1 ** (lambda r1:
-           p2 ** (lambda r2:
-           Return(r1 + r2) if hasattr(r1, '__add__') else Return(r2)))
+    if isinstance(p1, Literal) and isinstance(p2, Literal):
+        return p1.fuse(p2)
+    if type(p1) is Sequence:
+        # p1 + p2 + p3 extends the sequence instead of nesting it
+        parts = p1.parts[:-1]
+        last = p1.parts[-1]
+        if isinstance(last, Literal) and isinstance(p2, Literal):
+            return Sequence(parts + [last.fuse(p2)])
+        return Sequence(parts + [last, p2])
+    return Sequence([p1, p2])
 
 def when(predicate):
     """Parse an element when it satisfies the predicate"""
-    return element ** (lambda r: Return(r) if predicate(r) else zero)
+    return When(predicate)
 
 def item(c):
     """Parse an element matching exactly c"""
-    return when(lambda r: r == c)
+    return Item(c)
 
 def many(p):
     """Apply a parser zero or more times"""
-    return some(p) | Return([])
+    if scannable(p):
+        return Scan(p, 0, True)
+    return Many(p, 0)
 
 def some(p):
     """Apply a parser one or more times"""
-    return p ** (lambda a:
-                 many(p) ** (lambda aa:
-                             Return([a] + aa)))
+    if scannable(p):
+        return Scan(p, 1, True)
+    return Many(p, 1)
+
+
+def unwind(results):
+    """List of the elements of a linked (element, rest) list, oldest first"""
+    elements = []
+    while results is not None:
+        elements.append(results[0])
+        results = results[1]
+    elements.reverse()
+    return elements
+
+
+class Many(Expression):
+    """Non-greedy repetition of p, at least `least` times, backtracking
+    through all of p's results. Yields the same results in the same order
+    as the recursive definition
+
+        many(p) = some(p) | Return([])
+        some(p) = p ** (lambda a: many(p) ** (lambda aa: Return([a] + aa)))
+
+    but keeps the pending alternatives on an explicit stack and the matches
+    in a linked list, so long repetitions neither recurse nor copy lists.
+    Iterations of p that consume no input are not repeated."""
+
+    __slots__ = ('p', 'least')
+
+    def __init__(self, p, least=0):
+        self.p = p
+        self.least = least
+
+    def results(self, value, position):
+        if self.p.single:
+            return iter(list(self.p(value, position)))
+        return iter(self.p(value, position))
+
+    def __call__(self, value, position):
+        stack = [(self.results(value, position), None, position)]
+        while stack:
+            results, matches, pos = stack[-1]
+            for match, next_pos in results:
+                if next_pos != pos:
+                    stack.append((self.results(value, next_pos),
+                                  (match, matches), next_pos))
+                    break
+            else:
+                stack.pop()
+                if len(stack) >= self.least:
+                    yield unwind(matches), pos
+
+    def match(self, value, position):
+        # greedy like every repetition in match mode
+        matches, pos = [], position
+        while True:
+            result = self.p.match(value, pos)
+            if result is None or result[1] == pos:
+                break
+            matches.append(result[0])
+            pos = result[1]
+        if len(matches) < self.least:
+            return None
+        return matches, pos
 
 class Set(Expression):
     """Sets represent classes of acceptable items.
-    They optimize certain combinators by mapping them onto set arithmetics"""
+    They optimize certain combinators by mapping them onto set arithmetics.
+    Sets of bytes match bytearray and mmap elements by character or int."""
+
+    __slots__ = ('choices', 'octets', 'members')
+
+    single = True
 
     def __init__(self, choices):
+        if isinstance(choices, Ranges):
+            self.choices, self.octets = choices, choices.octets()
+            # classes within 0..255 are tested by their table alone
+            self.members = choices if choices.large else choices.table
+            return
         self.choices = choices if isinstance(choices, Set) else set(choices)
+        self.octets = None if isinstance(choices, Set) else byte_values(self.choices)
+        self.members = self.choices
 
     def __or__(self, other):
         if isinstance(other, Set):
@@ -319,71 +957,468 @@ class Set(Expression):
         else:
             raise TypeError("- only applies to Set expressions")
 
+    def accepts(self, element, value):
+        """Whether element of the input value is in the set"""
+        return element in self.members or self.octets is not None and \
+            element in self.octets and is_binary(value)
+
     def __call__(self, value, position):
         if position < len(value):
             v = value[position]
-            if v in self.choices:
+            if v in self.members or self.octets is not None and \
+                    v in self.octets and is_binary(value):
                 yield v, position + 1
 
+    def match(self, value, position):
+        if position < len(value):
+            v = value[position]
+            if v in self.members or self.octets is not None and \
+                    v in self.octets and is_binary(value):
+                return v, position + 1
+        return None
+
+
+def Range(low, high):
+    """Set of the characters or ints from low to high inclusive, kept as
+    intervals. Unions, intersections and differences with other ranges
+    stay intervals, see ranges.py."""
+    return Set(Ranges([(low, high)]))
+
+
+class Regex(Expression):
+    """Matches a regular expression at the current position of a string,
+    bytearray or mmap. Returns the matched text."""
+
+    __slots__ = ('regex',)
+
+    single = True
+
+    def __init__(self, pattern, flags=0):
+        self.regex = re.compile(pattern, flags)
+
+    def __call__(self, value, position):
+        text, start, stop = unwrap(value, position)
+        if not isinstance(text, (basestring,) + binary):
+            raise TypeError("Regex only applies to string or binary input")
+        match = self.regex.match(text, start, stop)
+        if match is not None:
+            yield match.group(), position + match.end() - start
+
+    def match(self, value, position):
+        text, start, stop = unwrap(value, position)
+        if not isinstance(text, (basestring,) + binary):
+            raise TypeError("Regex only applies to string or binary input")
+        match = self.regex.match(text, start, stop)
+        if match is None:
+            return None
+        return match.group(), position + match.end() - start
+
+
+def character_class(chars):
+    return re.compile('[%s]*' % ''.join(re.escape(c) for c in chars))
+
+
+class Scan(Expression):
+    """Repetition of a Set returning the list of matched elements. Strings
+    are scanned with a regular expression instead of element by element.
+
+    Scan(s, least) behaves like star(s) (least=0) or plus(s) (least=1),
+    Scan(s, least, every=True) like many(s) or some(s), yielding all
+    runs of at least `least` elements, longest first. The mode of greedy
+    scans is that of Repeat."""
+
+    __slots__ = ('choices', 'members', 'least', 'every', 'mode', 'single', 'patterns')
+
+    def __init__(self, choices, least=0, every=False, mode='list'):
+        self.choices = choices.choices
+        self.members = choices.members
+        self.least = least
+        self.every = every
+        self.mode = mode
+        self.single = not every
+        self.patterns = {}
+        if isinstance(self.choices, Ranges):
+            self.scan_ranges(self.choices)
+            return
+        chars = [c for c in self.choices
+                 if isinstance(c, basestring) and len(c) == 1]
+        if chars and len(chars) == len(self.choices):
+            if all(isinstance(c, str) for c in chars):
+                self.patterns[str] = character_class(chars)
+            if all(isinstance(c, unicode) or c < '\x80' for c in chars):
+                self.patterns[unicode] = character_class(map(unicode, chars))
+        octets = byte_values(self.choices)
+        if octets is not None:
+            pattern = character_class(sorted(c for c in octets if isinstance(c, str)))
+            for kind in binary:
+                self.patterns[kind] = pattern
+
+    def scan_ranges(self, ranges):
+        """Patterns of a Set of ranges, made of its intervals"""
+        if not ranges:
+            return
+        if ranges.chars:
+            self.patterns[unicode] = ranges.pattern(unichr)
+        if ranges.octets() is not None:
+            pattern = ranges.pattern(chr)
+            for kind in (str,) + binary if ranges.chars else binary:
+                self.patterns[kind] = pattern
+
+    def end(self, value, position):
+        """End of the longest run starting at position"""
+        text, start, stop = unwrap(value, position)
+        pattern = self.patterns.get(type(text))
+        if pattern is not None:
+            return position + pattern.match(text, start, stop).end() - start
+        end, members = position, self.members
+        while end < len(value) and value[end] in members:
+            end += 1
+        return end
+
+    def run(self, value, position, end):
+        if isinstance(value, (basestring, list, tuple) + binary):
+            return list(value[position:end])
+        return [value[i] for i in xrange(position, end)]
+
+    def __call__(self, value, position):
+        end = self.end(value, position)
+        stop = position + self.least
+        if not self.every:
+            if end >= stop:
+                run = self.run(value, position, end) if self.mode == 'list' else None
+                yield repetition(self.mode, run, end - position, position, end), end
+            return
+        run = self.run(value, position, end)
+        while end >= stop:
+            yield run[:end - position], end
+            end -= 1
+
+    def match(self, value, position):
+        end = self.end(value, position)
+        if end < position + self.least:
+            return None
+        if self.every:
+            return self.run(value, position, end), end
+        run = self.run(value, position, end) if self.mode == 'list' else None
+        return repetition(self.mode, run, end - position, position, end), end
+
+
+def scannable(p):
+    """Whether repetitions of p can be replaced by a Scan"""
+    return type(p) is Set and isinstance(p.choices, (set, frozenset, Ranges))
+
+
+class Activation(object):
+    """A rule application in progress. Holds the seed of a left-recursive
+    rule while it is being grown."""
+
+    __slots__ = ('seeds', 'left_recursive', 'pending')
+
+    def __init__(self):
+        self.seeds = []
+        self.left_recursive = False
+        self.pending = 0    # seeds handed out and still being extended
+
+    def replay(self):
+        """Answer a recursive call with the current seeds"""
+        for seed in self.seeds:
+            self.pending += 1
+            try:
+                yield seed
+            finally:
+                self.pending -= 1
+
+
+def furthest(results):
+    """Furthest position reached by a list of (result, position) pairs"""
+    return max([pos for result, pos in results] or [-1])
+
 
 class Reference(Expression):
-    """Lazy reference to a grammar rule. Detects infinite recursion."""
+    """Lazy reference to a grammar rule. Supports left recursion by growing
+    the rule's results from a seed (Warth et al.)."""
+
+    __slots__ = ('grammar', 'key')
 
     def __init__(self, grammar, key):
         self.grammar = grammar
         self.key = key
-        self._pos = 0
 
     def __call__(self, value, position):
-        self._pos = position
-        if not self.ensure_progress(position, len(value)):
-            print "Warning: Instantiation of rule '%s' may be infinite. Tracking back." % self.key
-            return
-        with self:
-            parse_rule = self.grammar.rules[self.key]
-            for result, next_pos in parse_rule(value, position):
-                yield result, next_pos
-
-    def ensure_progress(self, pos, size):
-        for prev_pos, rule in reversed(self.grammar.history):
-            if rule is self and pos == prev_pos and pos < size:
-                return False
-        return True
+        context = current()
+        if context is None:
+            # referenced outside of a grammar parse
+            return Context().parse(self, value, position)
+        if self.grammar.profile is not None:
+            return self.grammar.profile.measure(
+                self.key, self.results(value, position, context))
+        return self.results(value, position, context)
+
+    def match(self, value, position):
+        """First result of the rule by ordered choice. A left-recursive
+        rule first fails at its own position, then is matched again with
+        the recursive call answering the previous result, as long as that
+        reaches further (Warth et al.). With a memo, results are cached per
+        parse unless they were computed from a seed."""
+        context = current()
+        if context is None:
+            return Context().call(self.match, value, position)
+        grammar = self.grammar
+        key = id(grammar), self.key, position, id(value)
+        seeds = context.seeds
+        if key in seeds:
+            context.recursive.add(key)
+            context.recursions += 1
+            return seeds[key]
+        memo = grammar.memo is not None
+        if memo and key in context.matched:
+            return context.matched[key]
+        # results computed without any seed around are final
+        outermost, recursions = not seeds, context.recursions
+        seeds[key] = None
+        try:
+            if grammar.profile is not None:
+                result = grammar.profile.call(self.key, self.grow,
+                                              value, position)
+            else:
+                result = self.grow(value, position)
+        finally:
+            del seeds[key]
+            context.recursive.discard(key)
+        if memo and (outermost or context.recursions == recursions):
+            context.matched[key] = result
+        return result
+
+    def grow(self, value, position):
+        """Match the rule, again as long as a left-recursive rule reaches
+        further than its seed"""
+        context = current()
+        key = id(self.grammar), self.key, position, id(value)
+        rule = self.grammar.rules[self.key]
+        seeds = context.seeds
+        result = rule.match(value, position)
+        if key in context.recursive:
+            while result is not None and (seeds[key] is None or
+                                          result[1] > seeds[key][1]):
+                seeds[key] = result
+                result = rule.match(value, position)
+            result = seeds[key]
+        return result
+
+    def results(self, value, position, context):
+        grammar = self.grammar
+        frame = context.active.get((id(grammar), self.key, position, id(value)))
+        if frame is not None:
+            results = context.recurse(grammar, self.key, position, value, frame)
+        elif grammar.memo is None or context.is_growing(position, value):
+            results = self.apply(value, position, context)
+        else:
+            results = grammar.memo.lookup(self.key, position, value, context)
+            if results is None:
+                document = value if isinstance(value, Document) else None
+                results = grammar.memo.store(
+                    self.key, position, value,
+                    MemoEntry(self.apply(value, position, context), context,
+                              document, position))
+        for result, next_pos in results:
+            yield result, next_pos
 
-    def __enter__(self):
-        self.grammar.history.append((self._pos, self))
+    def apply(self, value, position, context):
+        """Parse the referenced rule without consulting the memo table.
+
+        If the rule turns out to be left-recursive, it is evaluated again
+        with the recursive call answering the results of the previous pass.
+        Only results new in the previous pass are handed out as seeds, as
+        the extensions of older ones are already known. Growing stops once
+        a pass does not reach further into the input.
+
+        The grown results are ordered as re-evaluating the whole rule would
+        order them: longest first if the recursive alternative precedes the
+        others, shortest first otherwise."""
+        grammar = self.grammar
+        rule = grammar.rule(self.key)
+        key = id(grammar), self.key, position, id(value)
+        frame = Activation()
+        base, emitted = [], []
+        for result in context.activate(key, frame, rule(value, position)):
+            base.append(result)
+            if not frame.left_recursive:
+                emitted.append(result)
+                yield result
+        if not frame.left_recursive:
+            return
+        grown, base_first = [], None
+        try:
+            frame.seeds, reach = base, furthest(base)
+            while frame.seeds:
+                new = []
+                for result in context.activate(key, frame, rule(value, position)):
+                    if base_first is None:
+                        base_first = not frame.pending
+                    if frame.pending:
+                        new.append(result)
+                if furthest(new) <= reach:
+                    break
+                grown.append(new)
+                frame.seeds, reach = new, furthest(new)
+        finally:
+            context.stop_growing(position, value)
+        if base_first:
+            results = base + sum(grown, [])
+        else:
+            results = sum(reversed(grown), []) + base
+        emitted = set(map(id, emitted))
+        for result in results:
+            if id(result) not in emitted:
+                yield result
 
-    def __exit__(self, *args):
-        self.grammar.history.pop()
-        self._pos = 0
 
 class Grammar(Expression):
     """Collection of named rules."""
 
-    def __init__(self, start):
-        """Instantiate grammar. start = name of the starting non-terminal"""
+    engines = ('generator', 'vm')
+
+    def __init__(self, start, memo=None, engine='generator', profile=False):
+        """Instantiate grammar. start = name of the starting non-terminal,
+        memo = optional Memo table enabling packrat parsing of rules,
+        engine = 'generator' or 'vm' (see vm.py),
+        profile = whether to record statistics per rule (see profiling.py)"""
+        if engine not in self.engines:
+            raise ValueError("Unknown engine '%s'" % engine)
         self.rules = {}
         self.start = start
-        self.history = []
+        self.memo = memo
+        self.compiled = {}
+        self.engine = engine
+        self.program = None
+        self.profile = Profile() if profile else None
 
     def __setitem__(self, key, value):
         """Define a non-terminal"""
         self.rules[key] = value
+        self.compiled.pop(key, None)
+        self.program = None
 
     def __getitem__(self, item):
         """Refer to a non-terminal. The resolution can be defined later (lazy)"""
         return Reference(self, item)
 
     def __call__(self, value, position=0):
-        """Instantiate grammar on a given collection"""
-        for result, next_pos in self.rules[self.start](value, position):
+        """Instantiate grammar on a given collection. Each call parses in
+        a Context of its own, see context.py."""
+        return Context(current()).parse(self.results, value, position)
+
+    def match(self, value, position):
+        """First result by ordered choice, see Expression.match. Parses
+        in a Context of its own."""
+        return Context(current()).call(self[self.start].match, value, position)
+
+    def parse(self, value, position=0):
+        """The pair (result, next_position) of the first parse by ordered
+        choice (PEG semantics), or None if there is none"""
+        return self.match(value, position)
+
+    def results(self, value, position):
+        if self.memo is not None:
+            self.memo.reset()
+        if self.engine == 'vm':
+            if self.program is None:
+                from vm import Program
+                self.program = Program.rules(self)
+            results = self.program.run(value, position)
+        else:
+            results = self.rule(self.start)(value, position)
+        if self.profile is not None:
+            results = self.profile.measure(self.start, results)
+        for result, next_pos in results:
             yield result, next_pos
 
+    def rule(self, key):
+        """The parser for a non-terminal, compiled if available"""
+        return self.compiled.get(key) or self.rules[key]
+
+    def compile(self):
+        """Translate all rules into specialized Python code. Subsequent
+        parses use the compiled rules. Redefining a rule drops its code."""
+        from codegen import compile_grammar
+        self.compiled = compile_grammar(self)
+        return self
+
+    def optimize(self):
+        """Simplify the rules by the monad laws, see optimize.py. Call
+        after all rules are defined, before predict() and compile()."""
+        from optimize import optimize_grammar
+        optimize_grammar(self)
+        return self
+
+    def intern(self):
+        """Share structurally identical subtrees of the rules between
+        each other and with other interned grammars, see interning.py"""
+        from interning import intern_grammar
+        intern_grammar(self)
+        return self
+
+    def predict(self):
+        """Dispatch wide alternatives on the FIRST sets of their arms.
+        Call after all rules are defined. Redefines the rules it changes,
+        which drops their compiled code."""
+        from prediction import predict_grammar
+        predict_grammar(self)
+        return self
+
+    def profile_report(self):
+        """Table of the statistics per rule, see profiling.py"""
+        if self.profile is None:
+            raise ValueError("Grammar is not profiled")
+        return self.profile.report()
+
+    @staticmethod
+    def cached(builder, directory=None, key=None):
+        """The grammar returned by builder(), cached on disk under a
+        fingerprint of the code building it. It is loaded, or built and
+        stored, on first use. See cache.py."""
+        from cache import cached
+        return cached(builder, directory, key)
+
+    def parse_many(self, iterable, workers=None, chunksize=1):
+        """Parse each input of iterable in a pool of worker processes.
+        Returns the list of (result, position) pairs of each input, in
+        order. workers=None uses all cores, workers=1 parses in this
+        process. See pool.py."""
+        from pool import parse_many
+        return parse_many(self, iterable, workers, chunksize)
+
+    def feed_parser(self):
+        """Push parser of a sequence of messages, each a parse of this
+        grammar, from input handed to it in chunks. See feed.py."""
+        from feed import FeedParser
+        return FeedParser(self)
+
+    def __getstate__(self):
+        """Pickle rules and compiled code. The VM program is rebuilt on
+        demand, memo entries are dropped by the memo."""
+        state = Expression.__getstate__(self)
+        state.update(program=None)
+        return state
+
+    def edit(self, document, offset, removed, inserted):
+        """Replace `removed` elements at offset of document by the inserted
+        text. The next parse of document reuses the memo entries the edit
+        does not affect. See incremental.py."""
+        if self.memo is not None:
+            # entries to be moved must be finished on the old text
+            self.memo.complete(document, offset + removed)
+        document.replace(offset, removed, inserted)
+        if self.memo is not None:
+            self.memo.edit(document, offset, removed, len(inserted))
+
 
 class Unify(Expression):
     """Pipes an expression's instantiation into a Unifiable instance.
     Returns the unified/transformed instantiation"""
 
+    __slots__ = ('expression', 'pattern')
+
     def __init__(self, expression, pattern):
         self.expression = expression
         self.pattern = pattern
@@ -392,46 +1427,129 @@ class Unify(Expression):
         for parse_result, p1 in self.expression(value, position):
             for unify_result in self.pattern.unify(parse_result):
                 yield unify_result, p1
+
+    def match(self, value, position):
+        result = self.expression.match(value, position)
+        if result is None:
+            return None
+        # the first unification stays in effect, bindings included
+        for unify_result in self.pattern.unify(result[0]):
+            return unify_result, result[1]
+        return None
                 
 
 class EndOfInput(Expression):
     """Matches end of input. Instantiates to an End instance or fails."""
 
+    __slots__ = ()
+
+    single = True
+
     def __call__(self, value, position):
         if position == len(value):
             yield End(position), position
 
+    def match(self, value, position):
+        if position == len(value):
+            return End(position), position
+        return None
+
+
+# Expressions whose match() is their only result, see Sequence
+leaves = frozenset([Element, Set, Literal, Item, Items, When, Return, Zero,
+                    Regex, EndOfInput])
+
 
 class Repeat(Expression):
     """Greedy repeated expression. Will only yield the (recursively) first match.
     WARNING: Will not unbind variables!
-    Call unbind() every time a variable has been bound inside a Repeat(...)"""
+    Call unbind() every time a variable has been bound inside a Repeat(...)
+
+    The mode selects what is returned:
+        'list'      the list of matches
+        'count'     the number of matches
+        'span'      the (start, end) positions of the repetition
+        'skip'      Empty, matches are not kept"""
 
-    def __init__(self, what, once=True):
+    __slots__ = ('what', 'once', 'mode')
+
+    single = True
+    modes = ('list', 'count', 'span', 'skip')
+
+    def __init__(self, what, once=True, mode='list'):
+        if mode not in self.modes:
+            raise ValueError("Unknown repeat mode '%s'" % mode)
         self.what = what
         self.once = once
+        self.mode = mode
 
     def __call__(self, value, position):
-        result, next_pos = [], position
+        collect = self.mode == 'list'
+        result, count, next_pos = [], 0, position
         generator = None
         try:
             while True:
                 generator = self.what(value, next_pos)
                 next_result, next_pos = generator.next()
-                result.append(next_result)
-                next_before = result
+                if collect:
+                    result.append(next_result)
+                count += 1
                 generator.close()
         except StopIteration:
-            if not self.once or result:
-                yield result, next_pos
+            if not self.once or count:
+                yield repetition(self.mode, result, count, position, next_pos), next_pos
         finally:
             if generator:
                 generator.close()
 
+    def match(self, value, position):
+        matches, count, pos = [], 0, position
+        collect = self.mode == 'list'
+        while True:
+            result = self.what.match(value, pos)
+            if result is None or result[1] == pos:
+                break
+            if collect:
+                matches.append(result[0])
+            count += 1
+            pos = result[1]
+        if self.once and not count:
+            return None
+        return repetition(self.mode, matches, count, position, pos), pos
+
+
+def repetition(mode, matches, count, start, end):
+    """Result of a repetition in the given mode"""
+    if mode == 'list':
+        return matches
+    if mode == 'count':
+        return count
+    if mode == 'span':
+        return start, end
+    return Empty
+
+
+def repeat(p, once, mode='list'):
+    if scannable(p):
+        return Scan(p, 1 if once else 0, mode=mode)
+    return Repeat(p, once, mode)
+
 def star(p):
     """Greedy star"""
-    return Repeat(p, False)
+    return repeat(p, False)
 
 def plus(p):
     """Greedy plus"""
-    return Repeat(p, True)
+    return repeat(p, True)
+
+def skip(p):
+    """Greedy star returning Empty instead of the matches"""
+    return repeat(p, False, 'skip')
+
+def count(p):
+    """Greedy star returning the number of matches"""
+    return repeat(p, False, 'count')
+
+def span(p):
+    """Greedy star returning its (start, end) positions"""
+    return repeat(p, False, 'span')
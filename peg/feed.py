@@ -0,0 +1,218 @@
+"""
+Push parsing of input arriving in chunks, e.g. from a socket.
+
+A FeedParser parses a sequence of messages, each one a complete parse
+of the grammar, from chunks handed to feed(). The parse runs as far as
+the data allows and suspends when it needs more; the next feed()
+resumes it where it stopped, so messages are neither buffered
+separately nor parsed twice while data arrives.
+
+    parser = g.feed_parser()
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        for message in parser.feed(data):
+            handle(message)
+    for message in parser.close():
+        handle(message)
+
+Each message is the first result of g at the position where the
+previous message ended. It is handed out as soon as the grammar decided
+it. Until close(), the end of the input is unknown: the input appears
+to go on, so reads wait for the next chunk and EndOfInput does not match.
+A message the input ends in is parsed again after close() with the end
+known. Input before the end of a message is dropped from the buffer, so
+long streams parse in bounded memory. A Span result is unpacked before
+its input is dropped; results must not hold spans otherwise.
+
+feed() and close() raise ValueError when the input has no parse at the
+start of a message, and pass on exceptions raised by the grammar. The
+parser cannot be used afterwards.
+
+The suspended parse is kept by a worker thread, which runs only while
+feed() or close() waits for it. There is no asyncio in Python 2; feed()
+returns as soon as the parser waits for input, so it may be called from
+the callbacks of any event loop.
+
+A parser given up before close(), e.g. when the connection drops, still
+holds its thread and buffer: abort() ends the parse without results and
+releases both. Used in a with statement, the parser is aborted on leaving
+it unless it was closed:
+
+    with g.feed_parser() as parser:
+        for data in chunks:
+            handle_all(parser.feed(data))
+        handle_all(parser.close())
+"""
+
+import sys
+import threading
+from Queue import Queue
+
+from stream import Stream
+from instantiations import Span
+
+
+# Events from the worker
+WAITING, RESULT, DONE, ERROR = range(4)
+
+# Marks the end of the input
+CLOSED = object()
+
+# Stops the parse
+ABORTED = object()
+
+
+class EndOfFeed(Exception):
+    """Raised when a parse reads past the input after the feed closed"""
+
+
+class Aborted(Exception):
+    """Raised in the worker to end a parse given up by abort()"""
+
+
+class FeedStream(Stream):
+    """Stream whose reads wait for the next chunk to be fed. Until the
+    feed is closed, its length is unknown and reported as infinite: any
+    position may still come. Reading a position past the input after
+    closing raises EndOfFeed."""
+
+    def fill(self, end):
+        while self.offset + len(self.buffer or ()) < end and not self.done:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.done = True
+                return
+            if self.buffer is None:
+                self.buffer = chunk[:0] if isinstance(chunk, basestring) else []
+            if isinstance(self.buffer, basestring):
+                self.buffer += chunk
+            else:
+                self.buffer.extend(chunk)
+
+    def available(self):
+        return self.offset + len(self.buffer or ())
+
+    def __len__(self):
+        if not self.done:
+            return sys.maxint
+        return self.available()
+
+    def __getitem__(self, position):
+        stop = position.stop if isinstance(position, slice) else position + 1
+        if stop is not None:
+            self.fill(stop)
+            if stop > self.available():
+                raise EndOfFeed()
+        return Stream.__getitem__(self, position)
+
+
+class FeedParser(object):
+    """Parser of messages fed in chunks, see the module documentation"""
+
+    def __init__(self, parser, chunk=4096):
+        self.parser = parser
+        self.chunks = Queue()
+        self.events = Queue()
+        self.stream = FeedStream(self.receive(), chunk)
+        self.worker = None
+        self.finished = False
+
+    def receive(self):
+        """Chunks as they are fed. Asking for one beyond the first tells
+        the feeding side the parser waits."""
+        first = True
+        while True:
+            if not first:
+                self.events.put((WAITING, None))
+            first = False
+            chunk = self.chunks.get()
+            if chunk is CLOSED:
+                return
+            if chunk is ABORTED:
+                raise Aborted()
+            yield chunk
+
+    def run(self):
+        """Worker: parse messages until the input ends"""
+        stream, position = self.stream, 0
+        try:
+            while position < len(stream):
+                try:
+                    for result, pos in self.parser(stream, position):
+                        break
+                    else:
+                        raise ValueError("No parse at position %d" % position)
+                except EndOfFeed:
+                    # the input ended within the message, parse it again
+                    # knowing the end; entries cached meanwhile are cut short
+                    memo = getattr(self.parser, 'memo', None)
+                    if memo is not None:
+                        memo.clear()
+                    continue
+                if pos == position:
+                    raise ValueError("Empty message at position %d" % position)
+                if isinstance(result, Span):
+                    result = result.unpack()
+                self.events.put((RESULT, result))
+                stream.commit(pos)
+                position = pos
+        except Exception as error:
+            self.events.put((ERROR, error))
+        else:
+            self.events.put((DONE, None))
+
+    def resume(self, chunk):
+        """Hand chunk to the parse, returns the messages completed
+        until it waits again or ends"""
+        if self.finished:
+            raise ValueError("Parser is closed")
+        self.chunks.put(chunk)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run)
+            self.worker.daemon = True
+            self.worker.start()
+        results = []
+        while True:
+            event, value = self.events.get()
+            if event == RESULT:
+                results.append(value)
+            elif event == WAITING:
+                return results
+            else:
+                self.finished = True
+                self.worker.join()
+                if event == ERROR:
+                    raise value
+                return results
+
+    def feed(self, chunk):
+        """Parse chunk, returns the list of messages it completed"""
+        if not chunk:
+            return []
+        return self.resume(chunk)
+
+    def close(self):
+        """End the input, returns the list of the remaining messages"""
+        return self.resume(CLOSED)
+
+    def abort(self):
+        """Give up the parse: stop the worker and drop the buffer. Does
+        nothing once the parser is closed."""
+        if self.finished:
+            return
+        self.finished = True
+        if self.worker is not None:
+            self.chunks.put(ABORTED)
+            while self.events.get()[0] not in (DONE, ERROR):
+                pass
+            self.worker.join()
+        self.stream.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, trace):
+        self.abort()
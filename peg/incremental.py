@@ -0,0 +1,85 @@
+"""
+Incremental reparsing of edited documents.
+
+A Document is an editable string input that records how far parsers
+examine it. Memoized rule applications remember the furthest position
+they examined, so after an edit a grammar only has to recompute the
+applications that looked at the edited range:
+
+    doc = Document(text)
+    g = Grammar('start', memo=Memo())
+    g(doc)
+    g.edit(doc, offset, removed, inserted)
+    g(doc)                          # reuses the unaffected applications
+
+Applications which examined only input before the edit are kept as they
+are. Applications starting behind the edited range are moved by the
+change in length; their remaining results are enumerated before the
+text changes. Spans over the document, End markers and lists of them
+are moved along; other results computed from positions, like those of
+span() or Make on captures, are reused unchanged.
+
+The memo moves applications lazily, when a parse reuses them, so an edit
+does work for the applications that examined the edited range and those
+still in progress, not for the whole document. See memo.py.
+
+Examined positions are the elements read and, if the rule asked for
+len(), the position behind them: parsers reach positions by reading the
+elements before, so that is where they compare against the end. Parsers
+inspecting the input in other ways, like Regex, do not apply. Reuse
+needs a memo table with the 'lru' policy, as the 'parse' policy clears
+the table before each parse.
+"""
+
+
+class Document(object):
+    """Editable string input tracking the furthest position examined"""
+
+    def __init__(self, text):
+        self.text = text
+        self.read = -1      # furthest position read by the current rule
+        self.reach = -1     # furthest position it examined
+
+    def replace(self, offset, removed, inserted):
+        """Replace the `removed` elements at offset by the inserted text"""
+        if not 0 <= offset <= offset + removed <= len(self.text):
+            raise IndexError("edit outside of the document")
+        self.text = self.text[:offset] + inserted + self.text[offset + removed:]
+
+    def track(self, entry, advance):
+        """Call advance() and add the positions it examines to entry"""
+        outer = self.read, self.reach
+        self.read = self.reach = entry.position - 1
+        try:
+            return advance()
+        finally:
+            entry.read = max(entry.read, self.read)
+            entry.reach = max(entry.reach, self.reach)
+            self.read = max(outer[0], entry.read)
+            self.reach = max(outer[1], entry.reach)
+
+    def examined(self, entry):
+        """Note that the current rule depends on what entry examined"""
+        self.read = max(self.read, entry.read)
+        self.reach = max(self.reach, entry.reach)
+
+    def __len__(self):
+        self.reach = max(self.reach, self.read + 1)
+        return len(self.text)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            last = (len(self.text) if index.stop is None else index.stop) - 1
+        else:
+            last = index
+        if last > self.read:
+            self.read = last
+            if last > self.reach:
+                self.reach = last
+        return self.text[index]
+
+    def __str__(self):
+        return str(self.text)
+
+    def __repr__(self):
+        return "<Document %r>" % self.text
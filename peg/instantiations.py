@@ -1,6 +1,12 @@
-class Unifiable(object):
+from context import current
+from slots import Slotted
+
+
+class Unifiable(Slotted):
     """Base class for matching parser results"""
 
+    __slots__ = ()
+
     @staticmethod
     def lift(value):
         if isinstance(value, Unifiable):
@@ -15,22 +21,35 @@ class Unifiable(object):
 class Any(Unifiable):
     """Accept any parse result"""
 
+    __slots__ = ()
+
     def unify(self, value):
         yield value
+
+    def __reduce__(self):
+        # unpickle as the singleton
+        return 'Any'
 Any = Any()
 
 
 class Nothing(Unifiable):
     """Reject any parse result"""
 
+    __slots__ = ()
+
     def unify(self, value):
         pass
+
+    def __reduce__(self):
+        return 'Nothing'
 Nothing = Nothing()
 
 
 class InstantiatedExpression(Unifiable):
     """Base class for instantiated expressions"""
 
+    __slots__ = ()
+
     def unpack(self):
         """Expose the underlying value to be passed to a secondary parser"""
         raise NotImplemented
@@ -48,6 +67,8 @@ class InstantiatedExpression(Unifiable):
 class Empty(InstantiatedExpression):
     """The empty instantiation which signals success but no value"""
 
+    __slots__ = ()
+
     def combined_with(self, other):
         return other
 
@@ -63,12 +84,17 @@ class Empty(InstantiatedExpression):
     def combined_with_item(self, other):
         return other
 
+    def __reduce__(self):
+        return 'Empty'
+
 Empty = Empty()
 
 
 class End(InstantiatedExpression):
     """Signals end of input"""
 
+    __slots__ = ('pos',)
+
     def __init__(self, pos):
         self.pos = pos
 
@@ -89,8 +115,83 @@ class End(InstantiatedExpression):
         return None
 
 
+class Span(InstantiatedExpression):
+    """View of value[start:end] which copies only when unpacked.
+    Spans support len(), indexing and slicing, so they can be parsed
+    again without materializing them. Adjacent spans concatenate to a
+    span over both."""
+
+    __slots__ = ('value', 'start', 'end')
+
+    def __init__(self, value, start, end):
+        self.value = value
+        self.start = start
+        self.end = end
+
+    def unpack(self):
+        return self.value[self.start:self.end]
+
+    def view(self):
+        """memoryview of the span if the input supports the buffer
+        protocol, a read-only buffer for old-style buffers like mmap,
+        the span itself otherwise"""
+        try:
+            return memoryview(self.value)[self.start:self.end]
+        except TypeError:
+            pass
+        try:
+            return buffer(self.value, self.start, len(self))
+        except TypeError:
+            return self
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.unpack()[index]
+            return Span(self.value, self.start + start,
+                        self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("span index out of range")
+        return self.value[self.start + index]
+
+    def __add__(self, other):
+        if isinstance(other, Span):
+            if other.value is self.value and other.start == self.end:
+                return Span(self.value, self.start, other.end)
+            other = other.unpack()
+        return self.unpack() + other
+
+    def __radd__(self, other):
+        return other + self.unpack()
+
+    def __eq__(self, other):
+        if isinstance(other, Span):
+            other = other.unpack()
+        return self.unpack() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.unpack())
+
+    def __str__(self):
+        return str(self.unpack())
+
+    def __repr__(self):
+        return "<Span %s:%s %r>" % (self.start, self.end, self.unpack())
+
+
 class Constant(Unifiable):
 
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -105,35 +206,69 @@ class Constant(Unifiable):
         return self.value
 
 
+UNBOUND = False, None
+
+
 class Variable(Unifiable):
-    """Captures the matched value. Matches only the captured value again."""
+    """Captures the matched value. Matches only the captured value again.
+
+    During a grammar parse the binding belongs to the parse's Context, so
+    concurrent parses do not see each other's bindings. Bindings made
+    outside of parses apply to all parses. The variable also shows the
+    latest binding between parses and results, for inspection."""
+
+    __slots__ = ('outside', 'latest')
 
     @classmethod
     def list(cls, n):
         return [cls() for i in xrange(n)]
 
     def __init__(self):
-        self.bound = False
-        self.value = None
+        self.outside = UNBOUND  # binding made outside of parses
+        self.latest = UNBOUND   # latest binding made anywhere
+
+    def binding(self):
+        """(bound, value) as seen by the current parse"""
+        context = current()
+        if context is None:
+            return self.latest
+        return context.bindings.get(self, self.outside)
+
+    @property
+    def bound(self):
+        return self.binding()[0]
+
+    @property
+    def value(self):
+        return self.binding()[1]
+
+    def rebind(self, binding):
+        context = current()
+        if context is None:
+            self.outside = binding
+        elif binding[0]:
+            context.bindings[self] = binding
+        else:
+            context.bindings.pop(self, None)
+        self.latest = binding
 
     def bind_to(self, value):
-        self.value = value
-        self.bound = True
+        self.rebind((True, value))
 
     def unbind(self):
-        self.value = None
-        self.bound = False
+        self.rebind(UNBOUND)
 
     def unify(self, value):
-        if self.bound:
-            if isinstance(self.value, Unifiable):
-                for unified in self.value.unify(value):
+        bound, bound_value = self.binding()
+        if bound:
+            if isinstance(bound_value, Unifiable):
+                for unified in bound_value.unify(value):
                     yield unified
             elif isinstance(value, Unifiable):
                 for unified in value.unify(self):
                     yield unified
             else:
-                if self.value == value:
+                if bound_value == value:
                     yield value
         else:
             self.bind_to(value)
@@ -153,6 +288,8 @@ class Variable(Unifiable):
 class Result(InstantiatedExpression):
     """Instantiation wrapper with a label attached"""
 
+    __slots__ = ('result', 'label')
+
     def __init__(self, result, label):
         self.result = result
         self.label = label
@@ -171,6 +308,8 @@ class Label(Unifiable):
     """Labels the current instantiation.
     Example:  Item(x) >> Label('x') """
 
+    __slots__ = ('label',)
+
     def __init__(self, label):
         self.label = label
 
@@ -188,6 +327,8 @@ class Make(Unifiable):
     
     MyClass(foo=f.value, bar=b.value)
     """
+
+    __slots__ = ('factory', 'direct', 'args')
     
     def __init__(self, factory, **kwargs):
         self.factory = factory
@@ -199,6 +340,8 @@ class Make(Unifiable):
 
     def unify(self, value):
         if self.direct:
+            if isinstance(value, Span):
+                value = value.unpack()
             yield self.factory(value)
         else:
             kwargs = {}
@@ -0,0 +1,165 @@
+"""
+Hash-consing of expressions.
+
+intern(p) returns p with structurally identical subtrees replaced by a
+single node: the same item('x') or Set used in 200 places of a grammar
+becomes one node, shared by all grammars interned in the process. Nodes
+are compared bottom-up by their type, their fields and the identity of
+their (interned) children, so interning a tree costs one dictionary
+lookup per node.
+
+    p = p.intern()
+    g.intern()                      # rewrite all rules of grammar g
+
+The table of interned nodes holds them weakly: nodes no grammar uses any
+more are dropped. Rule references, expressions of other packages and
+nodes with unhashable fields are kept as they are. Interning does not
+change results; compiled code of a shared node is shared as well.
+g.optimize() interns the nodes it rewrites.
+"""
+
+import copy
+import threading
+import weakref
+
+from expressions import *
+from structure import Attribute, Get, At, TypeOf, MatchType
+
+
+# Child expressions by node type, rewritten in place of copies
+children = {
+    Bind: ('expr',), Branch: ('p', 'q'), Both: ('p', 'q'),
+    Inside: ('outer', 'inner'), Cut: ('expr',), Capture: ('expr',),
+    Unify: ('expression',), Repeat: ('what',), Many: ('p',),
+    Attribute: ('parser',),
+}
+
+# Child lists by node type
+lists = {Alternatives: 'arms', Sequence: 'parts', MatchType: 'parsers'}
+
+
+def rebuilt(p, nodes):
+    """Node like p with the child list nodes"""
+    if type(p) is MatchType:
+        return MatchType(zip(p.types, nodes))
+    return type(p)(nodes)
+
+
+def arms_of(p):
+    """The arms of a chain of Branches and Alternatives, in order"""
+    if type(p) is Branch:
+        return arms_of(p.p) + arms_of(p.q)
+    if type(p) is Alternatives:
+        return sum([arms_of(arm) for arm in p.arms], [])
+    return [p]
+
+
+# structural key -> interned node
+table = weakref.WeakValueDictionary()
+lock = threading.Lock()
+
+
+def structure(p):
+    """Hashable description of p's structure, None if p is not shared"""
+    kind = type(p)
+    if kind in (Element, Zero, EndOfInput):
+        return kind,
+    if kind is Set:
+        if isinstance(p.choices, Ranges):
+            return kind, p.choices.chars, p.choices.unicode, \
+                tuple(p.choices.lows), tuple(p.choices.highs)
+        # equal elements of other types match differently, e.g. on binary
+        return kind, frozenset((type(c), c) for c in p.choices), p.octets
+    if kind in (Literal, Item, Items):
+        return kind, tuple(type(e) for e in p.elements), tuple(p.elements)
+    if kind is When:
+        return kind, p.predicate
+    if kind is Get:
+        return kind, p.name
+    if kind is At:
+        return kind, type(p.index), p.index
+    if kind is TypeOf:
+        return kind, p.atype
+    if kind is Return:
+        return kind, type(p.result), p.result
+    if kind is MatchType:
+        return (kind, tuple(p.types)) + tuple(map(id, p.parsers))
+    if kind in lists:
+        return (kind,) + tuple(map(id, getattr(p, lists[kind])))
+    if kind in children:
+        fields = children[kind]
+        rest = tuple(sorted((name, value) for name, value in p.__getstate__().items()
+                            if name not in fields))
+        return (kind, rest) + tuple(id(getattr(p, field)) for field in fields)
+    return None
+
+
+class Interner(object):
+    """Rewrites expressions bottom-up, sharing the results between calls"""
+
+    def __init__(self):
+        self.rewritten = {}     # id(node) -> (node, rewritten node)
+
+    def __call__(self, p):
+        done = self.rewritten.get(id(p))
+        if done is not None:
+            return done[1]
+        result = self.share(self.rewrite(p))
+        # keep p alive while its id is in use
+        self.rewritten[id(p)] = p, result
+        return result
+
+    def rewrite(self, p):
+        kind = type(p)
+        if kind in lists:
+            nodes = getattr(p, lists[kind])
+            new = [self(node) for node in nodes]
+            if any(a is not b for a, b in zip(new, nodes)):
+                return rebuilt(p, new)
+            return p
+        changed = self.changes(p)
+        if not changed:
+            return p
+        return self.copy(p, **changed)
+
+    def changes(self, p):
+        """The rewritten children of p which differ, by field"""
+        changed = {}
+        for field in children.get(type(p), ()):
+            child = getattr(p, field)
+            new = self(child)
+            if new is not child:
+                changed[field] = new
+        return changed
+
+    def copy(self, node, **fields):
+        result = copy.copy(node)
+        for name, value in fields.items():
+            setattr(result, name, value)
+        return result
+
+    def share(self, p):
+        """The node structurally identical to p interned before, or p"""
+        try:
+            key = structure(p)
+            hash(key)
+        except TypeError:
+            return p
+        if key is None:
+            return p
+        with lock:
+            return table.setdefault(key, p)
+
+
+def intern(p):
+    """p with structurally identical subtrees shared"""
+    return Interner()(p)
+
+
+def intern_grammar(grammar):
+    """Rewrite the rules of grammar in place"""
+    interner = Interner()
+    for key, rule in grammar.rules.items():
+        new = interner(rule)
+        if new is not rule:
+            grammar[key] = new
@@ -0,0 +1,375 @@
+"""
+Packrat memoization for grammar rules.
+
+A Memo caches the results of applying a rule at a position of an input.
+Results are cached as a stream: the underlying generator is advanced only
+as far as some consumer asked for, so lazy and infinite result sequences
+stay lazy. Any later consumer replays the results seen so far and then
+continues to pull from the shared generator.
+
+    g = Grammar('expr', memo=Memo(size=10000))
+    ...
+    g.memo.hits, g.memo.misses, g.memo.evictions
+
+Eviction policies:
+
+    'lru'       keep at most `size` entries, dropping the least recently
+                used one when the table is full.
+
+    'parse'     keep at most `size` entries per parse. Once the table is
+                full, further rule applications are simply not cached.
+
+Whenever the grammar starts a new parse, the entries of earlier parses
+are dropped, so the table holds on to no input but those being parsed.
+Under the 'lru' policy, entries on a Document are kept for the next
+parse: entries on a Document also record the furthest position their rule
+examined, which lets edit() keep the entries an edit does not affect.
+See incremental.py. Without a size, the entries of Documents accumulate
+until they are edited away or the table is cleared.
+
+The entries on a Document are kept by position in a list of columns,
+which edit() splices like the text, so the entries behind an edit move
+along without being visited. Their results are moved by the change in
+length once a parse looks them up again. An edit only visits the columns
+shortly before it, entries which examined more than `window` positions
+and entries still in progress: those are the candidates for having
+examined the edited range.
+
+Entries belong to the context of the parse which created them (see
+context.py) and their generators advance with it as the current context.
+A parse reuses the entries of other parses once they are complete or
+the parse that created them finished; it computes and stores an entry of
+its own in place of one still in progress elsewhere. So parses in
+several threads may share one table.
+
+Memoization assumes rules are pure functions of (input, position). Rules
+whose results depend on previously bound Variables should not be cached.
+Entries are keyed by the identity of the input: changing a list or
+bytearray in place while a parse of it runs, or a Document other than by
+the grammar's edit(), leaves entries computed from the old contents.
+"""
+
+import threading
+from collections import OrderedDict
+
+from incremental import Document
+from instantiations import End, Result, Span
+
+
+class MemoEntry(object):
+    """Result stream of one rule application, materialized on demand,
+    computed in the context of the parse which created it. With a
+    document, the positions the rule examines are tracked."""
+
+    def __init__(self, generator, context=None, document=None, position=0):
+        self.results = []
+        self.generator = generator
+        self.context = context
+        self.document = document
+        self.position = position
+        self.read = self.reach = position - 1
+        self.key = self.column = None
+
+    def advance(self, index):
+        """Compute the result at index, unless another consumer did.
+        Returns False once there are no more results."""
+        if index < len(self.results):
+            return True
+        if self.generator is None:
+            return False
+        try:
+            if self.document is None:
+                result = next(self.generator)
+            else:
+                result = self.document.track(
+                    self, lambda: next(self.generator))
+        except StopIteration:
+            self.generator = None
+            return False
+        self.results.append(result)
+        return True
+
+    def usable(self, context):
+        """Whether a parse in context may consume this entry"""
+        return self.generator is None or self.context is context or \
+            self.context.finished
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if self.document is not None:
+                # replayed results depend on what the rule examined
+                self.document.examined(self)
+            if index < len(self.results):
+                yield self.results[index]
+                index += 1
+            elif self.generator is None or \
+                    not self.context.resume(lambda: self.advance(index)):
+                return
+
+    def shifted(self, value, delta):
+        """Complete entry with all positions moved by delta"""
+        entry = MemoEntry(None, None, self.document, self.position + delta)
+        entry.results = [(shifted(result, value, delta), pos + delta)
+                         for result, pos in self.results]
+        entry.read = self.read + delta
+        entry.reach = self.reach + delta
+        entry.key, entry.column = self.key, self.column
+        return entry
+
+    def examines(self, start, offset):
+        """Whether the rule, applied at start, examined position offset
+        or beyond"""
+        return start + self.reach - self.position >= offset
+
+
+def shifted(result, value, delta):
+    """result with the positions in value it refers to moved by delta"""
+    if isinstance(result, Span) and result.value is value:
+        return Span(value, result.start + delta, result.end + delta)
+    if isinstance(result, End):
+        return End(result.pos + delta)
+    if isinstance(result, Result):
+        return Result(shifted(result.result, value, delta), result.label)
+    if isinstance(result, list):
+        return [shifted(r, value, delta) for r in result]
+    return result
+
+
+class Columns(object):
+    """The entries on one Document: a column of {rule: entry} for each
+    position, entries in progress and entries examining far ahead with
+    the position they start at"""
+
+    def __init__(self):
+        self.columns = []
+        self.pending = set()
+        self.long = {}
+
+    def at(self, position):
+        """The column at position, created on demand"""
+        columns = self.columns
+        if position >= len(columns):
+            columns.extend([None] * (position + 1 - len(columns)))
+        column = columns[position]
+        if column is None:
+            column = columns[position] = {}
+        return column
+
+    def get(self, position):
+        if position < len(self.columns):
+            return self.columns[position]
+        return None
+
+
+class Memo(object):
+    """Memo table mapping (rule, position, input) to cached result streams"""
+
+    policies = ('lru', 'parse')
+
+    # entries on a Document examining fewer positions are found from the
+    # columns before an edit, the others are listed separately
+    window = 32
+
+    def __init__(self, size=None, policy='lru'):
+        if policy not in self.policies:
+            raise ValueError("Unknown memo policy '%s'" % policy)
+        self.size = size
+        self.policy = policy
+        self.table = OrderedDict()
+        self.inputs = {}
+        self.documents = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.table)
+
+    def key(self, rule, position, value, create=False):
+        """Table key of a rule application. Entries on Documents are keyed
+        by their column, which moves along with edits."""
+        if not isinstance(value, Document):
+            return rule, position, id(value)
+        columns = self.documents.get(id(value))
+        if columns is None:
+            if not create:
+                return None
+            columns = self.documents[id(value)] = Columns()
+        column = columns.at(position) if create else columns.get(position)
+        if column is None:
+            return None
+        return rule, id(column), id(value)
+
+    def lookup(self, rule, position, value, context):
+        """Return the cached entry or None, counting hits and misses.
+        Entries still in progress in another parse count as misses."""
+        with self.lock:
+            key = self.key(rule, position, value)
+            entry = self.table.get(key)
+            if entry is not None and not entry.usable(context):
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if entry.position != position:
+                # moved by edits since it was computed
+                entry = self.moved(key, entry, value, position)
+            if self.policy == 'lru':
+                del self.table[key]
+                self.table[key] = entry
+            return entry
+
+    def moved(self, key, entry, value, position):
+        moved = entry.shifted(value, position - entry.position)
+        self.table[key] = entry.column[key[0]] = moved
+        columns = self.documents[key[2]]
+        if entry in columns.long:
+            columns.long[moved] = columns.long.pop(entry)
+        return moved
+
+    def store(self, rule, position, value, entry):
+        """Cache entry unless the policy forbids it. Returns entry."""
+        with self.lock:
+            if self.key(rule, position, value) in self.table:
+                # replaces an entry in progress in another parse
+                self.discard(rule, position, value)
+            elif self.size is not None and len(self.table) >= self.size:
+                if self.policy == 'parse':
+                    return entry
+                self.evict()
+            key = self.key(rule, position, value, create=True)
+            self.table[key] = entry
+            if isinstance(value, Document):
+                entry.key = key
+                entry.column = self.documents[key[2]].get(position)
+                entry.column[rule] = entry
+                self.documents[key[2]].pending.add(entry)
+            # Keep the input alive so that its id cannot be reused while
+            # entries still refer to it.
+            pinned = self.inputs.get(key[2])
+            if pinned is None:
+                self.inputs[key[2]] = [value, 1]
+            else:
+                pinned[1] += 1
+            return entry
+
+    def discard(self, rule, position, value):
+        """Forget the entry for one rule application, if present"""
+        with self.lock:
+            key = self.key(rule, position, value)
+            if key in self.table:
+                self.remove(key)
+
+    def remove(self, key):
+        entry = self.table.pop(key)
+        if entry.column is not None:
+            del entry.column[key[0]]
+            columns = self.documents[key[2]]
+            columns.pending.discard(entry)
+            columns.long.pop(entry, None)
+        self.release(key[2])
+
+    def evict(self):
+        """Drop the least recently used entry"""
+        self.remove(next(iter(self.table)))
+        self.evictions += 1
+
+    def release(self, input_id):
+        pinned = self.inputs[input_id]
+        pinned[1] -= 1
+        if not pinned[1]:
+            del self.inputs[input_id]
+            self.documents.pop(input_id, None)
+
+    def complete(self, value, position):
+        """Enumerate all results of the entries on value in progress from
+        position on, each in the context of the parse which created it"""
+        with self.lock:
+            columns = self.documents.get(id(value))
+            entries = [entry for entry in columns.pending
+                       if entry.position >= position] if columns else []
+        for entry in entries:
+            for result in entry:
+                pass
+
+    def edit(self, value, offset, removed, inserted):
+        """Update the entries on value after `removed` elements at offset
+        were replaced by `inserted` elements. Entries that examined only
+        input before offset are kept, complete entries starting behind
+        the replaced range are moved, all others are dropped."""
+        with self.lock:
+            columns = self.documents.get(id(value))
+            if columns is None:
+                return
+            end = offset + removed
+            dropped = []
+            # sets and dicts keep their size, so both are built anew
+            pending, long = set(), {}
+            for entry in columns.pending:
+                if entry.generator is None:
+                    if entry.examines(entry.position,
+                                      entry.position + self.window):
+                        columns.long[entry] = entry.position
+                elif entry.position >= offset or \
+                        entry.examines(entry.position, offset):
+                    dropped.append(entry)
+                else:
+                    pending.add(entry)
+            for entry, start in columns.long.iteritems():
+                if start >= end:
+                    long[entry] = start + inserted - removed
+                elif start >= offset or entry.examines(start, offset):
+                    dropped.append(entry)
+                else:
+                    long[entry] = start
+            columns.pending, columns.long = pending, long
+            for start in xrange(max(0, offset - self.window),
+                                min(offset, len(columns.columns))):
+                for entry in (columns.columns[start] or {}).itervalues():
+                    if entry.examines(start, offset):
+                        dropped.append(entry)
+            for column in columns.columns[offset:end]:
+                dropped.extend((column or {}).itervalues())
+            for entry in dropped:
+                if self.table.get(entry.key) is entry:
+                    self.remove(entry.key)
+            if len(columns.columns) < end:
+                columns.columns.extend([None] * (end - len(columns.columns)))
+            columns.columns[offset:end] = [None] * inserted
+
+    def reset(self):
+        """Start a new parse. Drops the entries of earlier parses, except
+        those on Documents under the 'lru' policy. Entries of parses
+        computing in this or another thread are kept."""
+        with self.lock:
+            for key, entry in self.table.items():
+                if entry.context is not None and entry.context.running:
+                    continue
+                if self.policy == 'lru' and key[2] in self.documents:
+                    continue
+                self.remove(key)
+
+    def clear(self):
+        """Drop all entries. Counters are kept."""
+        with self.lock:
+            self.table.clear()
+            self.inputs.clear()
+            self.documents.clear()
+
+    def __getstate__(self):
+        """Pickle the configuration and counters, not the entries"""
+        state = self.__dict__.copy()
+        state.update(table=OrderedDict(), inputs={}, documents={})
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.table)}
@@ -0,0 +1,220 @@
+"""
+Algebraic simplification of expression trees.
+
+optimize(p) rewrites p into an expression yielding the same results in
+the same order, with fewer and flatter nodes, using the laws listed in
+expressions.py:
+
+    Return(a) ** f          f(a)
+    p | zero, zero | p      p
+    zero ** f, zero + p     zero
+    (p | q) | r             Alternatives([p, q, r])
+    (p + q) + r             Sequence([p, q, r])
+    item(x) | item(y)       Items([x, y])
+    Set(s) | Set(t)         Set(s | t)
+    Set(s) | item(x)        Set(s | {x}) or Items(list(s) + [x])
+
+Adjacent literals in a sequence are fused. Adjacent items merge only if
+no spelling of their elements is shared, byte values counting as
+character and int, so no result is lost or reordered; like the items,
+Items yields the input's element. Adjacent Sets merge only if they are
+disjoint in every spelling and both, or neither, match binary input.
+A Set and adjacent items merge likewise, when their elements are
+hashable and disjoint in every spelling: into a Set if its elements are
+all bytes or none is, into Items otherwise, provided the Set matches
+bytes by both spellings. Structurally identical
+subtrees are shared, e.g. the same item('x') used in many places becomes
+one node, which the compiler then translates once. See interning.py.
+
+    p = p.optimize()
+    g.optimize()                    # rewrite all rules of grammar g
+
+Folding Return(a) ** f calls f at optimization time, so continuations
+have to be functions of their argument alone, as the monad laws assume;
+continuations reading Variables bound during the parse are not. Rule
+references are not followed, the rules they name are optimized with
+g.optimize(). Expressions created at parse time by Bind are not
+optimized.
+"""
+
+from expressions import *
+from interning import Interner, children, arms_of
+from structure import MatchType
+
+
+def is_zero(p):
+    return type(p) is Zero
+
+
+class Optimizer(Interner):
+    """Rewrites expressions, sharing the results between calls"""
+
+    def rewrite(self, p):
+        kind = type(p)
+        if kind is Branch or kind is Alternatives:
+            return self.alternatives(p)
+        if kind is Bind:
+            expr = self(p.expr)
+            if is_zero(expr):
+                return zero
+            if type(expr) is Return:
+                return self(p.each(expr.result))
+            if expr is p.expr:
+                return p
+            return self.copy(p, expr=expr)
+        if kind is MatchType:
+            return Interner.rewrite(self, p)
+        if kind is Sequence:
+            parts = [self(part) for part in p.parts]
+            if any(is_zero(part) for part in parts):
+                return zero
+            return self.sequence(*parts)
+        fields = children.get(kind, ())
+        changed = self.changes(p)
+        if fields and is_zero(self.first_child(p, changed, fields[0])) and \
+                kind is not Many and not (kind is Repeat and not p.once):
+            # nothing to apply the node to
+            return zero
+        if kind is Both and is_zero(changed.get('q', p.q)):
+            return zero
+        if not changed:
+            return p
+        return self.copy(p, **changed)
+
+    def first_child(self, p, changed, field):
+        return changed.get(field, getattr(p, field))
+
+    def alternatives(self, p):
+        arms = []
+        for arm in arms_of(p):
+            arm = self(arm)
+            if type(arm) is Alternatives:
+                arms.extend(arm.arms)
+            elif not is_zero(arm):
+                self.merge(arms, arm)
+        if not arms:
+            return zero
+        if len(arms) == 1:
+            return arms[0]
+        return Alternatives(arms)
+
+    def merge(self, arms, arm):
+        """Append arm, merged into the previous arm if both are items or
+        Sets, of disjoint elements"""
+        if arms:
+            merged = merge_items(arms[-1], arm) or \
+                merge_sets(arms[-1], arm) or merge_set_items(arms[-1], arm)
+            if merged is not None:
+                arms[-1] = self.share(merged)
+                return
+        arms.append(arm)
+
+    def sequence(self, *parts):
+        flat = []
+        for index, part in enumerate(parts):
+            if index == 0 and type(part) is Sequence:
+                # only left nesting: results concatenate left to right
+                flat.extend(part.parts)
+            elif flat and isinstance(flat[-1], Literal) and isinstance(part, Literal):
+                flat[-1] = self.share(flat[-1].fuse(part))
+            else:
+                flat.append(part)
+        if len(flat) == 1:
+            return flat[0]
+        return Sequence(flat)
+
+
+def items(p):
+    """The elements of p if p matches one of them and yields it"""
+    if type(p) is Items or type(p) in (Literal, Item) and len(p.elements) == 1:
+        return p.elements
+    return None
+
+
+def spellings(elements):
+    """The elements with the other spelling of byte values"""
+    values = set()
+    for e in elements:
+        values.update(byte_values([e]) or [e])
+    return values
+
+
+def merge_items(left, right):
+    """Items matching the items left, then right, or None"""
+    first, second = items(left), items(right)
+    if first is None or second is None:
+        return None
+    try:
+        if spellings(first) & spellings(second):
+            return None
+    except TypeError:
+        return None     # unhashable element
+    return Items(first + second)
+
+
+def merge_sets(left, right):
+    """Set matching what the Sets left or right match, or None"""
+    if type(left) is not Set or type(right) is not Set:
+        return None
+    first, second = left.choices, right.choices
+    if not isinstance(first, (set, frozenset, Ranges)) or \
+            not isinstance(second, (set, frozenset, Ranges)) or \
+            is_ranges(first, second) or first & second:
+        return None
+    if (left.octets is None) != (right.octets is None):
+        return None     # the union would not match binary input alike
+    if left.octets is not None and left.octets & right.octets:
+        return None
+    return Set(first | second)
+
+
+def merge_set_items(left, right):
+    """Set or Items matching what the Set and the items among left and
+    right match, or None"""
+    if type(left) is Set:
+        choices, elements = left.choices, items(right)
+    elif type(right) is Set:
+        choices, elements = right.choices, items(left)
+    else:
+        return None
+    if elements is None or not isinstance(choices, (set, frozenset)):
+        return None
+    try:
+        if spellings(choices) & spellings(elements):
+            return None
+    except TypeError:
+        return None     # unhashable element
+    octets = [byte_values([e]) is not None for e in choices]
+    others = [byte_values([e]) is not None for e in elements]
+    if all(octets + others) or not any(octets + others):
+        return Set(set(choices) | set(elements))
+    if any(octets) and not all(octets):
+        return None     # the Set matches its bytes by one spelling only
+    if type(left) is Set:
+        return Items(list(choices) + elements)
+    return Items(elements + list(choices))
+
+
+def is_ranges(left, right):
+    """Whether merging mixes ranges of different kinds"""
+    for choices, other in ((left, right), (right, left)):
+        if isinstance(choices, Ranges):
+            try:
+                choices | other
+            except TypeError:
+                return True
+    return False
+
+
+def optimize(p):
+    """p rewritten by the laws of the module documentation"""
+    return Optimizer()(p)
+
+
+def optimize_grammar(grammar):
+    """Rewrite the rules of grammar in place"""
+    optimizer = Optimizer()
+    for key, rule in grammar.rules.items():
+        new = optimizer(rule)
+        if new is not rule:
+            grammar[key] = new
@@ -0,0 +1,40 @@
+"""
+Parallel parsing of independent inputs.
+
+    g.parse_many(records, workers=4, chunksize=100)
+
+starts a pool of worker processes, installs the grammar in each of them
+once and hands out the inputs in chunks of `chunksize`. Each input is
+parsed completely; the lists of (result, position) pairs come back in the
+order of the inputs. Inputs and results travel between the processes by
+pickling, so both have to be picklable, as do the grammar's expressions
+and Unifiables when processes are not forked.
+"""
+
+import multiprocessing
+
+
+grammar = None      # grammar installed in a worker process
+
+
+def install(installed):
+    global grammar
+    grammar = installed
+
+
+def parse(value):
+    return list(grammar(value))
+
+
+def parse_many(g, iterable, workers=None, chunksize=1):
+    if workers == 1:
+        return [list(g(value)) for value in iterable]
+    pool = multiprocessing.Pool(workers, install, (g,))
+    try:
+        results = pool.map(parse, iterable, chunksize)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
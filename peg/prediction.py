@@ -0,0 +1,225 @@
+"""
+FIRST sets and predictive dispatch of alternatives.
+
+first(p) is the set of elements p can start with: p only yields results
+if the element at the position parsed is in the set. END stands for the
+end of the input. None means p may succeed on any next element, e.g.
+because it can succeed without consuming any.
+
+predict(p) replaces wide chains of alternatives (p1 | p2 | ... | pn) by
+a Dispatch, which looks up the next element in a table and only tries
+the alternatives whose FIRST set allows it, in their original order. The
+results are those of the chain, in the same order.
+
+    g.predict()                     # rewrite all rules of grammar g
+    p = predict(p)
+
+Rule references are followed when computing FIRST sets, so g.predict()
+should be called after all rules are defined. Expressions created at
+parse time by Bind are not rewritten.
+"""
+
+import copy
+
+from expressions import *
+from interning import children, lists, arms_of, rebuilt
+from structure import MatchType
+
+
+class End(object):
+
+    def __repr__(self):
+        return 'END'
+
+    def __reduce__(self):
+        return 'END'
+
+END = End()
+
+
+# Minimum number of alternatives worth a table lookup
+MIN_ALTERNATIVES = 3
+
+# Maximum number of elements of a Range listed in a FIRST set
+MAX_RANGE = 1024
+
+
+def first(p, rules=None):
+    """FIRST set of p as a frozenset, or None if it is unrestricted"""
+    if rules is None:
+        rules = set()
+    kind = type(p)
+    if kind is Set:
+        if isinstance(p.choices, Ranges):
+            return members(p.choices)
+        if not isinstance(p.choices, (set, frozenset)):
+            return None
+        return frozenset(p.choices) | (p.octets or frozenset())
+    if kind is Scan:
+        if not p.least:
+            return None
+        if isinstance(p.choices, Ranges):
+            return members(p.choices)
+        return frozenset(p.choices) | (byte_values(p.choices) or frozenset())
+    if kind is Literal or kind is Item:
+        if not p.elements:
+            return None
+        try:
+            return frozenset([p.elements[0]]) | \
+                (byte_values(p.elements[:1]) or frozenset())
+        except TypeError:
+            return None     # unhashable element
+    if kind is Items:
+        return frozenset(p.items) | frozenset(p.octets or ())
+    if kind is Zero:
+        return frozenset()
+    if kind is EndOfInput:
+        return frozenset([END])
+    if kind is Branch:
+        return union(first(p.p, rules), first(p.q, rules))
+    if kind is Alternatives:
+        return reduce(union, [first(q, rules) for q in p.arms])
+    if kind is Sequence:
+        return first(p.parts[0], rules)
+    if kind is Dispatch:
+        return reduce(union, [first(q, rules) for q in p.alternatives])
+    if kind is MatchType:
+        if not p.parsers:
+            return frozenset()
+        return reduce(union, [first(q, rules) for q in p.parsers])
+    if kind is Both:
+        return intersection(first(p.p, rules), first(p.q, rules))
+    if kind is Bind or kind is Cut or kind is Capture:
+        return first(p.expr, rules)
+    if kind is Unify:
+        return first(p.expression, rules)
+    if kind is Inside:
+        return first(p.outer, rules)
+    if kind is Repeat:
+        return first(p.what, rules) if p.once else None
+    if kind is Many:
+        return first(p.p, rules) if p.least else None
+    if kind is Reference:
+        key = id(p.grammar), p.key
+        if key in rules or p.key not in p.grammar.rules:
+            return None     # left recursion or undefined rule
+        rules.add(key)
+        try:
+            return first(p.grammar.rules[p.key], rules)
+        finally:
+            rules.discard(key)
+    return None
+
+
+def members(ranges):
+    """FIRST set of a Set of ranges, None if too large to tabulate"""
+    if len(ranges) > MAX_RANGE:
+        return None
+    elements = set(ranges)
+    if ranges.chars:
+        # ranges compare code points, so list both string types
+        elements.update([unichr(ord(c)) for c in elements] +
+                        [chr(ord(c)) for c in elements if ord(c) < 256])
+    return frozenset(elements) | (ranges.octets() or frozenset())
+
+
+def union(s, t):
+    if s is None or t is None:
+        return None
+    return s | t
+
+def intersection(s, t):
+    if s is None:
+        return t
+    if t is None:
+        return s
+    return s & t
+
+
+class Dispatch(Expression):
+    """Alternatives tried only if their FIRST set admits the next element.
+    Yields the results of p1 | p2 | ... in the same order."""
+
+    __slots__ = ('alternatives', 'firsts', 'default', 'end', 'everything',
+                 'table')
+
+    def __init__(self, alternatives, firsts):
+        self.alternatives = alternatives
+        self.firsts = firsts
+        everything = tuple(range(len(alternatives)))
+        self.default = tuple(i for i in everything if firsts[i] is None)
+        self.end = tuple(i for i in everything
+                         if firsts[i] is None or END in firsts[i])
+        self.everything = everything
+        self.table = {}
+        for key in set().union(*[s for s in firsts if s is not None]):
+            if key is not END:
+                self.table[key] = tuple(i for i in everything
+                                        if firsts[i] is None or key in firsts[i])
+
+    def select(self, value, position):
+        """Indices of the alternatives to try at position"""
+        try:
+            if position < len(value):
+                return self.table.get(value[position], self.default)
+            return self.end
+        except TypeError:
+            # unsized input or unhashable element
+            return self.everything
+
+    def __call__(self, value, position):
+        for index in self.select(value, position):
+            for result, pos in self.alternatives[index](value, position):
+                yield result, pos
+
+    def match(self, value, position):
+        for index in self.select(value, position):
+            result = self.alternatives[index].match(value, position)
+            if result is not None:
+                return result
+        return None
+
+
+def predict(p, rewritten=None):
+    """p with wide chains of alternatives replaced by Dispatch nodes"""
+    if rewritten is None:
+        rewritten = {}
+    done = rewritten.get(id(p))
+    if done is not None:
+        return done[1]
+    if type(p) is Branch or type(p) is Alternatives:
+        arms = [predict(arm, rewritten) for arm in arms_of(p)]
+        if len(arms) >= MIN_ALTERNATIVES:
+            firsts = [first(arm) for arm in arms]
+            if any(s is not None for s in firsts):
+                result = Dispatch(arms, firsts)
+                rewritten[id(p)] = p, result
+                return result
+    if type(p) in lists:
+        field = lists[type(p)]
+        nodes = [predict(node, rewritten) for node in getattr(p, field)]
+        result = p
+        if any(new is not old for new, old in zip(nodes, getattr(p, field))):
+            result = rebuilt(p, nodes)
+        rewritten[id(p)] = p, result
+        return result
+    result = p
+    fields = children.get(type(p), ())
+    for field in fields:
+        child = getattr(p, field)
+        new = predict(child, rewritten)
+        if new is not child:
+            if result is p:
+                result = copy.copy(p)
+            setattr(result, field, new)
+    rewritten[id(p)] = p, result    # keep p alive while its id is in use
+    return result
+
+
+def predict_grammar(grammar):
+    """Rewrite the rules of grammar in place"""
+    rewritten = {}
+    for key, rule in grammar.rules.items():
+        new = predict(rule, rewritten)
+        if new is not rule:
+            grammar[key] = new
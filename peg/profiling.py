@@ -0,0 +1,184 @@
+"""
+Per-rule profiling of grammars.
+
+    g = Grammar('expr', profile=True)
+    g(data)
+    print g.profile_report()
+    g.profile.stats()               # the same as {rule: {counter: value}}
+
+For each rule the profile counts
+
+    calls           applications of the rule
+    successes       applications yielding at least one result
+    failures        applications yielding none
+    results         results yielded
+    backtracks      times a consumer asked an application for another
+                    result after one was yielded
+    cumulative      seconds spent in the rule, including the rules it
+                    called, counted once for recursive applications
+    self            seconds spent in the rule itself
+    depth           maximum number of nested applications of the rule
+
+Time is measured while the rule computes results, not while consumers
+process them. A grammar without profile costs one attribute test per rule
+application. The 'vm' engine calls rules without references and is not
+profiled per rule.
+
+Grammar.parse() and match() are profiled the same way. They ask each
+application for its first result only, so there are no backtracks, and
+re-entries answered from the seeds of left recursion or from the memo
+are not counted as calls.
+
+Parses in several threads may share a profiled grammar: each thread
+times the applications it computes, the counters are updated under a
+lock.
+"""
+
+import threading
+from timeit import default_timer
+
+
+class RuleStats(object):
+
+    counters = ('calls', 'successes', 'failures', 'results', 'backtracks',
+                'cumulative', 'self', 'depth')
+
+    def __init__(self):
+        for counter in self.counters:
+            setattr(self, counter, 0)
+
+    def stats(self):
+        return dict((counter, getattr(self, counter)) for counter in self.counters)
+
+
+class Profile(object):
+    """Counters and timings by rule"""
+
+    def __init__(self):
+        self.rules = {}
+        self.depth = 0      # deepest nesting of rule applications
+        # the applications being timed, by thread: rule applications nest
+        # within the step of one parse, whichever parse they belong to
+        self.local = threading.local()
+        self.lock = threading.Lock()    # guards the counters
+
+    def rule(self, rule):
+        with self.lock:
+            stats = self.rules.get(rule)
+            if stats is None:
+                stats = self.rules[rule] = RuleStats()
+            return stats
+
+    def applications(self):
+        """(rule -> applications computing right now, stack of [rule, time
+        spent in nested rules]) of this thread"""
+        local = self.local
+        if not hasattr(local, 'stack'):
+            local.active, local.stack = {}, []
+        return local.active, local.stack
+
+    def enter(self, rule, stats):
+        """Start timing an application of rule. Returns whether it is the
+        outermost one."""
+        active, stack = self.applications()
+        outermost = not active.get(rule)
+        active[rule] = active.get(rule, 0) + 1
+        stack.append([rule, 0.0])
+        with self.lock:
+            stats.depth = max(stats.depth, active[rule])
+            self.depth = max(self.depth, len(stack))
+        return outermost
+
+    def leave(self, rule, stats, outermost, elapsed):
+        active, stack = self.applications()
+        nested = stack.pop()[1]
+        if stack:
+            stack[-1][1] += elapsed
+        active[rule] -= 1
+        with self.lock:
+            if outermost:
+                stats.cumulative += elapsed
+            stats.self += elapsed - nested
+
+    def count(self, stats, *counters):
+        with self.lock:
+            for counter in counters:
+                setattr(stats, counter, getattr(stats, counter) + 1)
+
+    def measure(self, rule, results):
+        """Yield results, accounting for them to rule"""
+        stats = self.rule(rule)
+        self.count(stats, 'calls')
+        results = iter(results)
+        count = 0
+        while True:
+            outermost = self.enter(rule, stats)
+            start = default_timer()
+            try:
+                result = next(results)
+            except StopIteration:
+                if not count:
+                    self.count(stats, 'failures')
+                return
+            finally:
+                self.leave(rule, stats, outermost, default_timer() - start)
+            if not count:
+                self.count(stats, 'successes', 'results')
+            else:
+                self.count(stats, 'results')
+            count += 1
+            yield result
+            self.count(stats, 'backtracks')
+
+    def call(self, rule, match, value, position):
+        """Return match(value, position), the first result or None,
+        accounting for it to rule"""
+        stats = self.rule(rule)
+        self.count(stats, 'calls')
+        outermost = self.enter(rule, stats)
+        start = default_timer()
+        try:
+            result = match(value, position)
+        finally:
+            self.leave(rule, stats, outermost, default_timer() - start)
+        if result is None:
+            self.count(stats, 'failures')
+        else:
+            self.count(stats, 'successes', 'results')
+        return result
+
+    def stats(self):
+        with self.lock:
+            return dict((rule, stats.stats())
+                        for rule, stats in self.rules.items())
+
+    def clear(self):
+        with self.lock:
+            self.rules.clear()
+            self.depth = 0
+
+    def __getstate__(self):
+        """Pickle the counters, not the applications being timed"""
+        state = self.__dict__.copy()
+        del state['local'], state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def report(self):
+        """Table of the rules by self time"""
+        header = '%-20s %8s %8s %8s %8s %10s %10s %10s %6s' % (
+            'rule', 'calls', 'success', 'fail', 'results', 'backtracks',
+            'cumulative', 'self', 'depth')
+        lines = [header]
+        for rule, stats in sorted(self.rules.items(),
+                                  key=lambda item: -item[1].self):
+            lines.append('%-20s %8d %8d %8d %8d %10d %10.6f %10.6f %6d' % (
+                str(rule)[:20], stats.calls, stats.successes, stats.failures,
+                stats.results, stats.backtracks, stats.cumulative,
+                stats.self, stats.depth))
+        lines.append('maximum nesting of rules: %d' % self.depth)
+        return '\n'.join(lines)
@@ -0,0 +1,199 @@
+"""
+Compact classes of characters or ints given by intervals.
+
+A Ranges object is a sorted list of disjoint, inclusive intervals. It
+behaves like the set Set keeps its choices in: membership, iteration,
+len() and the operators | & - ^ with other Ranges or plain sets. A class
+of all letters takes a few intervals instead of a set of every letter.
+
+    Set(Ranges([('a', 'z'), ('A', 'Z')]))
+    Range('0', '9') | Set('_')              # see expressions.py
+
+Characters are compared by code point, a str character by its byte
+value. The members from 0 to 255, i.e. bytes and ASCII, are also kept in
+a table: a frozenset of every spelling (str, unicode or int), which Set
+tests before bisecting the intervals for other code points and ints.
+"""
+
+import re
+from bisect import bisect_right
+
+
+def code(element, chars):
+    """Code point of a character or value of an int, None if element is
+    of the other kind"""
+    if chars:
+        if isinstance(element, basestring) and len(element) == 1:
+            return ord(element)
+    elif isinstance(element, (int, long)):
+        return element
+    return None
+
+
+def kind(element):
+    """Whether element is a character (True) or an int (False)"""
+    if isinstance(element, basestring) and len(element) == 1:
+        return True
+    if isinstance(element, (int, long)):
+        return False
+    raise TypeError("Ranges hold characters or ints, not %r" % (element,))
+
+
+class Ranges(object):
+    """Class of characters or ints given by inclusive (low, high) intervals"""
+
+    def __init__(self, intervals=()):
+        self.chars = None       # characters (True) or ints (False)
+        self.unicode = False    # whether characters are unicode
+        bounds = []
+        for low, high in intervals:
+            for bound in low, high:
+                self.unify(kind(bound))
+                if isinstance(bound, unicode):
+                    self.unicode = True
+            bounds.append((code(low, self.chars), code(high, self.chars)))
+        self.lows, self.highs = [], []
+        for low, high in sorted(bounds):
+            if low > high:
+                continue
+            if self.highs and low <= self.highs[-1] + 1:
+                self.highs[-1] = max(self.highs[-1], high)
+            else:
+                self.lows.append(low)
+                self.highs.append(high)
+        self.tabulate()
+
+    def unify(self, chars):
+        if self.chars is None:
+            self.chars = chars
+        elif self.chars != chars:
+            raise TypeError("Ranges cannot mix characters and ints")
+
+    @classmethod
+    def of(cls, elements):
+        """The Ranges holding exactly elements"""
+        if isinstance(elements, Ranges):
+            return elements
+        return cls((e, e) for e in elements)
+
+    def covers(self, c):
+        """Whether code point c lies in an interval"""
+        i = bisect_right(self.lows, c) - 1
+        return i >= 0 and c <= self.highs[i]
+
+    def tabulate(self):
+        """Compute the table of members from 0 to 255 and whether there
+        are other members"""
+        codes = [c for c in xrange(256) if self.covers(c)]
+        if self.chars:
+            self.table = frozenset(map(chr, codes) + map(unichr, codes))
+        else:
+            self.table = frozenset(codes)
+        self.large = bool(self.highs) and \
+            (self.lows[0] < 0 or self.highs[-1] > 255)
+
+    def __contains__(self, element):
+        if element in self.table:
+            return True
+        if not self.large:
+            return False
+        c = code(element, self.chars)
+        return c is not None and not 0 <= c <= 255 and self.covers(c)
+
+    def element(self, c):
+        if not self.chars:
+            return c
+        return unichr(c) if self.unicode or c > 255 else chr(c)
+
+    def intervals(self):
+        """List of the (low, high) intervals, as elements"""
+        return [(self.element(low), self.element(high))
+                for low, high in zip(self.lows, self.highs)]
+
+    def __iter__(self):
+        for low, high in zip(self.lows, self.highs):
+            for c in xrange(low, high + 1):
+                yield self.element(c)
+
+    def __len__(self):
+        return sum(high - low + 1 for low, high in zip(self.lows, self.highs))
+
+    def __nonzero__(self):
+        return bool(self.lows)
+
+    def __eq__(self, other):
+        if isinstance(other, (set, frozenset)):
+            try:
+                other = Ranges.of(other)
+            except TypeError:
+                return False
+        if not isinstance(other, Ranges):
+            return NotImplemented
+        return (self.lows, self.highs) == (other.lows, other.highs) and \
+            (self.chars == other.chars or not self.lows)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def combine(self, other, keep):
+        """The Ranges of the codes where keep(in self, in other) holds"""
+        other = Ranges.of(other)
+        chars = self.chars if other.chars is None else other.chars
+        if self.chars is not None and chars != self.chars:
+            raise TypeError("Ranges cannot mix characters and ints")
+        # the classes are constant between consecutive boundaries
+        points = sorted(set(self.lows + [h + 1 for h in self.highs] +
+                            other.lows + [h + 1 for h in other.highs]))
+        result = Ranges()
+        result.chars = chars
+        result.unicode = self.unicode or other.unicode
+        for start, stop in zip(points, points[1:]):
+            if keep(self.covers(start), other.covers(start)):
+                if result.highs and result.highs[-1] + 1 == start:
+                    result.highs[-1] = stop - 1
+                else:
+                    result.lows.append(start)
+                    result.highs.append(stop - 1)
+        result.tabulate()
+        return result
+
+    def __or__(self, other):
+        return self.combine(other, lambda a, b: a or b)
+
+    def __and__(self, other):
+        return self.combine(other, lambda a, b: a and b)
+
+    def __sub__(self, other):
+        return self.combine(other, lambda a, b: a and not b)
+
+    def __xor__(self, other):
+        return self.combine(other, lambda a, b: a != b)
+
+    __ror__ = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+
+    def __rsub__(self, other):
+        return Ranges.of(other) - self
+
+    def octets(self):
+        """Both spellings of the members if all are bytes, else None"""
+        if self.large:
+            return None
+        return frozenset(c for b in xrange(256) if self.covers(b)
+                         for c in (b, chr(b)))
+
+    def pattern(self, character=unichr):
+        """Regular expression matching a run of members, with characters
+        made by character (chr for str, unichr for unicode patterns)"""
+        escape = lambda c: re.escape(character(c))
+        return re.compile('[%s]*' % ''.join(
+            escape(low) if low == high else '%s-%s' % (escape(low), escape(high))
+            for low, high in zip(self.lows, self.highs)))
+
+    def __repr__(self):
+        return 'Ranges(%r)' % self.intervals()
+
@@ -0,0 +1,54 @@
+"""
+Nodes without a __dict__.
+
+Expressions and Unifiables keep their fields in __slots__, which saves
+the per-instance dictionary: grammars of thousands of nodes and the
+Spans and Activations made during a parse take less memory and are
+faster to create. Slotted gives such classes the pickling and copying
+protocol of ordinary objects: the state is a dictionary of the fields
+that are set, and restoring it sets them again. Subclasses without
+__slots__ of their own get a __dict__ as usual, which the state
+includes.
+"""
+
+
+# slot names by class, of the class and its bases
+names = {}
+
+def slot_names(cls):
+    """Descriptors of the slots of cls by name"""
+    slots = names.get(cls)
+    if slots is None:
+        slots = {}
+        for base in reversed(cls.__mro__):
+            declared = base.__dict__.get('__slots__', ())
+            if isinstance(declared, basestring):
+                declared = declared,
+            for name in declared:
+                if name not in ('__dict__', '__weakref__'):
+                    slots[name] = base.__dict__[name]
+        names[cls] = slots
+    return slots
+
+
+class Slotted(object):
+    """Base class of nodes keeping their fields in __slots__"""
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for name, slot in slot_names(type(self)).iteritems():
+            try:
+                state[name] = slot.__get__(self)
+            except AttributeError:
+                pass    # not set
+        try:
+            state.update(object.__getattribute__(self, '__dict__'))
+        except AttributeError:
+            pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
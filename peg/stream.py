@@ -0,0 +1,104 @@
+"""
+Streaming input for parsing files and iterators larger than memory.
+
+A Stream wraps a file object (anything with read(size)) or an iterable of
+chunks (strings or lists) and behaves like the indexable input parsers
+expect: len(), indexing and slicing. Data is read on demand.
+
+    for result, pos in g(Stream(open('huge.log')), 0):
+        ...
+
+len() reports the data buffered so far, but always at least `lookahead`
+elements beyond the furthest position accessed (unless the stream ended
+before). Parsers that inspect the input through indexing, like all
+expressions of this package, therefore never see a premature end.
+
+Cuts commit: once a cut has produced its result at position p, the stream
+may discard everything before p, so a grammar cutting after each record
+parses in bounded memory. Accessing a discarded position raises an
+IndexError, a grammar on a stream must not backtrack before a cut.
+Spans captured over a stream have to be unpacked before a cut commits
+past them.
+"""
+
+
+class Stream(object):
+    """Indexable, growing buffer over a file object or chunk iterator"""
+
+    def __init__(self, source, chunk=65536, lookahead=None):
+        if hasattr(source, 'read'):
+            self.chunks = iter(lambda: source.read(chunk), '')
+        else:
+            self.chunks = iter(source)
+        self.chunk = chunk
+        self.lookahead = chunk if lookahead is None else lookahead
+        self.buffer = None  # str, unicode or list, after the first read
+        self.offset = 0     # stream position of buffer[0]
+        self.furthest = -1  # furthest position accessed
+        self.done = False
+
+    def fill(self, end):
+        """Read until the buffer reaches position end or the stream ends"""
+        available = self.offset + len(self.buffer or ())
+        if end <= available or self.done:
+            return
+        # grow geometrically to keep appending linear
+        wanted = max(end - available, self.chunk, len(self.buffer or ()))
+        chunks = []
+        while wanted > 0:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.done = True
+                break
+            chunks.append(chunk)
+            wanted -= len(chunk)
+        if not chunks:
+            return
+        if self.buffer is None:
+            self.buffer = chunks[0][:0] if isinstance(chunks[0], basestring) else []
+        if isinstance(self.buffer, basestring):
+            self.buffer = self.buffer + self.buffer[:0].join(chunks)
+        else:
+            for chunk in chunks:
+                self.buffer.extend(chunk)
+
+    def commit(self, position):
+        """Allow the data before position to be discarded"""
+        drop = position - self.offset
+        if self.buffer is not None and drop > 0 and \
+                drop >= min(self.chunk, len(self.buffer) // 2):
+            self.buffer = self.buffer[drop:]
+            self.offset = position
+
+    def index(self, position):
+        """Buffer index of a stream position"""
+        if position < self.offset:
+            raise IndexError("stream position %d was discarded by a cut" % position)
+        return position - self.offset
+
+    def __len__(self):
+        self.fill(self.furthest + 1 + self.lookahead)
+        return self.offset + len(self.buffer or ())
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            if position.step not in (None, 1):
+                raise ValueError("streams only support contiguous slices")
+            start = position.start or 0
+            stop = position.stop
+            if stop is None:
+                raise ValueError("streams do not support open slices")
+            self.fill(stop)
+            self.furthest = max(self.furthest, stop - 1)
+            if self.buffer is None:
+                return []
+            return self.buffer[self.index(start):self.index(max(start, stop))]
+        if position < 0:
+            raise IndexError("streams do not support negative indices")
+        self.fill(position + 1)
+        if position > self.furthest:
+            self.furthest = position
+        if self.buffer is None:
+            raise IndexError("stream is empty")
+        return self.buffer[self.index(position)]
@@ -9,13 +9,29 @@ p [ q ]     Continues to parse p's output with q. Return q's output.
 this        The parser for the whole input instead of just the next element.
             Use p[this] instead of p[element] if p does not emit a list.
 
-get('name') Continues parsing with input.name
+get('name') Continues parsing with input.name, or input.a.b for 'a.b'
 
 at(i)       Continues parsing with input[i]
 
-typeof(t)   Continues parsing if isinstance(input, t)
+type_of(t)  Continues parsing if isinstance(input, t)
+
+match_type({X: p, Y: q})
+            Continues parsing with p if the input is an X, with q if it
+            is a Y. The class nearest to the input's type in its method
+            resolution order decides, looked up once per type; a key may
+            also be a tuple of classes. Virtual subclasses, e.g. of
+            abstract base classes, take the first class they belong to
+            in the order of the mapping, which may also be a list of
+            (classes, parser) pairs.
+
+get, at and type_of are single nodes using operator.attrgetter and
+itemgetter, which the compiler translates inline.
 """
 
+from inspect import getmro
+from operator import attrgetter, itemgetter
+from types import InstanceType
+
 from expressions import *
 
 
@@ -23,12 +39,19 @@ class This(Expression):
     """Parser for just the argument given to parse.
     Complements the element parser which operates on indexable collections."""
 
+    __slots__ = ()
+
     def __call__(self, value, position):
         yield value, position
 
+    def match(self, value, position):
+        return value, position
+
 
 class Attribute(Expression):
 
+    __slots__ = ('parser', 'attr')
+
     def __init__(self, parser, attr):
         self.parser = parser
         self.attr = attr
@@ -40,20 +63,157 @@ class Attribute(Expression):
             except AttributeError:
                 pass
 
+    def match(self, value, position):
+        result = self.parser.match(value, position)
+        if result is None:
+            return None
+        try:
+            return getattr(result[0], self.attr), result[1]
+        except AttributeError:
+            return None
+
 this = This()
 
 
+class Get(Expression):
+    """Parser returning the attribute of the input, without consuming"""
+
+    __slots__ = ('name', 'getter')
+
+    def __init__(self, name):
+        self.name = name
+        self.getter = attrgetter(name)
+
+    def __call__(self, value, position):
+        yield self.getter(value), position
+
+    def match(self, value, position):
+        return self.getter(value), position
+
+    def __reduce__(self):
+        return Get, (self.name,)
+
+
+class At(Expression):
+    """Parser returning an item of the input, without consuming"""
+
+    __slots__ = ('index', 'getter')
+
+    def __init__(self, index):
+        self.index = index
+        self.getter = itemgetter(index)
+
+    def __call__(self, value, position):
+        yield self.getter(value), position
+
+    def match(self, value, position):
+        return self.getter(value), position
+
+    def __reduce__(self):
+        return At, (self.index,)
+
+
+class TypeOf(Expression):
+    """Parser returning the input if it is an instance of atype"""
+
+    __slots__ = ('atype',)
+
+    def __init__(self, atype):
+        self.atype = atype
+
+    def __call__(self, value, position):
+        if isinstance(value, self.atype):
+            yield value, position
+
+    def match(self, value, position):
+        if isinstance(value, self.atype):
+            return value, position
+        return None
+
+
+def class_of(value):
+    """The class of value, old-style classes included"""
+    cls = type(value)
+    if cls is InstanceType:
+        return value.__class__
+    return cls
+
+
+class MatchType(Expression):
+    """Applies the parser given for the input's class or its nearest base
+    class. Fails if the input is an instance of none of the classes.
+    Takes a mapping or a list of (classes, parser) pairs; parsers[i] is
+    given for the tuple of classes types[i]."""
+
+    __slots__ = ('types', 'parsers', 'indices', 'cache')
+
+    def __init__(self, parsers):
+        pairs = parsers.items() if hasattr(parsers, 'items') else parsers
+        self.types, self.parsers = [], []
+        self.indices = {}   # class -> index of the first parser given for it
+        for types, parser in pairs:
+            types = types if isinstance(types, tuple) else (types,)
+            for atype in types:
+                self.indices.setdefault(atype, len(self.parsers))
+            self.types.append(types)
+            self.parsers.append(parser)
+        self.cache = {}     # class of the input -> index or None
+
+    def select(self, value):
+        """Index of the parser for value, None if there is none"""
+        cls = class_of(value)
+        try:
+            return self.cache[cls]
+        except KeyError:
+            index = self.cache[cls] = self.lookup(cls)
+            return index
+
+    def lookup(self, cls):
+        for base in getmro(cls):
+            index = self.indices.get(base)
+            if index is not None:
+                return index
+        # virtual subclasses, e.g. of abstract base classes
+        for index, types in enumerate(self.types):
+            if issubclass(cls, types):
+                return index
+        return None
+
+    def __call__(self, value, position):
+        index = self.select(value)
+        if index is not None:
+            for result, pos in self.parsers[index](value, position):
+                yield result, pos
+
+    def match(self, value, position):
+        index = self.select(value)
+        if index is None:
+            return None
+        return self.parsers[index].match(value, position)
+
+    def __getstate__(self):
+        # the cache may hold classes that cannot be pickled
+        state = Expression.__getstate__(self)
+        state['cache'] = {}
+        return state
+
 
 def get(name):
     """Continue parsing with input.<name>"""
-    return this ** (lambda value: Return(getattr(value, name)))
+    return Get(name)
 
 
 def at(index):
     """Continue parsing with input[index]"""
-    return this ** (lambda value: Return(value[index]))
+    return At(index)
 
 
 def type_of(atype):
     """Continue parsing with input if type matches atype"""
-    return this ** (lambda value: Return(value) if isinstance(value, atype) else zero)
\ No newline at end of file
+    return TypeOf(atype)
+
+
+def match_type(parsers):
+    """Continue parsing with the parser given for the input's class,
+    {class or tuple of classes: parser} or a list of such pairs"""
+    return MatchType(parsers)
@@ -0,0 +1,494 @@
+"""
+Backtracking virtual machine for parsing expressions.
+
+Expression trees are lowered to a flat list of instructions which a single
+dispatch loop executes. Alternatives are kept on an explicit backtrack
+stack, rule calls on a linked call stack, so parsing does not consume
+Python stack frames and long repetitions do not hit the recursion limit.
+
+    g = Grammar('expr', engine='vm')
+    Program.expression(p).run(data, 0)
+
+The machine enumerates all results in the order of the generator based
+interpreter, which remains the reference semantics. Nodes without a
+lowering (including the expressions Bind creates at parse time) run as
+generators whose results the machine treats as alternatives.
+
+Left-recursive rules, those which may call themselves at the position
+they started at, run as generators of their Reference, which grows them
+as the generator engine does. Memo tables are not consulted by the
+machine.
+
+Instructions
+------------
+
+    ANY                 push the next element
+    SET choices         push the next element if it is in choices
+    BYTES set           push the next element if set accepts it, on binary
+                        input by character or int
+    LITERAL literal     push the literal's result if its elements follow
+    ITEM item           push the item's element if it is next
+    WHEN predicate      push the next element if predicate accepts it
+    PUSH x              push x
+    FAIL                backtrack
+    END                 push End(pos) at the end of the input
+    CHOICE l            save the state, resume at l when backtracking
+    JUMP l              continue at l
+    CALL (l, key)       call the rule at l
+    RETURN              return from a rule
+    MARK                remember the height of the backtrack stack
+    COMMIT              discard alternatives saved since the last MARK
+    CUT                 COMMIT, then commit a Stream input to the current
+                        position
+    PARTIAL_COMMIT l    update the top saved state to the current one,
+                        continue at l
+    NEWLIST             push []
+    APPEND              pop x, append x to the list on top
+    CONCAT              pop y and x, push the result of chaining x and y
+    NONEMPTY            fail if the list on top is empty
+    SAVEPOS             push the current position
+    DROP                pop a value
+    SETPOS              pop a position and continue there
+    ENTER               pop x, continue parsing x from position 0
+    LEAVE               return to the input and position before ENTER
+    BIND each           pop x, run each(x) as generator
+    UNIFY pattern       pop x, run pattern.unify(x) as generator
+    GENERATE node       run node as generator
+    HALT                yield (top, position) and backtrack for more
+"""
+
+from expressions import *
+
+
+names = ('ANY SET BYTES LITERAL ITEM WHEN PUSH FAIL END CHOICE JUMP CALL RETURN MARK COMMIT '
+         'CUT PARTIAL_COMMIT NEWLIST APPEND CONCAT NONEMPTY SAVEPOS DROP SETPOS '
+         'ENTER LEAVE BIND UNIFY GENERATE HALT').split()
+
+(ANY, SET, BYTES, LITERAL, ITEM, WHEN, PUSH, FAIL, END, CHOICE, JUMP, CALL,
+ RETURN, MARK, COMMIT, CUT, PARTIAL_COMMIT, NEWLIST, APPEND, CONCAT, NONEMPTY,
+ SAVEPOS, DROP, SETPOS, ENTER, LEAVE, BIND, UNIFY, GENERATE,
+ HALT) = range(len(names))
+
+# call stack frames
+RULE_FRAME, INPUT_FRAME, MARK_FRAME = range(3)
+
+
+lowerings = {}
+
+def lowers(cls):
+    """Register the decorated function as lowering of cls nodes"""
+    def register(lowering):
+        lowerings[cls] = lowering
+        return lowering
+    return register
+
+
+class Program(object):
+    """Instruction list of a lowered expression or grammar"""
+
+    def __init__(self, grammar=None):
+        self.code = []
+        self.grammar = grammar
+        self.calls = []     # CALL instructions to resolve
+        self.entries = {}   # rule key -> address
+
+    @classmethod
+    def expression(cls, expression):
+        program = cls()
+        program.lower(expression)
+        program.emit(HALT)
+        return program
+
+    @classmethod
+    def rules(cls, grammar):
+        program = cls(grammar)
+        program.emit(CALL, grammar.start)
+        program.emit(HALT)
+        recursive = left_recursive(grammar)
+        for key in grammar.rules:
+            program.entries[key] = len(program.code)
+            if key in recursive:
+                program.emit(GENERATE, grammar[key])
+            else:
+                program.lower(grammar.rules[key])
+            program.emit(RETURN)
+        for index in program.calls:
+            key = program.code[index][1]
+            program.code[index] = CALL, (program.entries[key], key)
+        return program
+
+    def emit(self, op, arg=None):
+        self.code.append((op, arg))
+        if op == CALL:
+            self.calls.append(len(self.code) - 1)
+        return len(self.code) - 1
+
+    def patch(self, index, arg):
+        self.code[index] = self.code[index][0], arg
+
+    def here(self):
+        return len(self.code)
+
+    def lower(self, node):
+        lowering = lowerings.get(type(node))
+        if lowering is None:
+            self.emit(GENERATE, node)
+        else:
+            lowering(self, node)
+
+    def listing(self):
+        return '\n'.join('%4d  %-15s %s' % (index, names[op], '' if arg is None else repr(arg))
+                         for index, (op, arg) in enumerate(self.code))
+
+    def run(self, value, position=0):
+        return execute(self.code, value, position)
+
+
+@lowers(Element)
+def lower_element(program, node):
+    program.emit(ANY)
+
+@lowers(Set)
+def lower_set(program, node):
+    if node.octets is None:
+        program.emit(SET, node.members)
+    else:
+        program.emit(BYTES, node)
+
+@lowers(Literal)
+def lower_literal(program, node):
+    program.emit(LITERAL, node)
+
+@lowers(Item)
+def lower_item(program, node):
+    program.emit(ITEM, node)
+
+@lowers(When)
+def lower_when(program, node):
+    program.emit(WHEN, node.predicate)
+
+@lowers(Return)
+def lower_return(program, node):
+    program.emit(PUSH, node.result)
+
+@lowers(Zero)
+def lower_zero(program, node):
+    program.emit(FAIL)
+
+@lowers(EndOfInput)
+def lower_end(program, node):
+    program.emit(END)
+
+@lowers(Branch)
+def lower_branch(program, node):
+    choice = program.emit(CHOICE)
+    program.lower(node.p)
+    jump = program.emit(JUMP)
+    program.patch(choice, program.here())
+    program.lower(node.q)
+    program.patch(jump, program.here())
+
+@lowers(Alternatives)
+def lower_alternatives(program, node):
+    jumps = []
+    for arm in node.arms[:-1]:
+        choice = program.emit(CHOICE)
+        program.lower(arm)
+        jumps.append(program.emit(JUMP))
+        program.patch(choice, program.here())
+    program.lower(node.arms[-1])
+    for jump in jumps:
+        program.patch(jump, program.here())
+
+@lowers(Sequence)
+def lower_sequence(program, node):
+    program.lower(node.parts[0])
+    for part in node.parts[1:]:
+        program.lower(part)
+        program.emit(CONCAT)
+
+@lowers(Both)
+def lower_both(program, node):
+    program.emit(SAVEPOS)
+    program.lower(node.p)
+    program.emit(DROP)
+    program.emit(SETPOS)
+    program.lower(node.q)
+
+@lowers(Inside)
+def lower_inside(program, node):
+    program.lower(node.outer)
+    program.emit(ENTER)
+    program.lower(node.inner)
+    program.emit(LEAVE)
+
+@lowers(Cut)
+def lower_cut(program, node):
+    program.emit(MARK)
+    program.lower(node.expr)
+    program.emit(CUT)
+
+@lowers(Bind)
+def lower_bind(program, node):
+    program.lower(node.expr)
+    program.emit(BIND, node.each)
+
+@lowers(Unify)
+def lower_unify(program, node):
+    program.lower(node.expression)
+    program.emit(UNIFY, node.pattern)
+
+@lowers(Repeat)
+def lower_repeat(program, node):
+    if node.mode != 'list':
+        program.emit(GENERATE, node)
+        return
+    program.emit(NEWLIST)
+    loop = program.emit(CHOICE)
+    program.emit(MARK)
+    program.lower(node.what)
+    program.emit(COMMIT)
+    program.emit(APPEND)
+    program.emit(PARTIAL_COMMIT, loop + 1)
+    program.patch(loop, program.here())
+    if node.once:
+        program.emit(NONEMPTY)
+
+@lowers(Reference)
+def lower_reference(program, node):
+    if program.grammar is node.grammar:
+        program.emit(CALL, node.key)
+    else:
+        program.emit(GENERATE, node)
+
+
+def left_calls(p, grammar, nullable):
+    """The rules p calls at the position it starts at, and whether p may
+    succeed without consuming input, as lowered for grammar. nullable
+    tells the latter of the rules. Nodes running as generators call no
+    rules of the machine; whether they consume input is unknown."""
+    kind = type(p)
+    if kind not in lowerings or kind is Repeat and p.mode != 'list':
+        return set(), True
+    if kind is Reference:
+        if p.grammar is not grammar:
+            return set(), True
+        return set([p.key]), nullable.get(p.key, False)
+    if kind is Branch or kind is Alternatives:
+        calls, empty = set(), False
+        for arm in (p.p, p.q) if kind is Branch else p.arms:
+            arm_calls, arm_empty = left_calls(arm, grammar, nullable)
+            calls |= arm_calls
+            empty = empty or arm_empty
+        return calls, empty
+    if kind is Sequence:
+        calls = set()
+        for part in p.parts:
+            part_calls, empty = left_calls(part, grammar, nullable)
+            calls |= part_calls
+            if not empty:
+                return calls, False
+        return calls, True
+    if kind is Both:
+        calls, empty = left_calls(p.p, grammar, nullable)
+        q_calls, empty = left_calls(p.q, grammar, nullable)
+        return calls | q_calls, empty
+    if kind is Inside:
+        return left_calls(p.outer, grammar, nullable)
+    if kind is Cut:
+        return left_calls(p.expr, grammar, nullable)
+    if kind is Bind:
+        # the continuation runs as generator
+        return left_calls(p.expr, grammar, nullable)[0], True
+    if kind is Unify:
+        return left_calls(p.expression, grammar, nullable)
+    if kind is Repeat:
+        calls, empty = left_calls(p.what, grammar, nullable)
+        return calls, empty or not p.once
+    if kind is Literal:
+        return set(), not p.elements
+    return set(), kind is Return or kind is EndOfInput
+
+
+def left_recursive(grammar):
+    """The keys of the rules of grammar which may call themselves at the
+    position they started at"""
+    nullable = dict.fromkeys(grammar.rules, False)
+    changed = True
+    while changed:
+        changed = False
+        for key, rule in grammar.rules.items():
+            if not nullable[key] and left_calls(rule, grammar, nullable)[1]:
+                nullable[key] = changed = True
+    calls = dict((key, left_calls(rule, grammar, nullable)[0])
+                 for key, rule in grammar.rules.items())
+    recursive = set()
+    for key in calls:
+        seen, todo = set(), list(calls[key])
+        while todo:
+            other = todo.pop()
+            if other == key:
+                recursive.add(key)
+                break
+            if other not in seen and other in calls:
+                seen.add(other)
+                todo.extend(calls[other])
+    return recursive
+
+
+def reentered(calls, key, pos):
+    """Whether rule key is already active at pos on the current input.
+    Rule frames are ordered by position, so only the frames at pos on top
+    of the call stack have to be checked."""
+    while calls is not None:
+        frame = calls[0]
+        if frame[0] == INPUT_FRAME:
+            return False
+        if frame[0] == RULE_FRAME:
+            if frame[3] < pos:
+                return False
+            if frame[2] == key:
+                return True
+        calls = calls[1]
+    return False
+
+
+def execute(code, value, position):
+    """Run code on value from position. Yields (result, position) pairs."""
+    pc, pos, values, calls = 0, position, None, None
+    backtrack = []
+    while True:
+        op, arg = code[pc]
+        pc += 1
+        if op == SET:
+            if pos < len(value) and value[pos] in arg:
+                values = value[pos], values
+                pos += 1
+                continue
+        elif op == BYTES:
+            if pos < len(value) and arg.accepts(value[pos], value):
+                values = value[pos], values
+                pos += 1
+                continue
+        elif op == ANY:
+            if pos < len(value):
+                values = value[pos], values
+                pos += 1
+                continue
+        elif op == LITERAL:
+            if arg.matches(value, pos):
+                values = arg.matched(value, pos), values
+                pos += len(arg.elements)
+                continue
+        elif op == ITEM:
+            if pos < len(value) and value[pos] == arg.element or \
+                    arg.octets is not None and is_binary(value) and \
+                    arg.matches(value, pos):
+                values = value[pos], values
+                pos += 1
+                continue
+        elif op == WHEN:
+            if pos < len(value) and arg(value[pos]):
+                values = value[pos], values
+                pos += 1
+                continue
+        elif op == CHOICE:
+            backtrack.append((arg, pos, value, values, calls, None, False))
+            continue
+        elif op == JUMP:
+            pc = arg
+            continue
+        elif op == CALL:
+            if not reentered(calls, arg[1], pos):
+                calls = (RULE_FRAME, pc, arg[1], pos), calls
+                pc = arg[0]
+                continue
+        elif op == RETURN:
+            pc = calls[0][1]
+            calls = calls[1]
+            continue
+        elif op == PUSH:
+            values = arg, values
+            continue
+        elif op == BIND:
+            backtrack.append((pc, pos, value, values[1], calls,
+                              arg(values[0])(value, pos), False))
+        elif op == UNIFY:
+            backtrack.append((pc, pos, value, values[1], calls,
+                              arg.unify(values[0]), True))
+        elif op == GENERATE:
+            backtrack.append((pc, pos, value, values, calls,
+                              arg(value, pos), False))
+        elif op == MARK:
+            calls = (MARK_FRAME, len(backtrack)), calls
+            continue
+        elif op == COMMIT:
+            del backtrack[calls[0][1]:]
+            calls = calls[1]
+            continue
+        elif op == CUT:
+            del backtrack[calls[0][1]:]
+            calls = calls[1]
+            if isinstance(value, Stream):
+                value.commit(pos)
+            continue
+        elif op == PARTIAL_COMMIT:
+            backtrack[-1] = (backtrack[-1][0], pos, value, values, calls, None, False)
+            pc = arg
+            continue
+        elif op == NEWLIST:
+            values = [], values
+            continue
+        elif op == APPEND:
+            values[1][0].append(values[0])
+            values = values[1]
+            continue
+        elif op == CONCAT:
+            values = concatenate(values[1][0], values[0]), values[1][1]
+            continue
+        elif op == NONEMPTY:
+            if values[0]:
+                continue
+        elif op == SAVEPOS:
+            values = pos, values
+            continue
+        elif op == DROP:
+            values = values[1]
+            continue
+        elif op == SETPOS:
+            pos, values = values
+            continue
+        elif op == ENTER:
+            calls = (INPUT_FRAME, value, pos), calls
+            value, values = values
+            pos = 0
+            continue
+        elif op == LEAVE:
+            value, pos = calls[0][1:]
+            calls = calls[1]
+            continue
+        elif op == END:
+            if pos == len(value):
+                values = End(pos), values
+                continue
+        elif op == HALT:
+            yield values[0], pos
+        # FAIL and every failed instruction end up here
+        while backtrack:
+            pc, pos, value, values, calls, generator, unifying = backtrack[-1]
+            if generator is None:
+                backtrack.pop()
+                break
+            try:
+                result = next(generator)
+            except StopIteration:
+                backtrack.pop()
+                continue
+            if unifying:
+                values = result, values
+            else:
+                values = result[0], values
+                pos = result[1]
+            break
+        else:
+            return
@@ -76,6 +76,16 @@ class ItemTest(ParseTest):
             item(42), [42],
             42, 1)
 
+    def test_item_engines(self):
+        from peg.vm import Program
+        p = item('a')
+        self.assertEqual(Item, type(p))
+        for value in 'a', 'b', '', bytearray('a'), [97]:
+            expected = list(Literal(['a'])(value, 0))
+            self.assertEqual(expected, list(p(value, 0)))
+            self.assertEqual(expected, list(p.compile()(value, 0)))
+            self.assertEqual(expected, list(Program.expression(p).run(value, 0)))
+
 
 class ChainTest(ParseTest):
     #
@@ -93,6 +103,13 @@ class ChainTest(ParseTest):
     def test_chain_no_match(self):
         self.assertFail(item('a') + item('b'), 'bb')
 
+    def test_chain_sequence(self):
+        p = element + element + (element + element) + item('x') + item('y')
+        self.assertEqual(Sequence, type(p))
+        self.assertEqual(4, len(p.parts))
+        self.assertEqual(Literal(['x', 'y']).elements, p.parts[-1].elements)
+        self.assertParse(p, 'abcdxy', 'abcdxy', 6)
+
 
 
 class BranchTest(ParseTest):
@@ -165,6 +182,15 @@ class WhenTest(ParseTest):
         self.assertFail(
             when(lambda x: x % 2 == 0), [21])
 
+    def test_when_engines(self):
+        from peg.vm import Program
+        p = star(when(lambda x: x % 2 == 0))
+        for value in [2, 4, 5], [1], []:
+            expected = list(p(value, 0))
+            self.assertEqual(expected, list(p.compile()(value, 0)))
+            self.assertEqual(expected, list(Program.expression(p).run(value, 0)))
+            self.assertEqual(expected[0], p.match(value, 0))
+
 
 class SomeManyTest(ParseTest):
 
@@ -211,5 +237,1588 @@ class SetTest(ParseTest):
         )
 
 
+class MemoTest(ParseTest):
+
+    def grammar(self, memo):
+        g = Grammar('s', memo)
+        g['s'] = (g['a'] + item('x')) | (g['a'] + item('y'))
+        g['a'] = some(item('a')) >> Make(''.join)
+        return g
+
+    def test_memo_result(self):
+        self.assertParse(self.grammar(Memo()), 'aay', 'aay', 3)
+
+    def test_memo_hits(self):
+        memo = Memo()
+        for result in self.grammar(memo)('aay'):
+            break
+        self.assertEqual(1, memo.hits)
+
+    def test_memo_same_results(self):
+        plain = list(self.grammar(None)('aaay'))
+        cached = list(self.grammar(Memo())('aaay'))
+        self.assertEqual(plain, cached)
+
+    def test_memo_lazy(self):
+        memo = Memo()
+        g = Grammar('s', memo)
+        g['s'] = g['a']
+        g['a'] = many(item('a'))
+        for result in g('aaaa'):
+            break
+        entry = memo.table.values()[-1]
+        self.assertEqual(1, len(entry.results))
+        self.assertTrue(entry.generator is not None)
+
+    def test_memo_lru(self):
+        memo = Memo(size=1)
+        g = Grammar('s', memo)
+        g['s'] = g['a'] + g['b']
+        g['a'] = item('a')
+        g['b'] = item('b')
+        list(g('ab'))
+        self.assertEqual(1, len(memo))
+        self.assertTrue(memo.evictions > 0)
+
+    def test_memo_parse_policy(self):
+        memo = Memo(size=1, policy='parse')
+        g = self.grammar(memo)
+        list(g('aay'))
+        list(g('aax'))
+        self.assertEqual(1, len(memo))
+        self.assertEqual(0, memo.evictions)
+
+    def test_memo_reset(self):
+        memo = Memo()
+        g = self.grammar(memo)
+        list(g('aay'))
+        value = list('aax')
+        self.assertEqual([('aax', 3)], list(g(value)))
+        self.assertEqual([value], [v for v, count in memo.inputs.values()])
+        value[2] = 'y'
+        self.assertEqual([('aay', 3)], list(g(value)))
+        doc = Document('aay')
+        list(g(doc))
+        list(g('aax'))
+        self.assertEqual(set([id(doc), id('aax')]), set(memo.inputs))
+
+    def test_memo_unknown_policy(self):
+        self.assertRaises(ValueError, Memo, 10, 'fifo')
+
+
+class IncrementalTest(ParseTest):
+
+    def grammar(self):
+        g = Grammar('doc', Memo())
+        g['doc'] = (g['line'] ** (lambda line:
+                    g['doc'] ** (lambda rest: Return([line] + rest)))) | \
+                   (EndOfInput() ** (lambda end: Return([])))
+        g['line'] = g['name'] + item('\n')
+        g['name'] = capture(skip(Set('abcdefghijklmnopqrstuvwxyz')))
+        return g
+
+    def first(self, g, value):
+        return list(g(value))[0][0]
+
+    def test_edit_result(self):
+        g = self.grammar()
+        doc = Document('ab\ncd\nef\n')
+        self.assertEqual(['ab\n', 'cd\n', 'ef\n'], self.first(g, doc))
+        g.edit(doc, 4, 1, 'xyz')
+        self.assertEqual(['ab\n', 'cxyz\n', 'ef\n'], self.first(g, doc))
+
+    def test_edit_reuses(self):
+        g = self.grammar()
+        g['doc'] = star(g['line'])
+        doc = Document(''.join('line%s\n' % chr(97 + i % 26) for i in xrange(40)))
+        self.first(g, doc)
+        misses = g.memo.misses
+        g.edit(doc, 6 * 20, 4, 'word')
+        self.assertEqual('wordu\n', self.first(g, doc)[20])
+        self.assertEqual(3, g.memo.misses - misses)
+
+    def test_edit_shifts(self):
+        g = self.grammar()
+        g['doc'] = g['line'] + g['name']
+        doc = Document('ab\ncd')
+        list(g(doc))
+        g.edit(doc, 0, 0, 'xy')
+        for result, pos in g['name'](doc, 5):
+            self.assertEqual('cd', result)
+            self.assertEqual((5, 7), (result.start, result.end))
+        self.assertEqual(1, g.memo.hits)
+
+    def test_edit_moves_lazily(self):
+        g = self.grammar()
+        g['doc'] = star(g['line'])
+        doc = Document(''.join('line%s\n' % chr(97 + i % 26) for i in xrange(40)))
+        self.first(g, doc)
+        entries = len(g.memo)
+        calls = []
+        shifted = MemoEntry.shifted
+        MemoEntry.shifted = lambda self, value, delta: \
+            calls.append(delta) or shifted(self, value, delta)
+        try:
+            g.edit(doc, 1, 0, 'ab')
+            self.assertEqual([], calls)
+            self.assertEqual(entries - 2, len(g.memo))
+            result, pos = next(g['line'](doc, 6 * 30 + 2))
+            self.assertEqual('linee\n', result)
+            self.assertEqual(6 * 31 + 2, pos)
+            self.assertEqual([2], calls)
+        finally:
+            MemoEntry.shifted = shifted
+
+    def test_edit_at_end(self):
+        g = Grammar('s', Memo())
+        g['s'] = g['name'] ** (lambda name: EndOfInput())
+        g['name'] = capture(skip(Set('ab')))
+        doc = Document('ab')
+        self.assertEqual([2], [pos for result, pos in g(doc)])
+        g.edit(doc, 2, 0, 'a')
+        self.assertEqual([3], [pos for result, pos in g(doc)])
+
+    def test_edit_resumes_entries(self):
+        g = Grammar('s', Memo())
+        g['s'] = many(g['w'] + item(';'))
+        g['w'] = capture(plus(Set('ab'))) | \
+            (g['w'] + item('-') + capture(plus(Set('ab'))))
+        doc = Document('a;a-b;b;')
+        first = g(doc)
+        self.assertEqual(['a;', 'a-b;', 'b;'], next(first)[0])
+        self.assertEqual([8, 6, 2, 0], [pos for result, pos in g(doc)])
+        next(g(doc))
+        g.edit(doc, 0, 1, 'b')
+        self.assertEqual(['b;', 'a-b;', 'b;'], next(g(doc))[0])
+
+    def test_edit_outside(self):
+        self.assertRaises(IndexError, Document('ab').replace, 1, 2, '')
+
+
+class LeftRecursionTest(ParseTest):
+
+    def grammar(self, memo=None):
+        g = Grammar('e', memo)
+        g['e'] = (g['e'] + item('-') + g['n']) | g['n']
+        g['n'] = Set('0123456789')
+        return g
+
+    def test_left_recursion(self):
+        self.assertParse(self.grammar(), '1-2-3', '1-2-3', 5)
+
+    def test_left_recursion_all_results(self):
+        positions = [pos for result, pos in self.grammar()('1-2-3')]
+        self.assertEqual([5, 3, 1], positions)
+
+    def test_left_recursion_memo(self):
+        self.assertParse(self.grammar(Memo()), '1-2-3', '1-2-3', 5)
+
+    def test_left_associative(self):
+        g = Grammar('e')
+        g['e'] = g['e'] ** (lambda a:
+                 item('-') ** (lambda op:
+                 g['n'] ** (lambda b: Return(a - b)))) | g['n']
+        g['n'] = Set('0123456789') >> Make(int)
+        self.assertParse(g, '9-2-3', 4, 5)
+
+    def test_base_case_first(self):
+        g = Grammar('e')
+        g['e'] = g['n'] | (g['e'] + item('-') + g['n'])
+        g['n'] = Set('0123456789')
+        results = list(g('1-2-3'))
+        self.assertEqual([('1', 1), ('1-2', 3), ('1-2-3', 5)], results)
+
+    def test_indirect_left_recursion(self):
+        g = Grammar('a', Memo())
+        g['a'] = g['b'] | item('x')
+        g['b'] = g['a'] + item('y')
+        self.assertParse(g, 'xyy', 'xyy', 3)
+
+
+class ContextTest(ParseTest):
+
+    def grammar(self):
+        g = Grammar('e')
+        g['e'] = (g['e'] + item('-') + g['n']) | g['n']
+        g['n'] = Set('0123456789')
+        return g
+
+    def test_interleaved_parses(self):
+        g = self.grammar()
+        text = '1-2-3-4'
+        expected = list(g(text))
+        first, second = g(text), g(text)
+        results = []
+        for a, b in zip(first, second):
+            results.append((a, b))
+        self.assertEqual(zip(expected, expected), results)
+
+    def test_nested_parse(self):
+        g = self.grammar()
+        h = Grammar('s')
+        h['s'] = g['e'] ** (lambda e: Return(list(g(e))))
+        self.assertEqual([('1-2', 3), ('1', 1)], next(h('1-2'))[0])
+
+    def test_threads(self):
+        from multiprocessing.pool import ThreadPool
+        g = self.grammar()
+        texts = ['-'.join('123456789'[:n]) for n in range(1, 10)] * 5
+        expected = [list(g(text)) for text in texts]
+        pool = ThreadPool(4)
+        try:
+            self.assertEqual(expected, pool.map(lambda text: list(g(text)), texts))
+        finally:
+            pool.close()
+
+    def test_threads_memo(self):
+        from multiprocessing.pool import ThreadPool
+        g = self.grammar()
+        g.memo = Memo()
+        text = '-'.join('123456789' * 20)
+        expected = list(g(text))
+        pool = ThreadPool(4)
+        try:
+            self.assertEqual([expected] * 8,
+                             pool.map(lambda text: list(g(text)), [text] * 8))
+        finally:
+            pool.close()
+
+    def test_variables_per_parse(self):
+        v = Variable()
+        g = Grammar('s')
+        g['s'] = (element >> v) + (element >> v)
+        first = g('aa')
+        self.assertEqual(('aa', 2), next(first))
+        self.assertEqual('a', v.unpack())
+        # v is still bound to 'a' in the first parse
+        self.assertEqual([('bb', 2)], list(g('bb')))
+        self.assertEqual([], list(first))
+        self.assertFalse(v.bound)
+
+    def test_variables_bound_outside(self):
+        v = Variable()
+        v.bind_to('x')
+        g = Grammar('s')
+        g['s'] = element >> v
+        self.assertFail(g, 'y')
+        self.assertParse(g, 'x', 'x', 1)
+        v.unbind()
+        self.assertParse(g, 'y', 'y', 1)
+
+    def test_reference_outside_grammar(self):
+        g = self.grammar()
+        self.assertEqual([5, 3, 1], [pos for r, pos in g['e']('1-2-3', 0)])
+
+
+class CompileTest(ParseTest):
+
+    def assertSame(self, parser, value):
+        expected = [(repr(r), pos) for r, pos in parser(value, 0)]
+        compiled = [(repr(r), pos) for r, pos in parser.compile()(value, 0)]
+        self.assertEqual(expected, compiled)
+
+    def test_compile_branch(self):
+        self.assertSame(Set('ab') | element | Return('x') | zero, 'a')
+
+    def test_compile_chain(self):
+        self.assertSame(item('a') + item('b') + (many(Set('abc')) >> Make(''.join)),
+                        'abcab')
+
+    def test_compile_long_chain(self):
+        p = item('a')
+        for i in range(40):
+            p = p + item('a')
+        self.assertSame(p, 'a' * 41)
+
+    def test_compile_cut(self):
+        self.assertSame(-(Return(21) | Return(42)) + element, [1])
+
+    def test_compile_repeat(self):
+        self.assertSame(plus(Set('ab')) | star(item('c')), 'abc')
+
+    def test_compile_inside(self):
+        self.assertSame(element[element + element] & element, [['a', 'b']])
+
+    def test_compile_unify(self):
+        x = Variable()
+        self.assertSame((Set('ab') >> x) + (Set('ab') >> x), 'aa')
+
+    def test_compile_end(self):
+        self.assertSame(EndOfInput() | (element & EndOfInput()), '')
+
+    def test_compile_cached(self):
+        p = item('a')
+        self.assertTrue(p.compile() is p.compile())
+
+    def test_compile_grammar(self):
+        g = Grammar('e')
+        g['e'] = (g['e'] + item('-') + g['n']) | g['n']
+        g['n'] = Set('0123456789')
+        expected = list(g('1-2-3'))
+        self.assertEqual(expected, list(g.compile()('1-2-3')))
+
+    def test_compile_redefine(self):
+        g = Grammar('s')
+        g['s'] = item('a')
+        g.compile()
+        g['s'] = item('b')
+        self.assertParse(g, 'b', 'b', 1)
+
+    def test_compile_zero(self):
+        self.assertEqual([], list(zero.compile()('a', 0)))
+        self.assertEqual([([], 0)], list(star(zero).compile()('a', 0)))
+        self.assertEqual([], list((zero + item('a')).compile()('a', 0)))
+
+    def test_compile_optimized_zero_rule(self):
+        g = Grammar('s')
+        g['s'] = g['kw'] | item('b')
+        g['kw'] = zero | (zero + item('a'))
+        g.optimize().compile()
+        self.assertEqual([('b', 1)], list(g('b')))
+
+
+class MachineTest(ParseTest):
+
+    def assertSame(self, parser, value):
+        from peg.vm import Program
+        expected = [(repr(r), pos) for r, pos in parser(value, 0)]
+        program = Program.expression(parser)
+        self.assertEqual(expected, [(repr(r), pos) for r, pos in program.run(value, 0)])
+
+    def test_vm_branch(self):
+        self.assertSame(Set('ab') | element | Return('x') | zero, 'a')
+
+    def test_vm_bind(self):
+        self.assertSame(item('a') + item('b') + (many(Set('abc')) >> Make(''.join)),
+                        'abcab')
+
+    def test_vm_cut(self):
+        self.assertSame(-(Return(21) | Return(42)) + element, [1])
+
+    def test_vm_repeat(self):
+        self.assertSame((plus(Set('ab')) | star(item('c'))) & element, 'abc')
+
+    def test_vm_inside(self):
+        self.assertSame(element[element + element] | element, [['a', 'b']])
+
+    def test_vm_unify(self):
+        x = Variable()
+        self.assertSame((Set('ab') >> x) + (Set('ab') >> x), 'aa')
+
+    def test_vm_end(self):
+        self.assertSame(EndOfInput() | (element & EndOfInput()), '')
+
+    def test_vm_grammar(self):
+        g = Grammar('s', engine='vm')
+        g['s'] = (g['a'] + g['s']) | g['a']
+        g['a'] = Set('ab')
+        self.assertEqual([('abb', 3), ('ab', 2), ('a', 1)], list(g('abb')))
+
+    def test_vm_long_repeat(self):
+        from peg.vm import Program, PARTIAL_COMMIT
+        g = Grammar('s', engine='vm')
+        g['s'] = star(item('a'))
+        ops = [op for op, arg in Program.rules(g).code]
+        self.assertTrue(PARTIAL_COMMIT in ops)
+        self.assertParse(g, 'a' * 10000, ['a'] * 10000, 10000)
+
+    def test_vm_left_recursion(self):
+        for engine in 'generator', 'vm':
+            g = Grammar('e', engine=engine)
+            g['e'] = (g['e'] + item('-') + g['n']) | g['n']
+            g['n'] = Set('0123456789')
+            self.assertEqual([('1-2-3', 5), ('1-2', 3), ('1', 1)],
+                             list(g('1-2-3')))
+        g = Grammar('a', engine='vm')
+        g['a'] = g['b'] | item('x')
+        g['b'] = (Return('') + g['a']) + item('y')
+        g['c'] = g['b'] + g['c']
+        from peg.vm import left_recursive
+        self.assertEqual(set(['a', 'b']), left_recursive(g))
+        self.assertParse(g, 'xyy', 'xyy', 3)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, Grammar, 's', None, 'jit')
+
+
+class LiteralTest(ParseTest):
+
+    def test_literal(self):
+        self.assertParse(literal('while'), 'while x', 'while', 5)
+
+    def test_literal_fail(self):
+        self.assertFail(literal('while'), 'whilx')
+
+    def test_literal_too_short(self):
+        self.assertFail(literal('while'), 'whi')
+
+    def test_literal_list(self):
+        self.assertParse(literal([1, 2]), [1, 2, 3], 3, 2)
+
+    def test_literal_tuple(self):
+        self.assertParse(literal('ab'), ('a', 'b'), 'ab', 2)
+
+    def test_literal_position(self):
+        for result, pos in literal('if')('x if', 2):
+            self.assertEqual(('if', 4), (result, pos))
+
+    def test_items_fused(self):
+        p = item('i') + item('f')
+        self.assertTrue(isinstance(p, Literal))
+        self.assertEqual('if', p.text)
+
+    def test_literal_yields_input(self):
+        result, pos = next((item('a') + item('b'))(u'ab', 0))
+        self.assertEqual(unicode, type(result))
+        self.assertEqual([(True, 1)], list(item(1)([True], 0)))
+        self.assertParse(literal('ab'), ['a', 'b'], 'ab', 2)
+        self.assertParse(literal('ab'), bytearray('ab'), bytearray('ab'), 2)
+
+    def test_item_multichar_element(self):
+        self.assertFail(item('ab'), 'ab')
+        self.assertParse(item('ab'), ['ab'], 'ab', 1)
+
+    def test_literal_compiled(self):
+        self.assertParse((literal('do') | literal('if')).compile(), 'if', 'if', 2)
+
+    def test_literal_vm(self):
+        g = Grammar('s', engine='vm')
+        g['s'] = literal('do') | literal('if')
+        self.assertParse(g, 'if', 'if', 2)
+
+
+class RegexTest(ParseTest):
+
+    def test_regex(self):
+        self.assertParse(Regex('[a-z]+'), 'abc1', 'abc', 3)
+
+    def test_regex_position(self):
+        for result, pos in Regex('[0-9]+')('ab12', 2):
+            self.assertEqual(('12', 4), (result, pos))
+
+    def test_regex_fail(self):
+        self.assertFail(Regex('[a-z]+'), '123')
+
+    def test_regex_list(self):
+        self.assertRaises(TypeError, list, Regex('a')(['a'], 0))
+
+
+class ScanTest(ParseTest):
+
+    def assertSame(self, scanned, plain, value):
+        self.assertTrue(isinstance(scanned, Scan))
+        self.assertFalse(isinstance(plain, Scan))
+        self.assertEqual(list(plain(value, 0)), list(scanned(value, 0)))
+
+    def test_star(self):
+        digits = Set('0123456789')
+        self.assertSame(star(digits), Repeat(digits, False), '123a')
+        self.assertSame(star(digits), Repeat(digits, False), 'a')
+
+    def test_plus(self):
+        digits = Set('0123456789')
+        self.assertSame(plus(digits), Repeat(digits, True), '123a')
+        self.assertSame(plus(digits), Repeat(digits, True), 'a')
+
+    def test_many(self):
+        ab = Set('ab')
+        self.assertSame(many(ab), some(ab | zero) | Return([]), 'aba')
+
+    def test_some(self):
+        ab = Set('ab')
+        self.assertSame(some(ab), some(ab | zero), 'abc')
+
+    def test_scan_list(self):
+        self.assertParse(many(Set([1, 2])), [1, 2, 3], [1, 2], 2)
+
+    def test_scan_special_characters(self):
+        self.assertParse(plus(Set('-]^\\')), '^]-\\x', ['^', ']', '-', '\\'], 4)
+
+    def test_scan_unicode(self):
+        self.assertParse(plus(Set('ab')), u'abc', [u'a', u'b'], 2)
+
+
+class ManyTest(ParseTest):
+
+    def recursive_many(self, p):
+        return self.recursive_some(p) | Return([])
+
+    def recursive_some(self, p):
+        return p ** (lambda a:
+                     self.recursive_many(p) ** (lambda aa:
+                                                Return([a] + aa)))
+
+    def test_many_all_results(self):
+        p = item('a') | (item('a') + item('a'))
+        self.assertEqual(list(self.recursive_many(p)('aaa', 0)),
+                         list(many(p)('aaa', 0)))
+
+    def test_some_all_results(self):
+        p = item('a') | (item('a') + item('a')) | item('b')
+        self.assertEqual(list(self.recursive_some(p)('aab', 0)),
+                         list(some(p)('aab', 0)))
+
+    def test_some_backtracks(self):
+        p = some(item('a') | item('b')) ** (lambda xs:
+            item('b') ** (lambda b: Return(xs)))
+        self.assertParse(p, 'abab', ['a', 'b', 'a'], 4)
+
+    def test_many_variables(self):
+        x = Variable()
+        p = many((item('a') | item('b')) >> x)
+        self.assertEqual(list(self.recursive_many((item('a') | item('b')) >> x)('ab', 0)),
+                         list(p('ab', 0)))
+
+    def test_many_empty_match(self):
+        self.assertParse(many(Return(1)), 'a', [], 0)
+
+    def test_many_long(self):
+        data = [1] * 100000
+        self.assertParse(many(item(1)), data, data, len(data))
+
+
+class RepeatModeTest(ParseTest):
+
+    def test_skip(self):
+        self.assertParse(skip(item(' ')) + item('x'), '  x', 'x', 3)
+
+    def test_skip_after(self):
+        self.assertParse(item('x') + skip(item(' ')), 'x  ', 'x', 3)
+
+    def test_count(self):
+        self.assertParse(count(item(1)), [1, 1, 2], 2, 2)
+
+    def test_span(self):
+        self.assertEqual([((1, 3), 3)], list((skip(item('x')) + span(item('y')))('xyy', 0)))
+
+    def test_scan_modes(self):
+        spaces = Set(' \t')
+        self.assertTrue(isinstance(count(spaces), Scan))
+        self.assertParse(count(spaces), ' \t x', 3, 3)
+        self.assertParse(skip(spaces) + item('x'), ' \t x', 'x', 4)
+
+    def test_plus_count(self):
+        self.assertFail(Repeat(item(1), True, 'count'), [2])
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, Repeat, item(1), True, 'sum')
+
+    def test_modes_compiled(self):
+        for mode in Repeat.modes:
+            p = Repeat(item('a') | item('b'), True, mode)
+            self.assertEqual(list(p('abc', 0)), list(p.compile()('abc', 0)))
+
+
+class CaptureTest(ParseTest):
+
+    def test_capture(self):
+        for result, pos in capture(many(Set('ab')))('abc', 0):
+            self.assertTrue(isinstance(result, Span))
+            self.assertEqual('ab', result.unpack())
+            break
+
+    def test_adjacent_spans(self):
+        data = 'if x'
+        p = capture(literal('if')) + capture(item(' ')) + capture(element)
+        for result, pos in p(data, 0):
+            self.assertTrue(isinstance(result, Span))
+            self.assertTrue(result.value is data)
+            self.assertEqual((0, 4), (result.start, result.end))
+
+    def test_distant_spans(self):
+        p = capture(item('a')) + skip(item(' ')) + capture(item('b'))
+        self.assertParse(p, 'a b', 'ab', 3)
+
+    def test_make_unpacks(self):
+        self.assertParse(capture(plus(Set('0123456789'))) >> Make(int), '42', 42, 2)
+
+    def test_variable_unpacks(self):
+        v = Variable()
+        for result, pos in (capture(item('a') + item('b')) >> v)('ab', 0):
+            self.assertEqual('ab', v.unpack())
+
+    def test_inside_span(self):
+        p = capture(literal('abc'))[literal('ab') + Regex('c')]
+        self.assertParse(p, 'abc', 'abc', 3)
+
+    def test_scan_span(self):
+        p = capture(literal('xab'))[skip(item('x')) + count(Set('ab'))]
+        self.assertParse(p, 'xabb', 2, 3)
+
+    def test_span_slice(self):
+        span = Span('abcdef', 1, 5)
+        self.assertEqual('bcde', span)
+        self.assertEqual('cd', span[1:3])
+        self.assertEqual('e', span[-1])
+        self.assertRaises(IndexError, lambda: span[4])
+
+    def test_span_view(self):
+        self.assertEqual('bc', Span('abcd', 1, 3).view().tobytes())
+
+
+class BinaryTest(ParseTest):
+
+    def mapped(self, data):
+        import mmap, tempfile
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.flush()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def test_set_bytearray(self):
+        self.assertParse(Set('ab'), bytearray('b'), ord('b'), 1)
+        self.assertFail(Set('ab'), bytearray('c'))
+
+    def test_set_int_choices(self):
+        self.assertParse(Set([ord('a')]), self.mapped('a'), 'a', 1)
+        self.assertFail(Set([ord('a')]), 'a')
+
+    def test_literal_bytearray(self):
+        self.assertParse(literal('GET'), bytearray('GET /'), 'GET', 3)
+        self.assertParse(item(0x20), bytearray(' '), 0x20, 1)
+        self.assertFail(literal('GET'), bytearray('GE'))
+
+    def test_literal_mmap(self):
+        self.assertParse(literal('GET') + item(' '), self.mapped('GET /'), 'GET ', 4)
+
+    def test_scan_binary(self):
+        digits = Set('0123456789')
+        self.assertParse(count(digits), bytearray('123x'), 3, 3)
+        self.assertParse(plus(digits), bytearray('12'), [ord('1'), ord('2')], 2)
+        self.assertParse(span(digits), self.mapped('123x'), (0, 3), 3)
+
+    def test_regex_mmap(self):
+        self.assertParse(Regex('[a-z]+'), self.mapped('abc1'), 'abc', 3)
+
+    def test_capture_mmap(self):
+        for result, pos in capture(skip(Set('abc')))(self.mapped('abcd'), 0):
+            self.assertEqual('abc', str(result.view()))
+            self.assertEqual(3, pos)
+
+    def test_compiled_binary(self):
+        p = ((Set('a') >> Make(chr)) + (Set([ord('b')]) >> Make(chr)) + literal('cd'))
+        self.assertParse(p.compile(), bytearray('abcd'), 'abcd', 4)
+
+    def test_machine_binary(self):
+        from peg.vm import Program
+        p = ((Set('a') >> Make(chr)) + (Set([ord('b')]) >> Make(chr)) + literal('cd'))
+        self.assertEqual([('abcd', 4)], list(Program.expression(p).run(bytearray('abcd'))))
+
+
+def is_vowel(c):
+    return c in 'aeiou'
+
+
+class PickleTest(ParseTest):
+
+    def grammar(self, **options):
+        g = Grammar('s', **options)
+        g['s'] = star(g['word'] + -item(' '))
+        g['word'] = capture(when(is_vowel) + Regex('[a-z]*')) >> Make(str)
+        return g
+
+    def roundtrip(self, obj):
+        import pickle
+        return pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def test_pickle_grammar(self):
+        g = self.grammar()
+        self.assertEqual(list(g('ab eb ')), list(self.roundtrip(g)('ab eb ')))
+
+    def test_pickle_memo(self):
+        g = self.grammar(memo=Memo(size=10))
+        list(g('ab '))
+        copy = self.roundtrip(g)
+        self.assertEqual(0, len(copy.memo))
+        self.assertEqual(10, copy.memo.size)
+        self.assertEqual(list(g('ab ')), list(copy('ab ')))
+
+    def test_pickle_compiled(self):
+        g = self.grammar().compile()
+        copy = self.roundtrip(g)
+        self.assertTrue(copy.compiled)
+        self.assertEqual(list(g('ab ')), list(copy('ab ')))
+        p = self.roundtrip((item('a') + element).compile())
+        self.assertParse(p, 'ab', 'ab', 2)
+
+    def test_pickle_vm(self):
+        g = self.grammar(engine='vm')
+        list(g('ab '))
+        self.assertEqual(list(g('ab ')), list(self.roundtrip(g)('ab ')))
+
+    def test_pickle_structure(self):
+        p = self.roundtrip(type_of(list)[at(0)[get('real')]])
+        self.assertParse(p, [1], 1, 0)
+
+    def test_parse_many(self):
+        g = self.grammar()
+        inputs = ['ab ', 'eb ib ', 'x', 'o ']
+        expected = [list(g(value)) for value in inputs]
+        self.assertEqual(expected, g.parse_many(inputs, workers=2, chunksize=2))
+        self.assertEqual(expected, g.parse_many(inputs, workers=1))
+
+
+def build_cached_grammar():
+    BuildCount.count += 1
+    g = Grammar('s')
+    g['s'] = star(g['word'] + -item(' '))
+    g['word'] = capture(when(is_vowel) + Regex('[a-z]*')) >> Make(str)
+    return g.compile()
+
+def build_unpicklable_grammar():
+    g = Grammar('s')
+    g['s'] = star(element) >> Make(''.join)
+    return g
+
+def build_wide_grammar():
+    g = Grammar('s')
+    g['s'] = reduce(Branch, [item('a') + item(str(i)) for i in range(400)])
+    return g.compile()
+
+class Deep(object):
+    """Callable failing to pickle like a too deeply nested object"""
+
+    def __call__(self, result):
+        return result
+
+    def __reduce__(self):
+        raise RuntimeError('maximum recursion depth exceeded')
+
+def build_deep_grammar():
+    g = Grammar('s')
+    g['s'] = item('a') >> Make(Deep())
+    return g
+
+class BuildCount(object):
+    count = 0
+
+
+class CacheTest(ParseTest):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        BuildCount.count = 0
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_cache_lazy(self):
+        g = Grammar.cached(build_cached_grammar, self.directory)
+        self.assertEqual(0, BuildCount.count)
+        self.assertEqual([(['ab ', 'eb '], 6)], list(g('ab eb ')))
+        self.assertEqual(1, BuildCount.count)
+        self.assertEqual((['ab ', 'eb '], 6), g.parse('ab eb '))
+
+    def test_cache_warm(self):
+        list(Grammar.cached(build_cached_grammar, self.directory)('ab '))
+        g = Grammar.cached(build_cached_grammar, self.directory)
+        self.assertEqual(list(build_cached_grammar()('ab eb ')), list(g('ab eb ')))
+        self.assertEqual(2, BuildCount.count)
+        self.assertTrue(g.load().compiled)
+
+    def test_cache_key(self):
+        list(Grammar.cached(build_cached_grammar, self.directory)('ab '))
+        list(Grammar.cached(build_cached_grammar, self.directory, key=2)('ab '))
+        self.assertEqual(2, BuildCount.count)
+
+    def test_cache_proxy(self):
+        g = Grammar.cached(build_cached_grammar, self.directory)
+        self.assertTrue(g.rules is g.load().rules)
+        self.assertEqual('s', g.start)
+        self.assertTrue(g.compile() is g.load())
+        self.assertTrue(g.optimize() is g.load())
+        self.assertTrue(g.predict() is g.load())
+        self.assertRaises(ValueError, g.profile_report)
+        self.assertTrue(g.feed_parser().parser is g.load())
+
+    def test_cache_unpicklable(self):
+        import os
+        g = Grammar.cached(build_unpicklable_grammar, self.directory)
+        self.assertEqual(('ab', 2), g.parse('ab'))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_cache_wide(self):
+        import os
+        g = Grammar.cached(build_wide_grammar, self.directory)
+        self.assertEqual(('a5', 2), g.parse('a5'))
+        self.assertEqual(1, len(os.listdir(self.directory)))
+        g = Grammar.cached(build_wide_grammar, self.directory)
+        self.assertEqual(list(build_wide_grammar()('a5', 0)), list(g('a5')))
+
+    def test_cache_too_deep(self):
+        import os
+        g = Grammar.cached(build_deep_grammar, self.directory)
+        self.assertEqual(('a', 1), g.parse('a'))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_cache_corrupt(self):
+        from peg.cache import GrammarCache
+        cache = GrammarCache(self.directory)
+        with open(cache.path('broken'), 'wb') as f:
+            f.write('not a pickle')
+        self.assertEqual(None, cache.load('broken'))
+
+    def test_compiled_rules_pickle(self):
+        import pickle
+        g = build_cached_grammar()
+        copy = pickle.loads(pickle.dumps(g, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(sorted(g.compiled), sorted(copy.compiled))
+        self.assertEqual(list(g('ab eb ')), list(copy('ab eb ')))
+
+
+class ProfileTest(ParseTest):
+
+    def grammar(self):
+        g = Grammar('s', profile=True)
+        g['s'] = (g['a'] + g['b']) | (g['a'] + item('c'))
+        g['a'] = item('a')
+        g['b'] = item('b')
+        return g
+
+    def test_profile_counts(self):
+        g = self.grammar()
+        list(g('ac'))
+        stats = g.profile.stats()
+        self.assertEqual(2, stats['a']['calls'])
+        self.assertEqual(2, stats['a']['successes'])
+        self.assertEqual(2, stats['a']['results'])
+        self.assertEqual(2, stats['a']['backtracks'])
+        self.assertEqual(1, stats['b']['failures'])
+        self.assertEqual(1, stats['s']['results'])
+
+    def test_profile_times(self):
+        g = self.grammar()
+        list(g('ac'))
+        stats = g.profile.stats()
+        self.assertTrue(stats['s']['cumulative'] >= stats['a']['cumulative'])
+        self.assertTrue(stats['s']['cumulative'] >= stats['s']['self'] >= 0)
+
+    def test_profile_depth(self):
+        g = Grammar('r', profile=True)
+        g['r'] = (item('x') + g['r']) | item('y')
+        list(g('xxxy'))
+        self.assertEqual(4, g.profile.stats()['r']['depth'])
+
+    def test_profile_report(self):
+        g = self.grammar()
+        list(g('ab'))
+        report = g.profile_report()
+        self.assertTrue('backtracks' in report)
+        self.assertEqual(5, len(report.splitlines()))
+
+    def test_profile_parse(self):
+        g = self.grammar()
+        self.assertEqual(('ac', 2), g.parse('ac'))
+        stats = g.profile.stats()
+        self.assertEqual(1, stats['s']['calls'])
+        self.assertEqual(1, stats['s']['successes'])
+        self.assertEqual(2, stats['a']['calls'])
+        self.assertEqual(1, stats['b']['failures'])
+        self.assertEqual(0, stats['a']['backtracks'])
+        self.assertTrue(stats['s']['cumulative'] >= stats['a']['cumulative'])
+        g = Grammar('r', profile=True)
+        g['r'] = (item('x') + g['r']) | item('y')
+        g.parse('xxxy')
+        self.assertEqual(4, g.profile.stats()['r']['depth'])
+
+    def test_profile_threads(self):
+        from multiprocessing.pool import ThreadPool
+        g = Grammar('r', profile=True)
+        g['r'] = (item('x') + g['r']) | item('y')
+        list(g('x' * 20 + 'y'))
+        once = g.profile.stats()['r']
+        g.profile.clear()
+        pool = ThreadPool(4)
+        try:
+            pool.map(lambda i: list(g('x' * 20 + 'y')), range(40))
+        finally:
+            pool.close()
+        stats = g.profile.stats()['r']
+        self.assertEqual(40 * once['calls'], stats['calls'])
+        self.assertEqual(40 * once['results'], stats['results'])
+        self.assertEqual(21, stats['depth'])
+        self.assertTrue(stats['cumulative'] >= stats['self'] >= 0)
+
+    def test_profile_off(self):
+        g = Grammar('s')
+        self.assertEqual(None, g.profile)
+        self.assertRaises(ValueError, g.profile_report)
+
+
+class Counted(Expression):
+    """Counts the calls of p"""
+
+    def __init__(self, p):
+        self.p = p
+        self.calls = 0
+
+    def __call__(self, value, position):
+        self.calls += 1
+        return self.p(value, position)
+
+
+class DispatchTest(ParseTest):
+
+    def keywords(self):
+        return literal('if') | literal('in') | item('x') | literal('else') | \
+            (Set('0123456789') >> Make(int))
+
+    def test_first(self):
+        from peg.prediction import first, END
+        # byte valued elements are listed in both spellings
+        self.assertEqual(frozenset('ix') | frozenset([105, 120]),
+                         first(literal('if') | item('x')))
+        self.assertEqual(frozenset([301, 302]), first(Set([301, 302]) + item(303)))
+        self.assertEqual(frozenset([END]), first(EndOfInput()))
+        self.assertEqual(None, first(element | item(301)))
+        self.assertEqual(None, first(star(item(301))))
+        self.assertEqual(frozenset([301]), first(plus(item(301))))
+        self.assertEqual(frozenset([302]), first(Both(Set([301, 302]), Set([302, 303]))))
+
+    def test_first_rules(self):
+        from peg.prediction import first
+        g = Grammar('s')
+        g['s'] = g['a'] | item(303)
+        g['a'] = (g['a'] + item(302)) | item(301)
+        self.assertEqual(None, first(g['a']))
+        g['a'] = item(301) + g['s']
+        self.assertEqual(frozenset([301, 303]), first(g['s']))
+
+    def test_dispatch_results(self):
+        from peg.prediction import predict, Dispatch
+        p = self.keywords()
+        q = predict(p)
+        self.assertTrue(isinstance(q, Dispatch))
+        for text in ['if', 'in', 'x', 'else', '7', 'y', '', 'i']:
+            self.assertEqual(list(p(text, 0)), list(q(text, 0)))
+
+    def test_dispatch_order(self):
+        from peg.prediction import predict
+        p = (item('a') >> Make(tuple)) | (element >> Make(str.upper)) | \
+            literal('ab') | Return('none')
+        q = predict(p)
+        self.assertEqual(list(p('ab', 0)), list(q('ab', 0)))
+        self.assertEqual([('B', 1), ('none', 0)], list(q('b', 0)))
+        self.assertEqual([('none', 0)], list(q('', 0)))
+
+    def test_dispatch_skips_arms(self):
+        from peg.prediction import predict
+        arms = [Counted(literal(w)) for w in ['if', 'in', 'else', 'while']]
+        arms[0].single = True
+        p = predict(Both(item('i'), arms[0]) | Both(item('i'), arms[1]) |
+                    Both(item('e'), arms[2]) | Both(item('w'), arms[3]))
+        self.assertParse(p, 'while', 'while', 5)
+        self.assertEqual([0, 0, 0, 1], [arm.calls for arm in arms])
+
+    def test_dispatch_end(self):
+        from peg.prediction import predict
+        p = predict(item('a') | item('b') | EndOfInput() | item('c'))
+        self.assertEqual([0], [pos for r, pos in p('', 0)])
+        self.assertParse(p, 'c', 'c', 1)
+
+    def test_dispatch_binary(self):
+        from peg.prediction import predict
+        p = predict(literal('if') | item('x') | literal('else'))
+        self.assertParse(p, bytearray('else'), 'else', 4)
+        self.assertParse(p, bytearray('x'), ord('x'), 1)
+
+    def test_dispatch_unhashable(self):
+        from peg.prediction import predict
+        p = predict(item('a') | item('b') | item('c'))
+        self.assertFail(p, [[1]])
+        self.assertParse(p, ['c'], 'c', 1)
+
+    def test_predict_grammar(self):
+        from peg.prediction import Dispatch
+        g = Grammar('s')
+        g['s'] = star(g['keyword'] + skip(item(' ')))
+        g['keyword'] = literal('if') | literal('in') | literal('else') | \
+            g['number']
+        g['number'] = capture(plus(Set('0123456789'))) >> Make(str)
+        text = 'if 12 else in '
+        expected = list(g(text))
+        g.predict()
+        self.assertTrue(isinstance(g.rules['keyword'], Dispatch))
+        self.assertEqual(expected, list(g(text)))
+        g.compile()
+        self.assertEqual(expected, list(g(text)))
+
+    def test_predict_nested(self):
+        from peg.prediction import predict, Dispatch
+        p = item('(') + (item('a') | item('b') | item('c')) + item(')')
+        self.assertEqual(list(p('(b)', 0)), list(predict(p)('(b)', 0)))
+        self.assertEqual(list(p('(b)', 0)), list(predict(p).compile()('(b)', 0)))
+
+
+class RangeTest(ParseTest):
+
+    def test_range(self):
+        digit = Range('0', '9')
+        self.assertParse(digit, '7', '7', 1)
+        self.assertFail(digit, 'a')
+        self.assertFail(digit, [7])
+        self.assertParse(Range(10, 20), [15], 15, 1)
+        self.assertFail(Range(10, 20), ['15'])
+        # classes within 0..255 are tested by their table only
+        self.assertEqual(frozenset(range(10, 21)), Range(10, 20).members)
+
+    def test_range_unicode(self):
+        letters = Range(u'\u0400', u'\u04ff')
+        self.assertEqual(1, len(letters.choices.intervals()))
+        self.assertParse(letters, u'\u0436', u'\u0436', 1)
+        self.assertFail(letters, u'z')
+        huge = Range(0, 10 ** 9)
+        self.assertParse(huge, [10 ** 8], 10 ** 8, 1)
+
+    def test_range_negative(self):
+        for p in Range(-10, 10), Range(-10, 300):
+            self.assertEqual([(-5, 1)], list(p([-5], 0)))
+            self.assertEqual([(5, 1)], list(p([5], 0)))
+            self.assertEqual([(-5, 1)], list(p.compile()([-5], 0)))
+            self.assertFail(p, [-11])
+        self.assertEqual(None, Range(-10, 10).octets)
+
+    def test_range_operators(self):
+        word = Range('a', 'z') | Range('A', 'Z') | Set('_')
+        self.assertTrue(isinstance(word.choices, Ranges))
+        self.assertEqual([('A', 'Z'), ('_', '_'), ('a', 'z')],
+                         word.choices.intervals())
+        consonants = Range('a', 'z') - Set('aeiou')
+        self.assertEqual(21, len(consonants.choices))
+        self.assertFail(consonants, 'e')
+        self.assertEqual(set('mn'), set((Range('a', 'n') & Range('m', 'z')).choices))
+        self.assertEqual(set('ah'), set((Range('a', 'g') ^ Range('b', 'h')).choices))
+        self.assertEqual(set('xyz'), set((Set('xyz0') & Range('a', 'z')).choices))
+        self.assertRaises(TypeError, lambda: Range('a', 'z') | Range(1, 2))
+
+    def test_range_scan(self):
+        identifier = capture(Range('a', 'z') + skip(Range('a', 'z') | Range('0', '9')))
+        self.assertTrue(isinstance(star(Range('a', 'z')), Scan))
+        self.assertParse(identifier >> Make(str), 'abc12+', 'abc12', 5)
+        self.assertParse(star(Range(u'\u0400', u'\u04ff')) >> Make(len),
+                         u'\u0436\u0436x', 2, 2)
+        self.assertParse(skip(Range('a', 'z')), bytearray('ab1'), Empty, 2)
+        self.assertParse(count(Range(1, 5)), [1, 2, 9], 2, 2)
+
+    def test_range_binary(self):
+        self.assertParse(Range('a', 'z'), bytearray('q'), ord('q'), 1)
+
+    def test_range_engines(self):
+        g = Grammar('s', engine='vm')
+        g['s'] = plus(Range('0', '9') | Range(u'\u0400', u'\u04ff'))
+        self.assertParse(g, u'1\u04002x', [u'1', u'\u0400', u'2'], 3)
+        p = Range('a', 'c') + Range('0', '9')
+        self.assertParse(p.compile(), 'b5', 'b5', 2)
+
+    def test_range_pickle(self):
+        import pickle
+        p = pickle.loads(pickle.dumps(Range('a', 'z') - Set('q')))
+        self.assertParse(p, 'r', 'r', 1)
+        self.assertFail(p, 'q')
+
+    def test_range_dispatch(self):
+        from peg.prediction import predict
+        p = predict(Range('a', 'f') | Range('0', '9') | item('_'))
+        self.assertParse(p, 'c', 'c', 1)
+        self.assertParse(p, u'c', u'c', 1)
+        self.assertParse(p, bytearray('5'), ord('5'), 1)
+        self.assertFail(p, 'z')
+
+
+def outcome(parser, value):
+    """Results of parser on value, or the type of error it raises"""
+    try:
+        return list(parser(value, 0))
+    except Exception as e:
+        return type(e)
+
+
+class OptimizeTest(ParseTest):
+
+    def same(self, p, *values):
+        q = p.optimize()
+        # binary input spells bytes as ints as well
+        values += tuple(bytearray(v) for v in values if isinstance(v, str))
+        from peg.vm import Program
+        for value in values:
+            expected = outcome(p, value)
+            self.assertEqual(expected, outcome(q, value))
+            self.assertEqual(expected, outcome(q.compile(), value))
+            self.assertEqual(expected, outcome(Program.expression(q).run, value))
+        return q
+
+    def test_fold_return(self):
+        q = self.same(Return(3) ** (lambda a: Return(a + 1)), 'x')
+        self.assertTrue(isinstance(q, Return))
+
+    def test_drop_zero(self):
+        q = self.same(zero | item('a') | zero, 'a', 'b')
+        self.assertTrue(isinstance(q, Literal))
+        self.assertTrue(isinstance((zero + item('a')).optimize(), Zero))
+        self.assertTrue(isinstance((zero ** (lambda a: item('a'))).optimize(), Zero))
+
+    def test_flatten_alternatives(self):
+        p = (literal('ab') | element) | (literal('a') | Return('x'))
+        q = self.same(p, 'ab', 'b', '')
+        self.assertEqual(4, len(q.arms))
+
+    def test_flatten_sequence(self):
+        p = element + element + (element + element) + element
+        q = self.same(p, 'abcde', 'abcd')
+        self.assertEqual(4, len(q.parts))
+        self.assertTrue(isinstance(q.parts[2], Sequence))
+
+    def test_sequence_backtracking(self):
+        p = many(item('a')) + star(item('a')) + \
+            ((item('b') >> Make(lambda b: [b])) | Return([]))
+        self.same(p, 'aab', 'aaa', '')
+
+    def test_fuse_literals(self):
+        q = self.same(element + item('b') + item('c'), 'abc', 'abd')
+        self.assertEqual(2, len(q.parts))
+
+    def test_merge_items(self):
+        q = self.same(item('a') | item('b') | Set('cd'), 'a', 'c', 'e')
+        self.assertEqual(Set, type(q))
+        q = self.same(item('a') | item('a') | item('b'), 'a', 'b')
+        self.assertEqual(2, len(q.arms))
+        q = self.same(item('a') | item(97) | item('b'), 'a', 'b')
+        self.assertEqual(2, len(q.arms))
+        q = self.same(item(1) | item(2), [1.0], [True], [2], [3])
+        self.assertEqual(Items, type(q))
+        self.assertEqual([(1, 1)], list(q([True], 0)))
+
+    def test_merge_sets(self):
+        # Set | Set merges as it is built, Alternatives keeps the arms
+        q = self.same(Alternatives([Set('ab'), Set('cd')]), 'a', 'c', 'e')
+        self.assertEqual(Set, type(q))
+        q = self.same(Alternatives([Range('a', 'f'), Range('x', 'z')]),
+                      'b', 'x', 'g')
+        self.assertEqual(Set, type(q))
+        q = self.same(Alternatives([Set('a'), Set([97])]), 'a')
+        self.assertEqual(2, len(q.arms))
+        q = self.same(Alternatives([Set('a'), Set(['bc'])]), 'a', ['bc'])
+        self.assertEqual(2, len(q.arms))
+
+    def test_merge_set_items(self):
+        q = self.same(Set('ab') | item('c') | item('d'), 'a', 'd', 'e')
+        self.assertEqual(Set, type(q))
+        q = self.same(item('x') | Set(['ab', 'cd']), 'x', ['ab'], ['x'])
+        self.assertEqual(Items, type(q))
+        q = self.same(Set(['ab']) | item('cd'), ['ab'], ['cd'], 'a')
+        self.assertEqual(Set, type(q))
+        q = self.same(Set('ab') | item('cd') | item(None),
+                      'a', ['cd'], [None], 'c')
+        self.assertEqual(Items, type(q))
+        q = self.same(Set(['a', 'xy']) | item('b'), 'a', 'b', ['xy'])
+        self.assertEqual(2, len(q.arms))
+        q = self.same(Set('ab') | item('b'), 'b')
+        self.assertEqual(2, len(q.arms))
+        q = self.same(Set('ab') | item(['c']), 'a', [['c']])
+        self.assertEqual(2, len(q.arms))
+
+    def test_share_subtrees(self):
+        p = (item('x') + element) | (element + item('x') + element)
+        q = p.optimize()
+        self.assertTrue(q.arms[0].parts[0] is q.arms[1].parts[1])
+
+    def test_optimize_grammar(self):
+        g = Grammar('e')
+        g['e'] = (g['e'] + item('-') + g['n']) | g['n']
+        g['n'] = item('0') | item('1') | item('2') | (item('(') + g['e'] + item(')'))
+        text = '1-(2-0)-1'
+        expected = list(g(text))
+        g.optimize()
+        self.assertEqual(expected, list(g(text)))
+        self.assertEqual(Alternatives, type(g.rules['n']))
+        self.assertEqual(Items, type(g.rules['n'].arms[0]))
+        g.compile()
+        self.assertEqual(expected, list(g(text)))
+
+
+class InternTest(ParseTest):
+
+    def test_no_dict(self):
+        for p in item('a'), Set('ab'), element + element, star(element), \
+                Variable(), Make(int), Span('ab', 0, 1):
+            self.assertFalse(hasattr(p, '__dict__'), type(p))
+        self.assertRaises(AttributeError, getattr, element, '_missing')
+
+    def test_pickle_slots(self):
+        import pickle, copy
+        p = (item('a') + Range('0', '9')) | (element >> Make(str))
+        for protocol in 0, pickle.HIGHEST_PROTOCOL:
+            q = pickle.loads(pickle.dumps(p, protocol))
+            self.assertEqual(list(p('a1', 0)), list(q('a1', 0)))
+        p.compile()
+        self.assertEqual(None, getattr(copy.copy(p), '_compiled', None))
+
+    def test_intern_shares(self):
+        p = (item('x') + Set('ab')) | (Set('ab') + item('x'))
+        q = p.intern()
+        self.assertTrue(q.p.parts[0] is q.q.parts[1])
+        self.assertTrue(q.p.parts[1] is q.q.parts[0])
+        self.assertTrue(item('x').intern() is q.p.parts[0])
+        self.assertEqual(list(p('xa', 0)), list(q('xa', 0)))
+
+    def test_intern_set_types(self):
+        sets = [Set([u'q']), Set(['q']), Set([1]), Set([True])]
+        interned = [p.intern() for p in sets]
+        self.assertEqual(4, len(set(map(id, interned))))
+        self.assertEqual([(ord('q'), 1)], list(interned[1](bytearray('q'), 0)))
+        self.assertFalse(Range(u'a', u'z').intern() is Range('a', 'z').intern())
+
+    def test_intern_grammars(self):
+        def build():
+            g = Grammar('s')
+            g['s'] = star(g['a'] | Set('-+'))
+            g['a'] = literal('ab') + when(str.isdigit)
+            return g
+        g, h = build().intern(), build()
+        self.assertFalse(g.rules['s'] is h.rules['s'])
+        h.intern()
+        self.assertTrue(g.rules['a'].parts[0] is h.rules['a'].parts[0])
+        self.assertEqual(list(build()('ab1-ab2', 0)), list(h('ab1-ab2')))
+
+    def test_table_weak(self):
+        import gc
+        from peg.interning import table
+        literal('interned and dropped').intern()
+        gc.collect()
+        self.assertFalse(any(isinstance(node, Literal) and
+                             node.elements == list('interned and dropped')
+                             for node in table.values()))
+
+
+class StreamTest(ParseTest):
+
+    def test_stream_file(self):
+        from StringIO import StringIO
+        stream = Stream(StringIO('if x'), chunk=2)
+        self.assertParse(literal('if') + item(' ') + element, stream, 'if x', 4)
+
+    def test_stream_chunks(self):
+        stream = Stream(iter(['ab', 'c', 'de']), chunk=1, lookahead=1)
+        self.assertParse(star(Set('abcde')) >> Make(''.join), stream, 'abcde', 5)
+
+    def test_stream_lists(self):
+        stream = Stream(iter([[1, 2], [3]]), chunk=1, lookahead=1)
+        self.assertParse(count(element), stream, 3, 3)
+
+    def test_stream_end(self):
+        stream = Stream(iter(['ab']), chunk=1, lookahead=1)
+        results = list((skip(element) + EndOfInput())(stream, 0))
+        self.assertEqual(1, len(results))
+        self.assertEqual(2, results[0][1])
+
+    def test_stream_bounded(self):
+        lines = ('record %d\n' % i for i in xrange(10000))
+        stream = Stream(lines, chunk=64)
+        line = -(skip(Set('record 0123456789')) + item('\n'))
+        for result, pos in count(line)(stream, 0):
+            self.assertEqual(10000, result)
+        self.assertTrue(len(stream.buffer) < 1024)
+
+    def test_stream_discarded(self):
+        stream = Stream(iter(['a' * 100]), chunk=10, lookahead=1)
+        for result in (-skip(item('a')))(stream, 0):
+            pass
+        self.assertRaises(IndexError, lambda: stream[0])
+
+    def test_stream_compiled(self):
+        stream = Stream(iter(['ab', 'c']), chunk=1, lookahead=1)
+        p = (-item('a') + Set('b') + item('c')).compile()
+        self.assertParse(p, stream, 'abc', 3)
+
+    def test_stream_machine(self):
+        from peg.vm import Program
+        stream = Stream(iter(['a' * 100]), chunk=10, lookahead=1)
+        program = Program.expression(-skip(item('a')) + EndOfInput())
+        self.assertEqual([100], [pos for result, pos in program.run(stream)])
+        self.assertRaises(IndexError, lambda: stream[0])
+
+    def test_stream_machine_repeat(self):
+        from peg.vm import Program
+        pairs = star(literal('ab')) >> Make(''.join)
+        p = (pairs + item('x')) | (pairs + item('y'))
+        stream = Stream(iter(['ab'] * 1000 + ['y']), chunk=16, lookahead=1)
+        self.assertEqual([2001], [pos for result, pos in
+                                  Program.expression(p).run(stream)])
+
+
+class FeedTest(ParseTest):
+
+    def grammar(self):
+        g = Grammar('message')
+        g['message'] = (capture(plus(Set('0123456789'))) >> Make(int)) + \
+            (item(';') >> Make(lambda separator: Empty))
+        return g
+
+    def test_feed(self):
+        parser = self.grammar().feed_parser()
+        self.assertEqual([], parser.feed('12'))
+        self.assertEqual([123], parser.feed('3;4'))
+        self.assertEqual([45], parser.feed('5;'))
+        self.assertEqual([6], parser.feed('6;7'))
+        self.assertEqual([7], parser.feed(';'))
+        self.assertEqual([], parser.close())
+
+    def test_feed_lists(self):
+        g = Grammar('pair')
+        g['pair'] = element + element
+        parser = g.feed_parser()
+        self.assertEqual([], parser.feed([1]))
+        self.assertEqual([3], parser.feed([2, 3]))
+        self.assertEqual([7], parser.feed([4]))
+        self.assertEqual([], parser.close())
+
+    def test_feed_left_recursion(self):
+        g = Grammar('e')
+        g['e'] = (g['e'] + item('-') + Set('0123456789')) | Set('0123456789')
+        parser = g.feed_parser()
+        self.assertEqual([], parser.feed('1-2'))
+        # more terms may follow until the input ends
+        self.assertEqual([], parser.feed('-3'))
+        self.assertEqual(['1-2-3'], parser.close())
+
+    def test_feed_error(self):
+        parser = self.grammar().feed_parser()
+        self.assertEqual([1], parser.feed('1;'))
+        self.assertRaises(ValueError, parser.feed, 'x;')
+        self.assertRaises(ValueError, parser.feed, '2;')
+
+    def test_feed_incomplete(self):
+        g = Grammar('pair')
+        g['pair'] = literal('ab')
+        parser = g.feed_parser()
+        self.assertEqual([], parser.feed('a'))
+        self.assertRaises(ValueError, parser.close)
+
+    def test_feed_end(self):
+        g = Grammar('s', Memo())
+        g['s'] = (g['word'] + (EndOfInput() >> Make(lambda end: '.'))) | \
+            (g['word'] + item(' '))
+        g['word'] = capture(plus(Set('abc'))) >> Make(str)
+        parser = g.feed_parser()
+        self.assertEqual(['ab '], parser.feed('ab c'))
+        self.assertEqual(['c.'], parser.close())
+
+    def test_feed_bounded_buffer(self):
+        parser = self.grammar().feed_parser()
+        for i in xrange(2000):
+            self.assertEqual([i], parser.feed('%d;' % i))
+        self.assertTrue(len(parser.stream.buffer) < 8192)
+        self.assertEqual([], parser.close())
+
+    def test_feed_abort(self):
+        parser = self.grammar().feed_parser()
+        self.assertEqual([1], parser.feed('1;23'))
+        parser.abort()
+        self.assertFalse(parser.worker.is_alive())
+        self.assertEqual(None, parser.stream.buffer)
+        self.assertRaises(ValueError, parser.feed, '4;')
+        parser.abort()
+        self.grammar().feed_parser().abort()
+
+    def test_feed_with(self):
+        with self.grammar().feed_parser() as parser:
+            self.assertEqual([1], parser.feed('1;2'))
+        self.assertFalse(parser.worker.is_alive())
+        with self.grammar().feed_parser() as parser:
+            self.assertEqual([1], parser.feed('1;2'))
+            self.assertEqual([2], parser.feed(';'))
+            self.assertEqual([], parser.close())
+
+
+class MatchTest(ParseTest):
+
+    def test_match_basics(self):
+        self.assertEqual(('a', 1), element.match('ab', 0))
+        self.assertEqual(None, element.match('', 0))
+        self.assertEqual(('ab', 2), literal('ab').match('abc', 0))
+        self.assertEqual(('b', 2), Set('ab').match('ab', 1))
+        self.assertEqual(None, zero.match('a', 0))
+        self.assertEqual((3, 0), Return(3).match('', 0))
+
+    def test_ordered_choice(self):
+        p = literal('a') | literal('ab')
+        self.assertEqual(('a', 1), p.match('ab', 0))
+        end = EndOfInput() >> Make(lambda end: '')
+        self.assertEqual(None, (p + end).match('ab', 0))
+        self.assertEqual(('ab', 2), next((p + end)('ab', 0)))
+
+    def test_greedy_repetition(self):
+        p = star(item('a')) + item('a')
+        self.assertEqual(None, p.match('aaa', 0))
+        self.assertEqual((['a', 'a'], 2), star(item('a')).match('aab', 0))
+        self.assertEqual((['a', 'b'], 2), many(element).match('ab', 0))
+        self.assertEqual((['a', 'b'], 2), some(element).match('ab', 0))
+        self.assertEqual(None, some(element).match('', 0))
+        self.assertEqual(many(Set('a')).match('aab', 0),
+                         many(item('a')).match('aab', 0))
+        g = Grammar('s')
+        g['s'] = many(item('a')) + some(item('b'))
+        self.assertEqual(next(g('aaab')), g.parse('aaab'))
+
+    def test_sequence(self):
+        p = Sequence([element, element, item('c')])
+        self.assertEqual(('abc', 3), p.match('abc', 0))
+        self.assertEqual(None, p.match('abd', 0))
+        self.assertEqual(('ab', 2), (element + element).match('ab', 0))
+
+    def test_filters(self):
+        v = Variable()
+        p = (element >> v) + item('-') + (element >> v)
+        self.assertEqual(('a-a', 3), self.grammar(p).parse('a-a'))
+        self.assertEqual(None, self.grammar(p).parse('a-b'))
+        self.assertEqual((1, 1), (Set('123') >> Make(int)).match('1', 0))
+
+    def grammar(self, p):
+        g = Grammar('s')
+        g['s'] = p
+        return g
+
+    def test_grammar_parse(self):
+        g = Grammar('s')
+        g['s'] = (item('(') + g['s'] + item(')')) | Return('')
+        self.assertEqual(('(())', 4), g.parse('(())'))
+        self.assertEqual(('()', 2), g.parse('())'))
+        self.assertEqual(None, self.grammar(item('x')).parse('y'))
+
+    def test_left_recursion(self):
+        g = Grammar('e')
+        g['e'] = (g['e'] + item('-') + g['n']) | g['n']
+        g['n'] = Set('0123456789')
+        self.assertEqual(('1-2-3', 5), g.parse('1-2-3'))
+        self.assertEqual(next(g('1-2-3')), g.parse('1-2-3'))
+        self.assertEqual(None, g.parse('-'))
+
+    def test_memo(self):
+        calls = []
+        def count(r):
+            calls.append(r)
+            return r
+        g = Grammar('s', memo=Memo())
+        g['s'] = (g['a'] + item('x')) | (g['a'] + item('y'))
+        g['a'] = element >> Make(count)
+        self.assertEqual(('ay', 2), g.parse('ay'))
+        self.assertEqual(1, len(calls))
+
+    def test_agrees_with_first_result(self):
+        from benchmarks.grammars import benchmarks
+        for benchmark in benchmarks:
+            value = benchmark.make(300)
+            result, pos = benchmark.parser.match(value, 0)
+            self.assertEqual(len(value), pos, benchmark.name)
+            self.assertEqual(benchmark.parse(value), pos)
+        g = Grammar('e')
+        g['e'] = (g['e'] + item('-') + g['n']) | g['n']
+        g['n'] = item('1') | (item('(') + g['e'] + item(')'))
+        g.optimize()
+        self.assertEqual(next(g('1-(1-1)-1')), g.parse('1-(1-1)-1'))
+        g.predict()
+        self.assertEqual(next(g('1-(1-1)-1')), g.parse('1-(1-1)-1'))
+
+
+class Point(object):
+
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+
+class Point3(Point):
+    pass
+
+
+class OldStyle:
+    pass
+
+
+class StructureTest(ParseTest):
+
+    def test_get_at(self):
+        self.assertParse(get('x'), Point(1, 2), 1, 0)
+        self.assertParse(get('x.real'), Point(1, 2), 1, 0)
+        self.assertParse(at(1), (1, 2), 2, 0)
+        self.assertEqual((2, 0), get('y').match(Point(1, 2), 0))
+
+    def test_type_of(self):
+        point = Point3(1, 2)
+        self.assertParse(type_of(Point), point, point, 0)
+        self.assertFail(type_of(Point3), Point(1, 2))
+        self.assertEqual(None, type_of(int).match('1', 0))
+
+    def test_match_type(self):
+        p = match_type({Point: get('x'), Point3: get('y'), (int, long): this})
+        self.assertParse(p, Point(1, 2), 1, 0)
+        self.assertParse(p, Point3(1, 2), 2, 0)
+        self.assertParse(p, 5L, 5L, 0)
+        self.assertFail(p, 'x')
+        self.assertFail(match_type({Point: this}), OldStyle())
+        self.assertParse(match_type({OldStyle: Return(1)}), OldStyle(), 1, 0)
+        self.assertEqual((2, 0), p.match(Point3(1, 2), 0))
+        self.assertTrue(Point3 in p.cache)
+
+    def test_match_type_virtual(self):
+        import collections
+        p = match_type({collections.Sized: Return('sized')})
+        self.assertParse(p, [], 'sized', 0)
+        self.assertFail(p, 1)
+
+    def test_match_type_order(self):
+        import collections
+        for first, second in ((collections.Sized, collections.Iterable),
+                              (collections.Iterable, collections.Sized)):
+            p = match_type([(first, Return(first)), (second, Return(second))])
+            self.assertParse(p, [], first, 0)
+
+    def test_match_type_rewrites(self):
+        from peg.prediction import Dispatch
+        def build():
+            g = Grammar('s')
+            g['s'] = match_type({list: item('a') | item('b') | item('c'),
+                                 Point: get('x')[item('x')]})
+            return g
+        g = build().optimize()
+        p = g.rules['s']
+        self.assertEqual(Items, type(p.parsers[p.indices[list]]))
+        g = build().intern().predict().compile()
+        p = g.rules['s']
+        self.assertEqual(Dispatch, type(p.parsers[p.indices[list]]))
+        self.assertTrue(p.parsers[p.indices[Point]].inner is item('x').intern())
+        self.assertEqual([('b', 1)], list(g(['b'])))
+        self.assertEqual([('x', 0)], list(g(Point(['x'], 0))))
+
+    def test_structure_compiled(self):
+        p = star(element[type_of(Point)[get('x')] | at(0)])
+        value = [Point(1, 2), (3, 4), Point3(5, 6)]
+        self.assertEqual(list(p(value, 0)), list(p.compile()(value, 0)))
+        self.assertEqual(([1, 3, 5], 3), p.match(value, 0))
+
+    def test_pickle_match_type(self):
+        import pickle
+        p = match_type({Point: get('x')})
+        list(p(Point(1, 2), 0))
+        q = pickle.loads(pickle.dumps(p, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual({}, q.cache)
+        self.assertParse(q, Point3(1, 2), 1, 0)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_benchmarks_parse(self):
+        from benchmarks.grammars import benchmarks
+        for benchmark in benchmarks:
+            value = benchmark.make(1000)
+            self.assertEqual(len(value), benchmark.parse(value), benchmark.name)
+
+    def test_slopes(self):
+        from benchmarks.runner import slopes
+        measurements = [{'size': 10, 'seconds': 1.0}, {'size': 100, 'seconds': 100.0}]
+        self.assertAlmostEqual(2.0, slopes(measurements)[0])
+
+
 if __name__ == '__main__':
     unittest.main()